@@ -0,0 +1,156 @@
+# ==================== IMPORTS ====================
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+
+from fastapi.responses import JSONResponse
+
+from metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_QUEUE_SECONDS, ADMISSION_SHED
+
+SHED_QUEUE_FULL = "queue_full"
+SHED_DEADLINE = "deadline"
+
+class RequestShed(Exception):
+    """A request was refused admission; answered with 503 and Retry-After"""
+
+    def __init__(self, route: str, reason: str, retry_after: float):
+        super().__init__(f"Server busy ({route}), retry later")
+        self.route = route
+        self.reason = reason
+        self.retry_after = retry_after
+
+def shed_response(shed: RequestShed) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(shed), "route": shed.route, "reason": shed.reason},
+        headers={"Retry-After": str(max(1, math.ceil(shed.retry_after)))},
+    )
+
+# ==================== LIMITER ====================
+class AdmissionLimiter:
+    """Weighted concurrency limit with a bounded FIFO wait queue.
+
+    A request takes cost units (1 for a plain request, the operation count for
+    a batch) and waits in line while they are not available. It is shed when
+    the line is full or when it would wait past queue_timeout: answering 503
+    quickly is better than answering late. Lives on the event loop of its worker.
+    """
+
+    def __init__(self, route: str, capacity: int, max_queue: int = 100,
+                 queue_timeout: float = 0.5, retry_after: float = 1.0):
+        self.route = route
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_use = 0
+        self._waiters = deque()
+        self._in_flight = ADMISSION_IN_FLIGHT.labels(route)
+        self._queue_depth = ADMISSION_QUEUE_DEPTH.labels(route)
+        self._queue_seconds = ADMISSION_QUEUE_SECONDS.labels(route)
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, cost: int = 1, shed: bool = True) -> int:
+        """Wait for cost units; returns the units taken, to be given back with release().
+
+        With shed=False the caller waits as long as it takes, which is how a
+        stream that has already started applies backpressure.
+        """
+        cost = min(max(cost, 1), self.capacity)
+        if not self._waiters and self.in_use + cost <= self.capacity:
+            self._take(cost)
+            return cost
+        if shed and len(self._waiters) >= self.max_queue:
+            self._shed(SHED_QUEUE_FULL)
+        started = time.perf_counter()
+        waiter = (cost, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._queue_depth.inc()
+        try:
+            await asyncio.wait_for(waiter[1], self.queue_timeout if shed else None)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter[1].done() and not waiter[1].cancelled():
+                # Granted just as the wait ended: hand the units on
+                self.release(cost)
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._queue_depth.dec()
+                # A large request at the head may have been holding back smaller ones
+                self._grant()
+            if isinstance(e, asyncio.TimeoutError):
+                self._shed(SHED_DEADLINE)
+            raise
+        self._queue_seconds.observe(time.perf_counter() - started)
+        return cost
+
+    def release(self, cost: int):
+        self.in_use -= cost
+        self._in_flight.dec(cost)
+        self._grant()
+
+    @asynccontextmanager
+    async def slot(self, cost: int = 1, shed: bool = True):
+        taken = await self.acquire(cost, shed)
+        try:
+            yield
+        finally:
+            self.release(taken)
+
+    def _take(self, cost: int):
+        """Admit without waiting"""
+        self.in_use += cost
+        self._in_flight.inc(cost)
+        self._queue_seconds.observe(0.0)
+
+    def _grant(self):
+        """Admit waiters in arrival order while their cost fits"""
+        while self._waiters and self.in_use + self._waiters[0][0] <= self.capacity:
+            cost, future = self._waiters.popleft()
+            self._queue_depth.dec()
+            if future.done():
+                continue
+            self.in_use += cost
+            self._in_flight.inc(cost)
+            future.set_result(None)
+
+    def _shed(self, reason: str):
+        ADMISSION_SHED.labels(self.route, reason).inc()
+        raise RequestShed(self.route, reason, self.retry_after)
+
+# ==================== MIDDLEWARE ====================
+class AdmissionMiddleware:
+    """ASGI middleware that admits each request through the limiter of its route.
+
+    Routes are matched by method and exact path, since a path can serve both
+    cheap and expensive requests; anything without a limiter (health checks,
+    metrics, event streams) is never limited. The slot is held until the
+    response has been sent, so streamed responses count for their whole duration.
+    """
+
+    def __init__(self, app, limiters: Dict[Tuple[str, str], AdmissionLimiter], enabled: bool = True):
+        self.app = app
+        self.limiters = limiters
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        limiter: Optional[AdmissionLimiter] = None
+        if self.enabled and scope["type"] == "http":
+            limiter = self.limiters.get((scope["method"], scope["path"]))
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            cost = await limiter.acquire()
+        except RequestShed as shed:
+            await shed_response(shed)(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release(cost)
@@ -0,0 +1,146 @@
+# ==================== IMPORTS ====================
+import datetime
+import gc
+from contextlib import contextmanager
+from typing import List, Tuple
+
+import numpy as np
+
+from history_schema import build_history_documents, build_history_error_document, object_ids
+
+# ==================== OPERATION CODES ====================
+OP_UNSUPPORTED = -1
+OP_SUM = 0
+OP_SUB = 1
+OP_MUL = 2
+OP_DIV = 3
+OPERATION_CODES = {"sum": OP_SUM, "sub": OP_SUB, "mul": OP_MUL, "div": OP_DIV}
+
+# Per-item status codes, in the order the per-item loop checks them
+STATUS_OK = 0
+STATUS_BAD_COUNT = 1
+STATUS_NEGATIVE = 2
+STATUS_UNSUPPORTED = 3
+STATUS_DIVISION_BY_ZERO = 4
+
+ERROR_MESSAGES = {
+    STATUS_BAD_COUNT: "Exactly 2 numbers are required",
+    STATUS_NEGATIVE: "Negative numbers are not allowed",
+    STATUS_UNSUPPORTED: "Unsupported operation",
+    STATUS_DIVISION_BY_ZERO: "Division by zero",
+}
+
+# ==================== COLUMNAR EVALUATION ====================
+def split_columns(operations):
+    """Split batch operations into operation codes and operand columns"""
+    count = len(operations)
+    names = [item.operation for item in operations]
+    operands = [item.numbers for item in operations]
+    codes = np.fromiter(
+        (OPERATION_CODES.get(name, OP_UNSUPPORTED) for name in names),
+        dtype=np.int8,
+        count=count,
+    )
+    pair_mask = np.fromiter((len(numbers) == 2 for numbers in operands), dtype=bool, count=count)
+    pairs = np.zeros((count, 2), dtype=np.float64)
+    if count and pair_mask.all():
+        pairs[:] = operands
+    elif pair_mask.any():
+        pairs[pair_mask] = [numbers for numbers, ok in zip(operands, pair_mask) if ok]
+    return names, operands, codes, pair_mask, pairs[:, 0], pairs[:, 1]
+
+def compute_columns(codes, pair_mask, a, b):
+    """Validate with array masks and compute one NumPy pass per operation type"""
+    status = np.full(codes.shape, STATUS_OK, dtype=np.int8)
+    status[~pair_mask] = STATUS_BAD_COUNT
+
+    pending = status == STATUS_OK
+    negative = pending & ((a < 0) | (b < 0))
+    status[negative] = STATUS_NEGATIVE
+    pending &= ~negative
+
+    unsupported = pending & (codes == OP_UNSUPPORTED)
+    status[unsupported] = STATUS_UNSUPPORTED
+    pending &= ~unsupported
+
+    zero_division = pending & (codes == OP_DIV) & (b == 0)
+    status[zero_division] = STATUS_DIVISION_BY_ZERO
+    pending &= ~zero_division
+
+    results = np.zeros(codes.shape, dtype=np.float64)
+    for code, ufunc in ((OP_SUM, np.add), (OP_SUB, np.subtract), (OP_MUL, np.multiply), (OP_DIV, np.divide)):
+        mask = pending & (codes == code)
+        if mask.any():
+            results[mask] = ufunc(a[mask], b[mask])
+    return status, results
+
+@contextmanager
+def gc_paused():
+    """Pause cyclic garbage collection while a batch builds its (acyclic) rows.
+
+    Hundreds of thousands of new dicts and lists otherwise trigger repeated
+    collections that scan them all; reference counting still frees them. Only
+    the caller that found collection enabled turns it back on.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def evaluate_batch(operations, created_at: datetime.datetime) -> Tuple[List[dict], List[dict]]:
+    """Evaluate a batch column-wise; returns per-item results and history documents.
+
+    Successful items (usually all of them) are built column by column with
+    ObjectIds made in bulk; failed items are built one by one and put back
+    at their index.
+    """
+    names, operands, codes, pair_mask, a, b = split_columns(operations)
+    status, values = compute_columns(codes, pair_mask, a, b)
+    with gc_paused():
+        return build_batch_rows(names, operands, status, values, a, b, created_at)
+
+def build_batch_rows(names, operands, status, values, a, b, created_at: datetime.datetime):
+    """Results and history documents in request order from the evaluated columns"""
+    ids = object_ids(created_at, len(names))
+
+    ok = status == STATUS_OK
+    if ok.all():
+        ok_index = None
+        ok_ids, ok_names, ok_a, ok_b, ok_values = ids, names, a.tolist(), b.tolist(), values.tolist()
+    else:
+        ok_index = np.flatnonzero(ok).tolist()
+        ok_ids = [ids[index] for index in ok_index]
+        ok_names = [names[index] for index in ok_index]
+        ok_a, ok_b, ok_values = a[ok].tolist(), b[ok].tolist(), values[ok].tolist()
+
+    results = [{"operation": operation, "result": value} for operation, value in zip(ok_names, ok_values)]
+    documents = build_history_documents(ok_ids, ok_names, [[x, y] for x, y in zip(ok_a, ok_b)], ok_values, created_at)
+    if ok_index is None:
+        return results, documents
+
+    all_results = [None] * len(names)
+    all_documents = [None] * len(names)
+    for index, result, document in zip(ok_index, results, documents):
+        all_results[index] = result
+        all_documents[index] = document
+    a_list = a.tolist()
+    b_list = b.tolist()
+    for index in np.flatnonzero(~ok).tolist():
+        code = int(status[index])
+        operation = names[index]
+        if code == STATUS_BAD_COUNT:
+            item_operands = operands[index]
+        else:
+            item_operands = [a_list[index], b_list[index]]
+        all_results[index] = {
+            "operation": operation,
+            "error": ERROR_MESSAGES[code],
+            "operands": item_operands
+        }
+        all_documents[index] = build_history_error_document(
+            operation, item_operands, ERROR_MESSAGES[code], created_at, ids[index]
+        )
+    return all_results, all_documents
@@ -0,0 +1,46 @@
+# ==================== IMPORTS ====================
+from typing import AsyncIterator, Iterable, Tuple
+
+from starlette.responses import StreamingResponse
+
+from fast_response import dumps
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+class StreamLineTooLong(ValueError):
+    """An NDJSON line grew past the configured limit without a newline"""
+
+# ==================== NDJSON FRAMING ====================
+async def ndjson_lines(chunks: AsyncIterator[bytes], max_line_bytes: int) -> AsyncIterator[Tuple[int, bytes]]:
+    """Split a byte stream into (line_number, line) pairs as chunks arrive; blank lines are skipped"""
+    buffer = b""
+    line_number = 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, line
+        if len(buffer) > max_line_bytes:
+            raise StreamLineTooLong(f"Line {line_number + 1} is longer than {max_line_bytes} bytes")
+    if buffer.strip():
+        yield line_number + 1, buffer
+
+def encode_lines(items: Iterable[dict]) -> bytes:
+    """Serialize items as NDJSON, one object per line; NaN and infinities are written as null like other responses"""
+    return b"".join(dumps(item) + b"\n" for item in items)
+
+# ==================== RESPONSE ====================
+class RequestStreamingResponse(StreamingResponse):
+    """StreamingResponse whose body iterator reads the request body while responding.
+
+    Starlette's disconnect listener would compete with the iterator for
+    receive() messages, so it is not started; a disconnect surfaces as
+    ClientDisconnect from request.stream() instead.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
@@ -0,0 +1,143 @@
+"""Latency of cheap requests while large batches saturate the server.
+
+Runs the same mixed load with admission control off and on, each in a fresh
+interpreter (the limits are read at import): batch workers post large
+/calculator/batch requests back to back while other workers call
+/calculator/sum. Reports sum latency, batch throughput and how many
+requests were shed with 503. History writes are discarded by default:
+mongomock cannot keep up with this load, and history backpressure would
+then dominate every latency measured here.
+
+Usage (from backend/):
+    python benchmarks/bench_admission.py --seconds 10
+"""
+# ==================== IMPORTS ====================
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ==================== SERVER ====================
+class DiscardCollection:
+    """History collection that accepts and drops every insert"""
+
+    def insert_many(self, documents, ordered=True):
+        pass
+
+def serve(args):
+    """Server process: main.app on 127.0.0.1 with the benchmark's history storage"""
+    sys.path.insert(0, BACKEND_DIR)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import uvicorn
+    import main
+    from run_benchmarks import Storage
+
+    logging.getLogger("custom_logger").setLevel(logging.WARNING)
+    Storage().fresh("admission")
+    if not args.keep_history:
+        main.collection_historial = DiscardCollection()
+    # The lifespan would open real Mongo clients; the storage above replaces them
+    uvicorn.run(main.app, host="127.0.0.1", port=args.serve, lifespan="off", log_level="warning")
+
+def start_server(args, admission: bool):
+    """Spawn a server process and wait until it answers"""
+    port = free_port()
+    env = dict(os.environ, ADMISSION_CONTROL="true" if admission else "false")
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", str(port)] + sys.argv[1:],
+        cwd=BACKEND_DIR, env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(3000):
+        try:
+            httpx.get(f"{base_url}/health/live")
+            return server, base_url
+        except httpx.HTTPError:
+            time.sleep(0.01)
+    server.terminate()
+    raise TimeoutError("benchmark server did not start")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# ==================== LOAD ====================
+async def mixed_load(base_url, batch_body, seconds, batch_workers, cheap_workers):
+    """Run both kinds of workers for a fixed time; returns latencies and status counts"""
+    deadline = time.perf_counter() + seconds
+    stats = {"sum": [], "batch": [], "sum_shed": 0, "batch_shed": 0, "errors": 0}
+
+    async def worker(client, kind, send):
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = await send(client)
+            if response.status_code == 503:
+                stats[f"{kind}_shed"] += 1
+                await asyncio.sleep(float(response.headers.get("Retry-After", "1")) / 10)
+            elif response.status_code >= 500:
+                stats["errors"] += 1
+            else:
+                stats[kind].append(time.perf_counter() - started)
+
+    def send_sum(client):
+        return client.get("/calculator/sum", params={"numbers": [1.5, 2.5]})
+
+    def send_batch(client):
+        return client.post("/calculator/batch", content=batch_body, headers={"Content-Type": "application/json"})
+
+    limits = httpx.Limits(max_connections=batch_workers + cheap_workers)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        await asyncio.gather(
+            *(worker(client, "batch", send_batch) for _ in range(batch_workers)),
+            *(worker(client, "sum", send_sum) for _ in range(cheap_workers)),
+        )
+    return stats
+
+# ==================== MAIN ====================
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--batch-size", type=int, default=20000)
+    parser.add_argument("--batch-workers", type=int, default=32)
+    parser.add_argument("--cheap-workers", type=int, default=8)
+    parser.add_argument("--keep-history", action="store_true", help="write history to mongomock")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    rng = random.Random(42)
+    batch_body = json.dumps([
+        {"operation": rng.choice(["sum", "sub", "mul", "div"]), "numbers": [rng.uniform(0, 1000), rng.uniform(1, 1000)]}
+        for _ in range(args.batch_size)
+    ]).encode()
+    for admission in (False, True):
+        server, base_url = start_server(args, admission)
+        try:
+            stats = asyncio.run(mixed_load(base_url, batch_body, args.seconds, args.batch_workers, args.cheap_workers))
+        finally:
+            server.terminate()
+            server.wait(10)
+        sums = sorted(t * 1000 for t in stats["sum"])
+        print(
+            f"admission {'on' if admission else 'off':>3}: "
+            f"sum p50 {statistics.median(sums):7.1f} ms  p99 {sums[int(len(sums) * 0.99)]:7.1f} ms  "
+            f"sum rps {len(sums) / args.seconds:7.1f}  batch rps {len(stats['batch']) / args.seconds:5.1f}  "
+            f"shed sum/batch {stats['sum_shed']}/{stats['batch_shed']}  errors {stats['errors']}"
+        )
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,69 @@
+"""Compare the per-item batch loop with the columnar NumPy engine.
+
+Usage (from backend/):
+    python benchmarks/bench_batch.py --sizes 100 1000 10000 100000 --repeat 3
+"""
+# ==================== IMPORTS ====================
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from batch_engine import evaluate_batch  # noqa: E402
+from history_schema import utc_now  # noqa: E402
+
+OPERATIONS = ["sum", "sub", "mul", "div"]
+
+# ==================== WORKLOAD ====================
+def make_batch(size: int, seed: int = 42):
+    """Random batch with roughly 5% invalid items"""
+    rng = random.Random(seed)
+    batch = []
+    for _ in range(size):
+        operation = rng.choice(OPERATIONS)
+        a = rng.uniform(0, 1000)
+        b = rng.uniform(0, 1000)
+        roll = rng.random()
+        if roll < 0.02:
+            b = 0.0
+        elif roll < 0.04:
+            a = -a
+        elif roll < 0.05:
+            operation = "pow"
+        batch.append(main.BatchOperation(operation=operation, numbers=[a, b]))
+    return batch
+
+def best_of(repeat: int, func, *args):
+    """Best wall time of several runs"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+# ==================== MAIN ====================
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # Per-item log lines would dominate the loop timings; measure compute only
+    logging.disable(logging.CRITICAL)
+
+    print(f"{'size':>10} {'loop (ms)':>12} {'vector (ms)':>12} {'speedup':>8}")
+    for size in args.sizes:
+        batch = make_batch(size)
+        created_at = utc_now()
+        loop_time = best_of(args.repeat, main.batch_operations_loop, batch)
+        vector_time = best_of(args.repeat, evaluate_batch, batch, created_at)
+        print(f"{size:>10} {loop_time * 1000:>12.2f} {vector_time * 1000:>12.2f} {loop_time / vector_time:>7.1f}x")
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,160 @@
+"""Storage and latency of compacted history against plain inserts, on one traffic mix.
+
+The mix is either the newest documents of a real history collection
+(--mongo-url, only read) or a synthetic one where --repeat-share of the calls
+repeat one of --distinct popular inputs. Every mode writes the same operations
+in history writer batches, then times a history page and the stats
+aggregation over what was stored. mongomock scans the collection on every
+upsert, so only a real server (--mongo-url) gives meaningful write latencies.
+
+Usage (from backend/):
+    python benchmarks/bench_compaction.py --operations 10000
+    python benchmarks/bench_compaction.py --operations 10000 --rate 2 --repeat-share 0.5 --windows 60 3600
+    python benchmarks/bench_compaction.py --mongo-url mongodb://localhost:27017 --source-database practica1
+"""
+# ==================== IMPORTS ====================
+import argparse
+import datetime
+import functools
+import operator
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bson  # noqa: E402
+import mongomock  # noqa: E402
+from bson import ObjectId  # noqa: E402
+from pymongo import DESCENDING, MongoClient  # noqa: E402
+
+from history_compaction import COUNTER_FIELDS, CompactingCollection, compaction_summary, ensure_compaction_index  # noqa: E402
+from history_query import ensure_history_indexes, find_history_documents  # noqa: E402
+from history_schema import SCHEMA_VERSION, build_history_document  # noqa: E402
+from history_stats import aggregate_rows  # noqa: E402
+from run_benchmarks import MongomockCollection  # noqa: E402
+
+REDUCERS = {
+    "sum": operator.add,
+    "subtract": operator.sub,
+    "multiplication": operator.mul,
+    "division": operator.truediv,
+}
+
+# ==================== TRAFFIC MIX ====================
+def synthetic_mix(count: int, distinct: int, repeat_share: float, rate: float, seed: int):
+    """count operations at rate per second; repeat_share of them are popular inputs (Zipf-like)"""
+    rng = random.Random(seed)
+    popular = [
+        (rng.choice(list(REDUCERS)), [float(rng.randint(1, 20)) for _ in range(rng.choice([2, 2, 3]))])
+        for _ in range(distinct)
+    ]
+    weights = [1 / (rank + 1) for rank in range(distinct)]
+    start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=count / rate)
+    documents = []
+    for index in range(count):
+        if rng.random() < repeat_share:
+            operation, numbers = rng.choices(popular, weights)[0]
+        else:
+            operation, numbers = rng.choice(list(REDUCERS)), [round(rng.uniform(1, 1000), 3) for _ in range(2)]
+        result = functools.reduce(REDUCERS[operation], numbers)
+        created_at = start + datetime.timedelta(seconds=index / rate)
+        documents.append(build_history_document(operation, list(numbers), result, created_at))
+    return documents
+
+def recorded_mix(mongo_url: str, database: str, count: int):
+    """The newest count operations of a real history collection, oldest first"""
+    collection = MongoClient(mongo_url)[database].historial
+    documents = []
+    for document in collection.find({"schema_version": SCHEMA_VERSION}).sort("_id", DESCENDING).limit(count):
+        # Already compacted: back to one document per operation
+        repeats = document.get("count", 1)
+        document = {field: value for field, value in document.items() if field not in COUNTER_FIELDS}
+        documents.append(document)
+        documents.extend(dict(document, _id=ObjectId()) for _ in range(repeats - 1))
+    documents.reverse()
+    return documents
+
+# ==================== MEASUREMENTS ====================
+def storage_bytes(collection) -> int:
+    """BSON size of every stored document (data only, indexes excluded)"""
+    return sum(len(bson.encode(document)) for document in collection.find())
+
+def best_of(repeat: int, func):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def run_mode(database, name: str, documents, window, chunk: int, repeat: int) -> dict:
+    database[name].drop()
+    collection = database[name]
+    if isinstance(database, mongomock.Database):
+        collection = MongomockCollection(collection)
+    ensure_history_indexes(collection)
+    sink = collection
+    if window:
+        ensure_compaction_index(collection)
+        sink = CompactingCollection(collection, window)
+
+    started = time.perf_counter()
+    for offset in range(0, len(documents), chunk):
+        # Copies: a plain insert adds nothing, but the source must stay reusable across modes
+        sink.insert_many([dict(document) for document in documents[offset:offset + chunk]], ordered=False)
+    write_seconds = time.perf_counter() - started
+
+    start = min(document["created_at"] for document in documents)
+    end = max(document["created_at"] for document in documents) + datetime.timedelta(seconds=1)
+    summary = compaction_summary(collection)
+    return {
+        "mode": f"compacted {window:g}s" if window else "plain",
+        "entries": summary["entries"],
+        "ratio": summary["ratio"],
+        "bytes": storage_bytes(collection),
+        "write_us": write_seconds / len(documents) * 1e6,
+        "page_ms": best_of(repeat, lambda: find_history_documents(collection, 50, sort_by="result")) * 1000,
+        "stats_ms": best_of(repeat, lambda: aggregate_rows(collection, start, end, "hour")) * 1000,
+    }
+
+# ==================== MAIN ====================
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--operations", type=int, default=10000)
+    parser.add_argument("--distinct", type=int, default=200, help="popular inputs of the synthetic mix")
+    parser.add_argument("--repeat-share", type=float, default=0.7, help="share of calls repeating a popular input")
+    parser.add_argument("--rate", type=float, default=50, help="synthetic operations per second")
+    parser.add_argument("--windows", type=float, nargs="+", default=[60, 3600], help="compaction windows (seconds)")
+    parser.add_argument("--chunk", type=int, default=500, help="documents per write (HISTORY_BATCH_SIZE)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--mongo-url", default=None, help="read the mix from, and write to, this server")
+    parser.add_argument("--source-database", default="practica1")
+    args = parser.parse_args()
+
+    if args.mongo_url:
+        documents = recorded_mix(args.mongo_url, args.source_database, args.operations)
+        database = MongoClient(args.mongo_url)["calculator_benchmark"]
+    else:
+        documents = synthetic_mix(args.operations, args.distinct, args.repeat_share, args.rate, args.seed)
+        database = mongomock.MongoClient()["calculator_benchmark"]
+    if not documents:
+        sys.exit("no history documents to replay")
+
+    rows = [run_mode(database, "compaction_plain", documents, None, args.chunk, args.repeat)]
+    for window in args.windows:
+        rows.append(run_mode(database, f"compaction_{window:g}", documents, window, args.chunk, args.repeat))
+
+    plain = rows[0]
+    print(f"{len(documents)} operations, {'recorded' if args.mongo_url else 'synthetic'} mix")
+    print(f"{'mode':<16} {'entries':>9} {'ratio':>7} {'MB':>8} {'saved':>7} {'write us/op':>12} {'page ms':>9} {'stats ms':>9}")
+    for row in rows:
+        saved = 1 - row["bytes"] / plain["bytes"]
+        print(f"{row['mode']:<16} {row['entries']:>9} {row['ratio']:>7.2f} {row['bytes'] / 1e6:>8.2f} {saved:>7.1%} "
+              f"{row['write_us']:>12.1f} {row['page_ms']:>9.2f} {row['stats_ms']:>9.2f}")
+
+if __name__ == "__main__":
+    main_cli()
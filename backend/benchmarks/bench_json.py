@@ -0,0 +1,96 @@
+"""Compare the old JSON response path with the orjson one for large responses.
+
+"before" rebuilds one dict per history row and encodes with jsonable_encoder
+and the stdlib json module (what FastAPI does for a returned dict); "after"
+turns the fetched documents into rows in place and encodes with orjson.
+
+Usage (from backend/):
+    python benchmarks/bench_json.py --rows 100000 --repeat 3
+"""
+# ==================== IMPORTS ====================
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+import fast_response  # noqa: E402
+from history_query import HISTORY_PROJECTION  # noqa: E402
+from history_schema import build_history_document, format_date, history_row  # noqa: E402
+
+OPERATIONS = ["sum", "subtract", "multiplication", "division"]
+
+# ==================== WORKLOAD ====================
+def fetched_documents(rows: int, seed: int = 42):
+    """Documents as a history query returns them (projected fields only)"""
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    documents = []
+    for index in range(rows):
+        numbers = [round(rng.uniform(0, 1000), 3), round(rng.uniform(1, 1000), 3)]
+        document = build_history_document(rng.choice(OPERATIONS), numbers, sum(numbers), now - datetime.timedelta(seconds=index))
+        documents.append({field: value for field, value in document.items() if field in HISTORY_PROJECTION or field == "_id"})
+    return documents
+
+def copies(documents, repeat: int):
+    return [[dict(document) for document in documents] for _ in range(repeat)]
+
+# ==================== ENCODERS ====================
+def encode_before(documents) -> bytes:
+    history = [
+        {
+            "numbers": document["numbers"],
+            "result": document["result"],
+            "operation": document["operation"],
+            "date": format_date(document["created_at"]),
+        }
+        for document in documents
+    ]
+    content = jsonable_encoder({"history": history, "next_cursor": None})
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+def encode_after(documents) -> bytes:
+    history = [history_row(document) for document in documents]
+    return fast_response.dumps({"history": history, "next_cursor": None})
+
+def best_of(func, inputs):
+    """Best wall time over one run per input; returns (seconds, last output)"""
+    best = None
+    output = None
+    for item in inputs:
+        started = time.perf_counter()
+        output = func(item)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+# ==================== MAIN ====================
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    encodings = ["gzip"] + (["br"] if fast_response.brotli else [])
+    header = f"{'rows':>8} {'path':>7} {'encode (ms)':>12} {'bytes':>11}"
+    for encoding in encodings:
+        header += f" {encoding + ' (ms)':>10} {encoding + ' bytes':>11}"
+    print(header)
+    for rows in args.rows:
+        documents = fetched_documents(rows)
+        for label, encoder in (("before", encode_before), ("after", encode_after)):
+            encode_time, body = best_of(encoder, copies(documents, args.repeat))
+            line = f"{rows:>8} {label:>7} {encode_time * 1000:>12.2f} {len(body):>11}"
+            for encoding in encodings:
+                compress_time, compressed = best_of(lambda b: fast_response.compress(b, encoding), [body] * args.repeat)
+                line += f" {compress_time * 1000:>10.2f} {len(compressed):>11}"
+            print(line)
+
+if __name__ == "__main__":
+    main_cli()
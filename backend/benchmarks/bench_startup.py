@@ -0,0 +1,120 @@
+"""Measure how long `import main` takes and how soon a fresh server answers.
+
+Each run starts a new interpreter, so nothing is cached between runs apart
+from the OS file cache. Time to first request is measured from process spawn
+until the probe path answers; the default probe works on every version of
+the app. Mongo and Loki do not have to be reachable, which is the case this
+is meant to show: startup must not wait on them.
+
+With --compare, the backend at a git ref (e.g. the commit before a change)
+is extracted to a temporary directory and measured the same way, and both
+results are printed with their ratio. --ref measures a git ref instead of
+the working tree.
+
+Usage (from backend/):
+    python benchmarks/bench_startup.py --runs 5
+    python benchmarks/bench_startup.py --runs 5 --compare 0d0c862^ --ref 0d0c862
+"""
+# ==================== IMPORTS ====================
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ==================== MEASUREMENTS ====================
+def import_time(env, backend_dir: str = BACKEND_DIR) -> float:
+    """Seconds for `import main` in a fresh interpreter"""
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=backend_dir, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def first_request_time(env, probe: str, backend_dir: str = BACKEND_DIR, timeout: float = 60) -> float:
+    """Seconds from spawning uvicorn until probe answers with a 2xx"""
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=backend_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(timeout=1) as client:
+            while time.perf_counter() - started < timeout:
+                try:
+                    if client.get(f"http://127.0.0.1:{port}{probe}").is_success:
+                        return time.perf_counter() - started
+                except httpx.HTTPError:
+                    pass
+                time.sleep(0.01)
+        raise TimeoutError(f"{probe} did not answer within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait(10)
+
+def measure(env, probe: str, runs: int, backend_dir: str = BACKEND_DIR) -> dict:
+    return {
+        "import main": [import_time(env, backend_dir) for _ in range(runs)],
+        "first request": [first_request_time(env, probe, backend_dir) for _ in range(runs)],
+    }
+
+def extract_backend(ref: str, directory: str) -> str:
+    """backend/ as of a git ref, extracted into directory (the working tree is not touched)"""
+    # Run from backend/, git archive puts this directory's files at the top of the tar
+    archive = subprocess.run(
+        ["git", "archive", "--format=tar", ref, "."], cwd=BACKEND_DIR, capture_output=True, check=True
+    ).stdout
+    os.makedirs(directory)
+    tar_path = os.path.join(directory, "backend.tar")
+    with open(tar_path, "wb") as tar_file:
+        tar_file.write(archive)
+    backend_dir = os.path.join(directory, "backend")
+    with tarfile.open(tar_path) as tar:
+        tar.extractall(backend_dir)
+    return backend_dir
+
+def print_results(label: str, results: dict):
+    print(label)
+    for name, values in results.items():
+        print(f"{name:>14}: median {statistics.median(values) * 1000:8.1f} ms"
+              f"  min {min(values) * 1000:8.1f} ms  max {max(values) * 1000:8.1f} ms")
+
+# ==================== MAIN ====================
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--probe", default="/calculator/sum?numbers=1&numbers=2")
+    parser.add_argument("--mongo-url", default="mongodb://127.0.0.1:1/", help="unreachable by default")
+    parser.add_argument("--loki-url", default="http://127.0.0.1:1/loki/api/v1/push", help="unreachable by default")
+    parser.add_argument("--compare", metavar="REF", help="also measure backend/ at this git ref, as the baseline")
+    parser.add_argument("--ref", help="measure backend/ at this git ref instead of the working tree")
+    args = parser.parse_args()
+
+    env = dict(os.environ, MONGO_URL=args.mongo_url, LOKI_URL=args.loki_url)
+    with tempfile.TemporaryDirectory() as directory:
+        if args.compare:
+            before = measure(env, args.probe, args.runs, extract_backend(args.compare, os.path.join(directory, "before")))
+            print_results(f"{args.compare}:", before)
+        backend_dir = extract_backend(args.ref, os.path.join(directory, "after")) if args.ref else BACKEND_DIR
+        after = measure(env, args.probe, args.runs, backend_dir)
+    print_results(f"{args.ref or 'working tree'}:", after)
+    if args.compare:
+        for name, values in after.items():
+            print(f"{name:>14}: {statistics.median(before[name]) / statistics.median(values):.2f}x (baseline / measured median)")
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,490 @@
+"""Reproducible performance benchmarks for the calculator backend.
+
+Runs without network access: Mongo is replaced by mongomock (or a local
+server given with --mongo-url) and HTTP runs against an in-process uvicorn
+bound to 127.0.0.1. With --backends the same workload runs once per history
+storage backend, so their latencies can be compared in one report. Results
+are written as JSON so runs can be compared across commits.
+
+Admission control is off unless ADMISSION_CONTROL=true is set explicitly:
+requests it sheds answer in microseconds and would hide the real latencies
+(bench_admission.py measures it). Shed and failed requests are counted in
+their own columns and never enter the latency samples.
+
+Usage (from backend/):
+    python benchmarks/run_benchmarks.py --quick
+    python benchmarks/run_benchmarks.py --output bench-results.json
+    python benchmarks/run_benchmarks.py --history-sizes 1000 10000 100000 1000000
+    python benchmarks/run_benchmarks.py --quick --backends mongo memory sqlite
+"""
+# ==================== IMPORTS ====================
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Read when main is imported: the middleware is configured once
+os.environ.setdefault("ADMISSION_CONTROL", "false")
+
+import httpx  # noqa: E402
+import mongomock  # noqa: E402
+import uvicorn  # noqa: E402
+from pymongo import MongoClient, ReplaceOne, UpdateOne  # noqa: E402
+from pymongo.results import BulkWriteResult  # noqa: E402
+
+import main  # noqa: E402
+from history_query import ensure_history_indexes  # noqa: E402
+from history_repository import (  # noqa: E402
+    HISTORY_BACKENDS,
+    MemoryHistoryRepository,
+    MongoHistoryRepository,
+    SQLiteHistoryRepository,
+)
+from history_schema import build_history_document  # noqa: E402
+
+OPERATIONS = ["sum", "subtract", "multiplication", "division"]
+ENDPOINTS = {
+    "sum": "/calculator/sum",
+    "subtract": "/calculator/substract",
+    "multiplication": "/calculator/multiply",
+    "division": "/calculator/divide",
+}
+BATCH_OPERATIONS = ["sum", "sub", "mul", "div"]
+
+# ==================== HELPERS ====================
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def summarize(timings, elapsed=None):
+    """Latency summary in milliseconds"""
+    values = sorted(t * 1000 for t in timings)
+    summary = {
+        "n": len(values),
+        "mean_ms": sum(values) / len(values) if values else None,
+        "p50_ms": percentile(values, 0.50),
+        "p90_ms": percentile(values, 0.90),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": values[-1] if values else None,
+    }
+    if elapsed:
+        summary["throughput_rps"] = len(values) / elapsed
+    return summary
+
+def report_row(results, row):
+    """Keep a result and print it so long sweeps show progress"""
+    results.append(row)
+    if row["n"]:
+        latency = f"p50={row['p50_ms']:.2f}ms p99={row['p99_ms']:.2f}ms"
+    else:
+        latency = "no successful requests"
+    failures = "".join(f" {field}={row[field]}" for field in ("shed", "errors") if row.get(field))
+    print(
+        f"{row['suite']:<10} {row['endpoint']:<28} {json.dumps(row['params']):<70} {latency}{failures}",
+        flush=True,
+    )
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def make_operands(length, rng):
+    return [round(rng.uniform(1, 100), 3) for _ in range(length)]
+
+def make_batch(size, rng):
+    return [
+        {"operation": rng.choice(BATCH_OPERATIONS), "numbers": [rng.uniform(0, 1000), rng.uniform(1, 1000)]}
+        for _ in range(size)
+    ]
+
+# ==================== STORAGE ====================
+class SerializedCursor:
+    """Deferred find() whose query runs under the collection lock when iterated"""
+
+    def __init__(self, collection, args, kwargs):
+        self._collection = collection
+        self._args = args
+        self._kwargs = kwargs
+        self._calls = []
+
+    def sort(self, *args, **kwargs):
+        self._calls.append(("sort", args, kwargs))
+        return self
+
+    def limit(self, *args, **kwargs):
+        self._calls.append(("limit", args, kwargs))
+        return self
+
+    def __iter__(self):
+        with self._collection.lock:
+            cursor = self._collection.raw.find(*self._args, **self._kwargs)
+            for name, args, kwargs in self._calls:
+                cursor = getattr(cursor, name)(*args, **kwargs)
+            return iter(list(cursor))
+
+class MongomockCollection:
+    """Thread-safe wrapper around a mongomock collection.
+
+    mongomock is not safe for concurrent use, which the HTTP benchmark needs,
+    and its bulk_write rejects the `sort` argument pymongo 4.18 passes to
+    ReplaceOne; bulk requests are replayed one by one instead.
+    """
+
+    def __init__(self, collection):
+        self.raw = collection
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        method = getattr(self.raw, name)
+        if not callable(method):
+            return method
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                return method(*args, **kwargs)
+        return locked
+
+    def find(self, *args, **kwargs):
+        return SerializedCursor(self, args, kwargs)
+
+    def aggregate(self, pipeline):
+        with self.lock:
+            return iter(list(self.raw.aggregate(pipeline)))
+
+    def bulk_write(self, requests, ordered=True):
+        upserted = 0
+        with self.lock:
+            for request in requests:
+                if isinstance(request, ReplaceOne):
+                    result = self.raw.replace_one(request._filter, request._doc, upsert=request._upsert)
+                elif isinstance(request, UpdateOne):
+                    result = self.raw.update_one(request._filter, request._doc, upsert=request._upsert)
+                else:
+                    raise TypeError(f"Unsupported bulk request: {request!r}")
+                upserted += result.upserted_id is not None
+        return BulkWriteResult({"nUpserted": upserted}, True)
+
+class Storage:
+    """History storage used by the benchmark: one backend, installed as the app's repository.
+
+    mongo uses mongomock unless a mongo_url is given; sqlite files live in a
+    temporary directory; the memory ring buffer holds memory_max_documents.
+    """
+
+    def __init__(self, backend="mongo", mongo_url=None, memory_max_documents=100000):
+        self.backend = backend
+        self.mongomock = mongo_url is None
+        self.memory_max_documents = memory_max_documents
+        self.client = None
+        self.directory = None
+        if backend == "mongo":
+            self.client = mongomock.MongoClient() if self.mongomock else MongoClient(mongo_url)
+        elif backend == "sqlite":
+            self.directory = tempfile.mkdtemp(prefix="calculator-benchmark-")
+
+    @property
+    def label(self):
+        if self.backend == "mongo":
+            return "mongomock" if self.mongomock else "mongodb"
+        return self.backend
+
+    def fresh(self, name):
+        """An empty history installed as the app's storage"""
+        main.history_repository.close()
+        if self.backend == "memory":
+            main.history_repository = MemoryHistoryRepository(self.memory_max_documents)
+        elif self.backend == "sqlite":
+            path = os.path.join(self.directory, f"{name}.sqlite3")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            main.history_repository = SQLiteHistoryRepository(path)
+        else:
+            self.fresh_collections(name)
+            # Reads the module globals, so scripts can still swap the collection afterwards
+            main.history_repository = MongoHistoryRepository(
+                lambda: main.collection_historial,
+                lambda: main.async_collection_historial,
+                lambda: main.collection_rollups,
+            )
+        main.history_repository.prepare()
+        return main.history_repository
+
+    def fresh_collections(self, name):
+        """Empty collections installed as the app's history and rollups"""
+        database = self.client["calculator_benchmark"]
+        database[name].drop()
+        database[f"{name}_rollups"].drop()
+        collection = database[name]
+        rollups = database[f"{name}_rollups"]
+        if self.mongomock:
+            collection = MongomockCollection(collection)
+            rollups = MongomockCollection(rollups)
+        ensure_history_indexes(collection)
+        main.collection_historial = collection
+        main.async_collection_historial = None
+        main.collection_rollups = rollups
+        return collection
+
+    def close(self):
+        main.history_repository.close()
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def seed(self, repository, count, rng, chunk=10000):
+        """Insert count history documents spread over the last 30 days"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for offset in range(0, count, chunk):
+            documents = []
+            for _ in range(min(chunk, count - offset)):
+                numbers = make_operands(2, rng)
+                created_at = now - datetime.timedelta(seconds=rng.uniform(0, 30 * 86400))
+                documents.append(build_history_document(rng.choice(OPERATIONS), numbers, sum(numbers), created_at))
+            repository.append_many(documents)
+
+# ==================== IN-PROCESS BENCHMARKS ====================
+def time_calls(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+def bench_in_process(args, storage, rng, results):
+    loop = asyncio.new_event_loop()
+    run = loop.run_until_complete
+    storage.fresh("inprocess")
+
+    for operation in OPERATIONS:
+        for length in args.operand_lengths:
+            numbers = make_operands(length, rng)
+            timings = time_calls(lambda: run(main.run_calculation(operation, numbers)), args.repeat)
+            report_row(results, {"suite": "in_process", "endpoint": ENDPOINTS[operation], "params": {"backend": storage.label, "operands": length}, **summarize(timings)})
+
+    for size in args.batch_sizes:
+        batch = [main.BatchOperation(**item) for item in make_batch(size, rng)]
+        repeat = max(1, min(args.repeat, 200_000 // size))
+        # The endpoint parses its own body; this measures evaluation and the history hand-off
+        timings = time_calls(lambda: run(main.evaluate_batch_request(batch, None)), repeat)
+        report_row(results, {"suite": "in_process", "endpoint": "/calculator/batch", "params": {"backend": storage.label, "batch_size": size}, **summarize(timings)})
+    main.history_writer.flush()
+
+    history_params = dict(limit=50, cursor=None, operation=None, date_from=None, date_to=None,
+                          sort_by="date", order="desc", since=None, expand=False, accept_encoding=None,
+                          if_none_match=None)
+    for count in args.history_sizes:
+        repository = storage.fresh(f"history_{count}")
+        storage.seed(repository, count, rng)
+        for label, params in (
+            ("newest", {}),
+            ("by_result", {"sort_by": "result"}),
+            ("operation_filter", {"operation": "divide"}),
+        ):
+            call_params = dict(history_params, **params)
+            timings = time_calls(lambda: run(main.get_history(**call_params)), args.repeat)
+            report_row(results, {"suite": "in_process", "endpoint": "/calculator/history", "params": {"backend": storage.label, "history_size": count, "query": label}, **summarize(timings)})
+
+        stats_params = dict(bucket="day", operation=None, date_from=None, date_to=None, accept_encoding=None,
+                        if_none_match=None)
+        cold = time_calls(lambda: run(main.get_history_stats(**stats_params)), 1)
+        warm = time_calls(lambda: run(main.get_history_stats(**stats_params)), args.repeat)
+        report_row(results, {"suite": "in_process", "endpoint": "/calculator/history/stats", "params": {"backend": storage.label, "history_size": count, "rollups": "cold"}, **summarize(cold)})
+        report_row(results, {"suite": "in_process", "endpoint": "/calculator/history/stats", "params": {"backend": storage.label, "history_size": count, "rollups": "warm"}, **summarize(warm)})
+    loop.close()
+
+# ==================== HTTP BENCHMARKS ====================
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class LocalServer:
+    """uvicorn serving main.app on 127.0.0.1 in a background thread"""
+
+    def __init__(self):
+        self.port = free_port()
+        # The lifespan would open real Mongo clients; the benchmark injects its own
+        config = uvicorn.Config(main.app, host="127.0.0.1", port=self.port, lifespan="off", log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return f"http://127.0.0.1:{self.port}"
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join(10)
+
+async def load(base_url, make_request, total, concurrency):
+    """Send total requests with a fixed number of concurrent workers.
+
+    Only successful responses are timed; 503s from admission control are
+    counted as shed and any other non-2xx status as an error.
+    """
+    timings = []
+    shed = 0
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker(client):
+        nonlocal shed, errors
+        for _ in counter:
+            started = time.perf_counter()
+            response = await make_request(client)
+            elapsed = time.perf_counter() - started
+            if response.is_success:
+                timings.append(elapsed)
+            elif response.status_code == 503 and "retry-after" in response.headers:
+                shed += 1
+            else:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return timings, elapsed, shed, errors
+
+def write_cases(args, storage, rng):
+    """(endpoint, params, request factory) for the calculator and batch endpoints"""
+    cases = []
+    for operation in OPERATIONS:
+        for length in args.operand_lengths:
+            params = [("numbers", n) for n in make_operands(length, rng)]
+            cases.append((ENDPOINTS[operation], {"backend": storage.label, "operands": length},
+                          lambda c, p=params, o=operation: c.get(ENDPOINTS[o], params=p)))
+    for size in args.batch_sizes:
+        if size > args.http_max_batch:
+            continue
+        payload = make_batch(size, rng)
+        cases.append(("/calculator/batch", {"backend": storage.label, "batch_size": size},
+                      lambda c, p=payload: c.post("/calculator/batch", json=p)))
+    return cases
+
+def read_cases(args, storage):
+    params = {"backend": storage.label, "history_size": args.http_history_size}
+    return [
+        ("/calculator/history", params, lambda c: c.get("/calculator/history")),
+        ("/calculator/history/stats", params, lambda c: c.get("/calculator/history/stats")),
+    ]
+
+def bench_http(args, storage, rng, results):
+    with LocalServer() as base_url:
+        for concurrency in args.concurrency:
+            storage.fresh("http_writes")
+            cases = write_cases(args, storage, rng)
+            # Reads run against a freshly seeded collection so earlier writes do not skew them
+            cases.append(None)
+            cases.extend(read_cases(args, storage))
+
+            for case in cases:
+                if case is None:
+                    main.history_writer.flush()
+                    storage.seed(storage.fresh("http_reads"), args.http_history_size, rng)
+                    continue
+                endpoint, params, make_request = case
+                total = args.requests
+                if "batch_size" in params:
+                    total = max(concurrency, min(total, 200_000 // params["batch_size"]))
+                timings, elapsed, shed, errors = asyncio.run(load(base_url, make_request, total, concurrency))
+                report_row(results, {
+                    "suite": "http",
+                    "endpoint": endpoint,
+                    "params": dict(params, concurrency=concurrency),
+                    "shed": shed,
+                    "errors": errors,
+                    **summarize(timings, elapsed),
+                })
+    main.history_writer.flush()
+
+# ==================== MAIN ====================
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="bench-results.json")
+    parser.add_argument("--mongo-url", default=None, help="local Mongo instead of mongomock")
+    parser.add_argument("--backends", nargs="+", choices=HISTORY_BACKENDS, default=["mongo"],
+                        help="history storage backends to run the workload against")
+    parser.add_argument("--memory-max-documents", type=int, default=None,
+                        help="ring buffer size of the memory backend (default: the largest history seeded)")
+    parser.add_argument("--operand-lengths", type=int, nargs="+", default=[2, 10, 100, 1000])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 1000, 10000, 100000])
+    parser.add_argument("--history-sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--requests", type=int, default=500, help="HTTP requests per case")
+    parser.add_argument("--http-history-size", type=int, default=10000)
+    parser.add_argument("--http-max-batch", type=int, default=10000)
+    parser.add_argument("--skip-http", action="store_true")
+    parser.add_argument("--with-logs", action="store_true", help="keep INFO logging enabled")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--quick", action="store_true", help="small sweep for a smoke run")
+    args = parser.parse_args()
+    if args.quick:
+        args.operand_lengths = [2, 100]
+        args.batch_sizes = [1, 100, 10000]
+        args.history_sizes = [1000]
+        args.repeat = 5
+        args.concurrency = [8]
+        args.requests = 100
+        args.http_history_size = 1000
+    return args
+
+def main_cli():
+    args = parse_args()
+    if not args.with_logs:
+        logging.getLogger("custom_logger").setLevel(logging.WARNING)
+    memory_max_documents = args.memory_max_documents or max(args.history_sizes + [args.http_history_size])
+    results = []
+    storages = []
+
+    for backend in args.backends:
+        # Same seed for every backend, so each one gets the same workload
+        rng = random.Random(args.seed)
+        storage = Storage(backend, args.mongo_url, memory_max_documents)
+        storages.append(storage.label)
+        try:
+            bench_in_process(args, storage, rng, results)
+            if not args.skip_http:
+                bench_http(args, storage, rng, results)
+        finally:
+            storage.close()
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "storage": storages,
+        "admission_control": main.ADMISSION_CONTROL,
+        "config": {k: v for k, v in vars(args).items() if k not in ("mongo_url", "output")},
+        "results": results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+
+    print(f"results written to {args.output}")
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,91 @@
+# ==================== IMPORTS ====================
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+# ==================== STATES ====================
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+BREAKER_STATES = (CLOSED, HALF_OPEN, OPEN)
+
+# ==================== CIRCUIT BREAKER ====================
+class CircuitBreaker:
+    """Opens when too many recent calls fail or are slow.
+
+    While open every call is refused; after open_seconds a single probe call
+    is let through (half-open) and its outcome closes or reopens the breaker.
+    """
+
+    def __init__(
+        self,
+        failure_rate: float = 0.5,
+        window: int = 20,
+        min_calls: int = 5,
+        slow_seconds: float = 1.0,
+        open_seconds: float = 10.0,
+        on_state_change: Optional[Callable[[str], None]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self.on_state_change = on_state_change
+        self.clock = clock
+        self._outcomes = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and self.clock() - self._opened_at >= self.open_seconds:
+                self._set_state(HALF_OPEN)
+            return self._state
+
+    def allow(self) -> bool:
+        """Whether a call may go through now; in half-open only one probe at a time"""
+        state = self.state
+        with self._lock:
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok: bool, elapsed: float = 0.0):
+        """Outcome of an allowed call; a call slower than slow_seconds counts as a failure"""
+        failed = not ok or elapsed > self.slow_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probing = False
+                self._outcomes.clear()
+                if failed:
+                    self._open()
+                else:
+                    self._set_state(CLOSED)
+                return
+            self._outcomes.append(failed)
+            if (
+                self._state == CLOSED
+                and len(self._outcomes) >= self.min_calls
+                and sum(self._outcomes) / len(self._outcomes) >= self.failure_rate
+            ):
+                self._open()
+
+    def _open(self):
+        self._opened_at = self.clock()
+        self._outcomes.clear()
+        self._set_state(OPEN)
+
+    def _set_state(self, state: str):
+        if state == self._state:
+            return
+        self._state = state
+        if self.on_state_change is not None:
+            self.on_state_change(state)
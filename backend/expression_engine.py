@@ -0,0 +1,195 @@
+# ==================== IMPORTS ====================
+import ast
+import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from history_schema import build_history_document, build_history_error_document, canonical_operation
+
+EXPRESSION_OPERATION = "evaluate"
+
+class InvalidExpression(ValueError):
+    """An expression that does not parse, or uses something other than the calculator operations"""
+
+# ==================== PLAN ====================
+# Operand references: ("const", value), ("var", variable index) or ("step", step index)
+Ref = Tuple[str, object]
+
+class Step(NamedTuple):
+    operation: str
+    operands: Tuple[Ref, ...]
+
+class ExpressionPlan(NamedTuple):
+    """A compiled expression: operation steps in evaluation order; the last one is the result"""
+    expression: str
+    variables: Tuple[str, ...]
+    leaves: Tuple[Ref, ...]  # constants and variables in reading order, stored as the history numbers
+    steps: Tuple[Step, ...]
+
+# ==================== COMPILER ====================
+BINARY_OPERATIONS = {ast.Add: "sum", ast.Sub: "subtract", ast.Mult: "multiplication", ast.Div: "division"}
+FUNCTION_OPERATIONS = {"sum", "subtract", "multiplication", "division"}
+
+class _Compiler:
+    def __init__(self):
+        self.variables = []
+        self.leaves = []
+        self.steps = []
+
+    def ref(self, node) -> Ref:
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            ref = ("const", float(node.value))
+            self.leaves.append(ref)
+            return ref
+        if isinstance(node, ast.Name):
+            if node.id not in self.variables:
+                self.variables.append(node.id)
+            ref = ("var", self.variables.index(node.id))
+            self.leaves.append(ref)
+            return ref
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATIONS:
+            operation = BINARY_OPERATIONS[type(node.op)]
+            # a - b - c is one subtract of [a, b, c], like the calculator endpoints
+            operands = self.chain(node.left, operation) + [self.ref(node.right)]
+            return self.step(operation, operands)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            operation = canonical_operation(node.func.id)
+            if operation not in FUNCTION_OPERATIONS:
+                raise InvalidExpression(f"Unknown function: {node.func.id}")
+            if len(node.args) < 2:
+                raise InvalidExpression(f"At least 2 numbers are required: {node.func.id}()")
+            return self.step(operation, [self.ref(arg) for arg in node.args])
+        raise InvalidExpression(f"Unsupported syntax: {type(node).__name__}")
+
+    def chain(self, node, operation: str) -> List[Ref]:
+        """Operands of a left-nested chain of the same operation"""
+        if isinstance(node, ast.BinOp) and BINARY_OPERATIONS.get(type(node.op)) == operation:
+            return self.chain(node.left, operation) + [self.ref(node.right)]
+        return [self.ref(node)]
+
+    def step(self, operation: str, operands: List[Ref]) -> Ref:
+        self.steps.append(Step(operation, tuple(operands)))
+        return ("step", len(self.steps) - 1)
+
+def compile_expression(expression: str) -> ExpressionPlan:
+    """Parse an arithmetic expression into a plan without evaluating any Python.
+
+    Supported: numbers, variables, + - * / with parentheses, and the calls
+    sum(), subtract(), multiply() and divide() (any history alias works too).
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except (SyntaxError, ValueError, RecursionError) as e:
+        raise InvalidExpression(f"Invalid expression: {getattr(e, 'msg', str(e))}")
+    compiler = _Compiler()
+    try:
+        compiler.ref(tree.body)
+    except RecursionError:
+        raise InvalidExpression("Invalid expression: nested too deeply")
+    if not compiler.steps:
+        raise InvalidExpression("The expression must use at least one operation")
+    return ExpressionPlan(expression, tuple(compiler.variables), tuple(compiler.leaves), tuple(compiler.steps))
+
+# ==================== EVALUATION ====================
+STATUS_OK = 0
+STATUS_MISSING = 1
+STATUS_NEGATIVE = 2
+STATUS_DIVISION_BY_ZERO = 3
+
+# Same messages and status codes as the calculator endpoints
+ERRORS = {
+    STATUS_NEGATIVE: ("Negative numbers are not allowed", 400),
+    STATUS_DIVISION_BY_ZERO: ("Division by zero", 403),
+}
+
+UFUNCS = {"sum": np.add, "subtract": np.subtract, "multiplication": np.multiply, "division": np.divide}
+
+class RowOutcome(NamedTuple):
+    result: Optional[float]
+    error: Optional[Tuple[str, int]]  # (message, status_code)
+    operands: List[float]  # operands of the failing step, or the leaves on success
+
+def bind_columns(plan: ExpressionPlan, rows: List[Dict[str, float]]):
+    """One float64 column per variable and the rows that miss one of them"""
+    columns = np.zeros((len(plan.variables), len(rows)), dtype=np.float64)
+    missing = np.zeros(len(rows), dtype=bool)
+    for index, name in enumerate(plan.variables):
+        values = [row.get(name) for row in rows]
+        absent = np.fromiter((value is None for value in values), dtype=bool, count=len(rows))
+        columns[index] = [0.0 if value is None else value for value in values]
+        missing |= absent
+    return columns, missing
+
+def evaluate_plan(plan: ExpressionPlan, rows: List[Dict[str, float]]) -> List[RowOutcome]:
+    """Evaluate the plan over every row at once, one NumPy pass per step.
+
+    Every step applies the calculator's rules to its operands, intermediate
+    results included, so a row fails exactly where the equivalent chain of
+    endpoint calls would have failed.
+    """
+    count = len(rows)
+    columns, missing = bind_columns(plan, rows)
+    status = np.where(missing, STATUS_MISSING, STATUS_OK).astype(np.int8)
+    failed_step = np.full(count, -1, dtype=np.int32)
+    values = []
+
+    def resolve(ref: Ref):
+        kind, value = ref
+        if kind == "const":
+            return np.full(count, value)
+        return columns[value] if kind == "var" else values[value]
+
+    with np.errstate(all="ignore"):
+        for index, step in enumerate(plan.steps):
+            operands = [resolve(ref) for ref in step.operands]
+            pending = status == STATUS_OK
+            negative = pending & np.logical_or.reduce([operand < 0 for operand in operands])
+            status[negative] = STATUS_NEGATIVE
+            failed_step[negative] = index
+            pending &= ~negative
+            if step.operation == "division":
+                zero = pending & np.logical_or.reduce([operand == 0 for operand in operands[1:]])
+                status[zero] = STATUS_DIVISION_BY_ZERO
+                failed_step[zero] = index
+            ufunc = UFUNCS[step.operation]
+            result = operands[0]
+            for operand in operands[1:]:
+                result = ufunc(result, operand)
+            values.append(result)
+
+    def operand_rows(refs) -> List[List[float]]:
+        return np.stack([resolve(ref) for ref in refs], axis=1).tolist()
+
+    status_list = status.tolist()
+    results = values[-1].tolist()
+    leaves = operand_rows(plan.leaves)
+    step_operands = {}
+    outcomes = []
+    for row, code in enumerate(status_list):
+        if code == STATUS_OK:
+            outcomes.append(RowOutcome(results[row], None, leaves[row]))
+        elif code == STATUS_MISSING:
+            absent = [name for name in plan.variables if name not in rows[row]]
+            outcomes.append(RowOutcome(None, (f"Missing variable: {', '.join(absent)}", 400), []))
+        else:
+            index = int(failed_step[row])
+            if index not in step_operands:
+                step_operands[index] = operand_rows(plan.steps[index].operands)
+            outcomes.append(RowOutcome(None, ERRORS[code], step_operands[index][row]))
+    return outcomes
+
+def expression_history_documents(plan: ExpressionPlan, outcomes: List[RowOutcome],
+                                 created_at: datetime.datetime) -> List[dict]:
+    """One document per evaluated row; rows missing a variable were never evaluated"""
+    documents = []
+    for outcome in outcomes:
+        if outcome.error is None:
+            document = build_history_document(EXPRESSION_OPERATION, outcome.operands, outcome.result, created_at)
+        elif outcome.operands:
+            document = build_history_error_document(EXPRESSION_OPERATION, outcome.operands, outcome.error[0], created_at)
+        else:
+            continue
+        document["expression"] = plan.expression
+        documents.append(document)
+    return documents
@@ -0,0 +1,87 @@
+# ==================== IMPORTS ====================
+import gzip
+import hashlib
+from typing import Optional
+
+import orjson
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:  # Optional: without it only gzip is offered
+    brotli = None
+
+# ==================== ENCODING ====================
+def dumps(content) -> bytes:
+    """Serialize with orjson; NumPy scalars and arrays are written natively"""
+    return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+# ==================== COMPRESSION ====================
+def accepted_encodings(accept_encoding: Optional[str]) -> set:
+    """Codings the client accepts (q-value above zero) from an Accept-Encoding header"""
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding and quality > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Preferred content coding for a response: br, then gzip, else None"""
+    accepted = accepted_encodings(accept_encoding)
+    if brotli is not None and ("br" in accepted or "*" in accepted):
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+def compress(body: bytes, encoding: str, gzip_level: int = 5, brotli_quality: int = 4) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=gzip_level)
+
+# ==================== ETAGS ====================
+def body_etag(body: bytes) -> str:
+    """Weak validator of the uncompressed body, so it holds for every content coding"""
+    return 'W/"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # If-None-Match uses weak comparison
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in candidates or etag.removeprefix("W/") in candidates
+
+# ==================== RESPONSE ====================
+class FastJSONResponse(Response):
+    """JSON response encoded with orjson and compressed when the client accepts it.
+
+    With etag=True the response carries an ETag and answers 304 when it matches If-None-Match.
+    """
+
+    media_type = "application/json"
+
+    def __init__(self, content, status_code: int = 200, accept_encoding: Optional[str] = None,
+                 min_compress_bytes: int = 1024, gzip_level: int = 5, brotli_quality: int = 4,
+                 etag: bool = False, if_none_match: Optional[str] = None):
+        body = dumps(content)
+        headers = {"Vary": "Accept-Encoding"}
+        if etag:
+            headers["ETag"] = body_etag(body)
+            # Cached copies must be revalidated, which is what makes If-None-Match useful
+            headers["Cache-Control"] = "no-cache"
+            if etag_matches(if_none_match, headers["ETag"]):
+                super().__init__(status_code=304, headers=headers)
+                return
+        encoding = choose_encoding(accept_encoding) if len(body) >= min_compress_bytes else None
+        if encoding:
+            body = compress(body, encoding, gzip_level, brotli_quality)
+            headers["Content-Encoding"] = encoding
+        super().__init__(body, status_code=status_code, headers=headers)
@@ -0,0 +1,347 @@
+# ==================== IMPORTS ====================
+import datetime
+import fcntl
+import gzip
+import heapq
+import os
+import threading
+from typing import Callable, Iterator, List, Optional
+
+from bson import ObjectId, json_util
+from pymongo import ASCENDING, DESCENDING
+
+from history_query import (
+    HISTORY_PROJECTION,
+    OPERATION_ALIASES,
+    InvalidHistoryQuery,
+    build_sort,
+    decode_cursor,
+    to_utc,
+)
+from history_schema import STATUS_ERROR, utc_now
+from history_stats import BUCKET_SIZES, bucket_floor, closed_bucket_rows
+from logger_config import events
+from metrics import HISTORY_ARCHIVED_DOCUMENTS, HISTORY_ARCHIVE_ERRORS
+
+ARCHIVE_SUFFIX = ".jsonl.gz"
+DAY_FORMAT = "%Y-%m-%d"
+
+# ==================== RETENTION INDEX ====================
+def ensure_retention_index(collection, max_age: datetime.timedelta):
+    """TTL index for retention without an archive: Mongo deletes documents older than max_age.
+
+    A changed max_age is applied to the existing index with collMod: creating
+    it again with other options fails with IndexOptionsConflict.
+    """
+    seconds = int(max_age.total_seconds())
+    for index in collection.index_information().values():
+        if dict(index["key"]) == {"created_at": ASCENDING} and "expireAfterSeconds" in index:
+            if index["expireAfterSeconds"] != seconds:
+                collection.database.command({
+                    "collMod": collection.name,
+                    "index": {"keyPattern": {"created_at": ASCENDING}, "expireAfterSeconds": seconds},
+                })
+            return
+    collection.create_index([("created_at", ASCENDING)], expireAfterSeconds=seconds)
+
+# ==================== ARCHIVE FILES ====================
+def day_path(directory: str, day: datetime.date) -> str:
+    return os.path.join(directory, day.strftime(DAY_FORMAT) + ARCHIVE_SUFFIX)
+
+def archive_days(directory: str) -> List[datetime.date]:
+    """Days that have an archive file, oldest first"""
+    if not os.path.isdir(directory):
+        return []
+    days = []
+    for name in os.listdir(directory):
+        if name.endswith(ARCHIVE_SUFFIX):
+            try:
+                days.append(datetime.datetime.strptime(name[:-len(ARCHIVE_SUFFIX)], DAY_FORMAT).date())
+            except ValueError:
+                continue
+    return sorted(days)
+
+def append_day(directory: str, day: datetime.date, documents: List[dict]):
+    """Append documents as one gzip member and fsync; concatenated members read back as one file"""
+    lines = "".join(json_util.dumps(document) + "\n" for document in documents)
+    with open(day_path(directory, day), "ab") as archive:
+        archive.write(gzip.compress(lines.encode("utf-8")))
+        archive.flush()
+        os.fsync(archive.fileno())
+
+def read_day(directory: str, day: datetime.date) -> Iterator[dict]:
+    """Documents archived for one day in file order, one line at a time.
+
+    A document archived twice (crash before delete) is read twice.
+    """
+    with gzip.open(day_path(directory, day), "rt", encoding="utf-8") as archive:
+        for line in archive:
+            if line.strip():
+                yield json_util.loads(line)
+
+# json_util.dumps writes _id first, as an extended JSON ObjectId
+ID_PREFIX = '{"_id": {"$oid": "'
+
+def line_id(line: str) -> ObjectId:
+    if line.startswith(ID_PREFIX):
+        return ObjectId(line[len(ID_PREFIX):len(ID_PREFIX) + 24])
+    return json_util.loads(line)["_id"]
+
+def read_day_ordered(directory: str, day: datetime.date) -> Iterator[dict]:
+    """Documents archived for one day in _id order, each once, without loading the file.
+
+    Batches are archived oldest first, so a file is in _id order except for
+    documents appended after newer ones: a batch archived again after a
+    crash, or spool replays archived late. A first pass over the ids finds
+    those; only they are held in memory and merged into the second pass.
+    """
+    newest = None
+    late = {}
+    with gzip.open(day_path(directory, day), "rt", encoding="utf-8") as archive:
+        for line in archive:
+            if not line.strip():
+                continue
+            object_id = line_id(line)
+            if newest is None or object_id > newest:
+                newest = object_id
+            elif object_id not in late:
+                late[object_id] = json_util.loads(line)
+    pending = sorted(late.values(), key=lambda document: document["_id"])
+    position = 0
+    newest = None
+    for document in read_day(directory, day):
+        object_id = document["_id"]
+        if newest is not None and object_id <= newest:
+            continue  # late: merged from pending
+        newest = object_id
+        while position < len(pending) and pending[position]["_id"] <= object_id:
+            if pending[position]["_id"] < object_id:
+                yield pending[position]
+            position += 1
+        yield document
+    yield from pending[position:]
+
+# ==================== ARCHIVE READS ====================
+def result_sort_key(value):
+    # Mongo orders null before numbers
+    return (value is not None, value if value is not None else 0)
+
+def document_sort_key(sort_by: str):
+    if sort_by == "date":
+        return lambda document: document["_id"]
+    return lambda document: (result_sort_key(document.get("result")), document["_id"])
+
+def archive_filter(operation: Optional[str] = None,
+                   date_from: Optional[datetime.datetime] = None,
+                   date_to: Optional[datetime.datetime] = None) -> Callable[[dict], bool]:
+    """Predicate equivalent to build_history_filter for archived documents"""
+    aliases = None
+    if operation:
+        aliases = OPERATION_ALIASES.get(operation)
+        if aliases is None:
+            raise InvalidHistoryQuery(f"Unsupported operation filter: {operation}")
+    low = ObjectId.from_datetime(to_utc(date_from)) if date_from else None
+    high = ObjectId.from_datetime(to_utc(date_to)) if date_to else None
+
+    def matches(document):
+        if document.get("status") == STATUS_ERROR:
+            return False
+        if aliases and document.get("operation") not in aliases:
+            return False
+        return not ((low and document["_id"] < low) or (high and document["_id"] >= high))
+    return matches
+
+def archive_days_in_range(directory: str, date_from=None, date_to=None) -> List[datetime.date]:
+    """Archive days that can hold documents in [date_from, date_to), oldest first"""
+    first = to_utc(date_from).date() if date_from else None
+    last = to_utc(date_to).date() if date_to else None
+    return [day for day in archive_days(directory) if (not first or day >= first) and (not last or day <= last)]
+
+def iter_archived_documents(directory: str, operation: Optional[str] = None,
+                            date_from: Optional[datetime.datetime] = None,
+                            date_to: Optional[datetime.datetime] = None):
+    """Matching archived documents in _id order, streamed day by day"""
+    matches = archive_filter(operation, date_from, date_to)
+    for day in archive_days_in_range(directory, date_from, date_to):
+        yield from filter(matches, read_day_ordered(directory, day))
+
+def find_archived_documents(directory: str, limit: int, cursor: Optional[str] = None,
+                            operation: Optional[str] = None,
+                            date_from: Optional[datetime.datetime] = None,
+                            date_to: Optional[datetime.datetime] = None,
+                            sort_by: str = "date", order: str = "desc",
+                            max_result_days: int = 7) -> List[dict]:
+    """Up to limit + 1 archived documents matching the same filters, sort and cursor as the Mongo query.
+
+    Sorting by result has to read every day in range, so it covers at most
+    the newest max_result_days archived days; an explicit date_from reaching
+    further back is rejected.
+    """
+    build_sort(sort_by, order)  # validates sort_by and order
+    matches = archive_filter(operation, date_from, date_to)
+    key = document_sort_key(sort_by)
+    descending = order == "desc"
+    after = None
+    if cursor:
+        value, object_id = decode_cursor(cursor)
+        after = object_id if sort_by == "date" else (result_sort_key(value), object_id)
+
+    def after_cursor(document):
+        position = key(document)
+        return position < after if descending else position > after
+
+    days = archive_days_in_range(directory, date_from, date_to)
+    if sort_by == "date" and after is not None:
+        # Documents are archived by the day of their _id: days past the cursor hold nothing for this page
+        cursor_day = after.generation_time.date()
+        days = [day for day in days if (day <= cursor_day if descending else day >= cursor_day)]
+    elif sort_by != "date" and len(days) > max_result_days:
+        if date_from is not None:
+            raise InvalidHistoryQuery(
+                f"Sorting archived history by result covers at most {max_result_days} days: use a later date_from"
+            )
+        days = days[-max_result_days:]
+    if descending:
+        days.reverse()
+
+    wanted = limit + 1
+    projection = set(HISTORY_PROJECTION) | {"_id"}
+    found = {}
+    for day in days:
+        for document in read_day(directory, day):
+            if matches(document) and (after is None or after_cursor(document)):
+                # Keyed by _id: a document archived twice is returned once
+                found[document["_id"]] = {field: value for field, value in document.items() if field in projection}
+        if sort_by == "date" and len(found) >= wanted:
+            # Days are disjoint _id ranges, so later days cannot come before these
+            break
+    select = heapq.nlargest if descending else heapq.nsmallest
+    return select(wanted, found.values(), key=key)
+
+def archive_overlaps(directory: str, date_from: Optional[datetime.datetime]) -> bool:
+    """True if the archive can hold documents at or after date_from"""
+    days = archive_days(directory)
+    if not days:
+        return False
+    return date_from is None or to_utc(date_from).date() <= days[-1]
+
+def merge_documents(hot: List[dict], archived: List[dict], limit: int, sort_by: str, order: str) -> List[dict]:
+    """Merge two sorted document lists into the first limit + 1 of the combined order"""
+    select = heapq.nlargest if order == "desc" else heapq.nsmallest
+    return select(limit + 1, hot + archived, key=document_sort_key(sort_by))
+
+# ==================== ARCHIVER ====================
+class HistoryArchiver:
+    """Background thread that moves history beyond the hot window into day-partitioned JSONL.gz files"""
+
+    def __init__(
+        self,
+        collection_getter: Callable,
+        rollups_getter: Callable,
+        directory: str,
+        max_age: Optional[datetime.timedelta] = None,
+        max_documents: Optional[int] = None,
+        batch_size: int = 5000,
+        interval: float = 300,
+        rollup_grace: float = 300,
+    ):
+        self.collection_getter = collection_getter
+        self.rollups_getter = rollups_getter
+        self.directory = directory
+        self.max_age = max_age
+        self.max_documents = max_documents
+        self.batch_size = batch_size
+        self.interval = interval
+        self.rollup_grace = rollup_grace
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and (self.max_age is not None or self.max_documents is not None)
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="history-archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.archive_once()
+            except Exception as e:
+                HISTORY_ARCHIVE_ERRORS.inc()
+                events.error("history archive error", error=e)
+            self._stop_event.wait(self.interval)
+
+    # ---------- archiving ----------
+    def cutoff(self, collection, now: Optional[datetime.datetime] = None) -> Optional[ObjectId]:
+        """Documents with an _id below this leave the hot window"""
+        bounds = []
+        if self.max_age is not None:
+            bounds.append(ObjectId.from_datetime((now or utc_now()) - self.max_age))
+        if self.max_documents is not None:
+            # The oldest document that still fits in the window
+            oldest_kept = list(
+                collection.find({}, {"_id": 1}).sort("_id", DESCENDING).skip(self.max_documents - 1).limit(1)
+            )
+            if oldest_kept:
+                bounds.append(oldest_kept[0]["_id"])
+        return max(bounds) if bounds else None
+
+    def archive_once(self, now: Optional[datetime.datetime] = None) -> int:
+        """Archive everything below the cutoff in _id order; returns how many documents moved"""
+        collection = self.collection_getter()
+        if collection is None:
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+        # Several workers may run an archiver; only one works on the files at a time
+        with open(os.path.join(self.directory, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            cutoff = self.cutoff(collection, now)
+            if cutoff is None:
+                return 0
+            moved = 0
+            while not self._stop_event.is_set():
+                batch = list(collection.find({"_id": {"$lt": cutoff}}).sort("_id", ASCENDING).limit(self.batch_size))
+                if not batch:
+                    break
+                self._freeze_rollups(collection, batch[0]["_id"], batch[-1]["_id"], now)
+                by_day = {}
+                for document in batch:
+                    by_day.setdefault(document["_id"].generation_time.date(), []).append(document)
+                for day, documents in by_day.items():
+                    append_day(self.directory, day, documents)
+                # Deleted only once the files are on disk
+                collection.delete_many({"_id": {"$in": [document["_id"] for document in batch]}})
+                moved += len(batch)
+                HISTORY_ARCHIVED_DOCUMENTS.inc(len(batch))
+            if moved:
+                events.info("history archived", documents=moved, cutoff=cutoff.generation_time)
+            return moved
+
+    def _freeze_rollups(self, collection, first_id: ObjectId, last_id: ObjectId, now=None):
+        """Store rollups for the closed buckets being archived so statistics keep counting them"""
+        rollups = self.rollups_getter()
+        if rollups is None:
+            return
+        closed = (now or utc_now()) - datetime.timedelta(seconds=self.rollup_grace)
+        for bucket in BUCKET_SIZES:
+            start = bucket_floor(first_id.generation_time, bucket)
+            end = min(bucket_floor(last_id.generation_time, bucket) + BUCKET_SIZES[bucket], bucket_floor(closed, bucket))
+            if start < end:
+                closed_bucket_rows(collection, rollups, bucket, start, end)
@@ -0,0 +1,144 @@
+# ==================== IMPORTS ====================
+import hashlib
+from typing import Callable, List, Optional
+
+import orjson
+import pytz
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from history_query import HISTORY_PROJECTION, encode_cursor, encode_expanded_cursor
+from history_schema import STATUS_ERROR
+from history_spool import DUPLICATE_KEY
+from metrics import HISTORY_COMPACTION_ENTRIES, HISTORY_COMPACTION_OPERATIONS
+
+# ==================== KEYS ====================
+# Fields that make two operations the same entry; _id and created_at differ on every call
+CONTENT_FIELDS = ("operation", "numbers", "result", "status", "error", "operands", "expression")
+# Written by the upsert itself, never part of the inserted document
+COUNTER_FIELDS = ("key", "count", "last_seen", "updated_id")
+
+def content_hash(document: dict) -> str:
+    content = [document.get(field) for field in CONTENT_FIELDS]
+    data = orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def compaction_key(document: dict, window: float) -> str:
+    """Content hash plus the time window the operation falls in"""
+    created_at = document["created_at"]
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=pytz.UTC)
+    return f"{int(created_at.timestamp() // window)}:{content_hash(document)}"
+
+def ensure_compaction_index(collection):
+    # Sparse: documents written before compaction was enabled have no key
+    collection.create_index([("key", ASCENDING)], unique=True, sparse=True)
+    # Sync tokens and deltas of compacted history follow the newest operation merged into each entry
+    collection.create_index([("updated_id", DESCENDING)], sparse=True)
+
+# ==================== COMPACTION ====================
+def compact_documents(documents: List[dict], window: float) -> List[dict]:
+    """Merge identical operations of a batch: one entry per key with its count and last-seen time.
+
+    The first document of each key keeps its _id and created_at, which stay
+    the entry's position in history (date filters, cursors). updated_id is
+    the newest _id merged in, what sync tokens follow.
+    """
+    entries = {}
+    for document in documents:
+        key = compaction_key(document, window)
+        entry = entries.get(key)
+        if entry is None:
+            entries[key] = dict(document, key=key, count=1, last_seen=document["created_at"],
+                                updated_id=document["_id"])
+        else:
+            entry["count"] += 1
+            entry["last_seen"] = max(entry["last_seen"], document["created_at"])
+            entry["updated_id"] = max(entry["updated_id"], document["_id"])
+    return list(entries.values())
+
+def upsert_request(entry: dict) -> UpdateOne:
+    inserted = {field: value for field, value in entry.items() if field not in COUNTER_FIELDS}
+    return UpdateOne(
+        {"key": entry["key"]},
+        {"$setOnInsert": inserted, "$inc": {"count": entry["count"]}, "$max": {"last_seen": entry["last_seen"], "updated_id": entry["updated_id"]}},
+        upsert=True,
+    )
+
+class CompactingCollection:
+    """History sink that stores identical operations of a time window as one counted entry.
+
+    Takes the place of the collection for the history writer: insert_many
+    merges the batch in memory, then sends one bulk of upserts. Counts are
+    at-least-once: a batch retried after a partial write (spool replay) is
+    counted again instead of being skipped by _id. on_stored(collection, keys)
+    runs after the upserts with the keys of the entries they touched.
+    """
+
+    def __init__(self, collection, window: float = 60, on_stored: Optional[Callable] = None):
+        self.collection = collection
+        self.window = window
+        self.on_stored = on_stored
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def insert_many(self, documents: List[dict], ordered: bool = False):
+        entries = compact_documents(documents, self.window)
+        requests = [upsert_request(entry) for entry in entries]
+        try:
+            result = self.collection.bulk_write(requests, ordered=False)
+            inserted = result.upserted_count
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if e.details.get("writeConcernErrors") or any(error["code"] != DUPLICATE_KEY for error in errors):
+                raise
+            # Another worker inserted the same new entry first: this one is now an update
+            self.collection.bulk_write([requests[error["index"]] for error in errors], ordered=False)
+            inserted = e.details.get("nUpserted", 0)
+        HISTORY_COMPACTION_OPERATIONS.inc(len(documents))
+        HISTORY_COMPACTION_ENTRIES.inc(inserted)
+        if self.on_stored is not None:
+            self.on_stored(self.collection, [entry["key"] for entry in entries])
+
+def stored_entries(collection, keys: List[str]) -> List[dict]:
+    """Entries as stored after their upsert (first _id, summed count), projected like a history page"""
+    return list(collection.find({"key": {"$in": keys}, "status": {"$ne": STATUS_ERROR}}, HISTORY_PROJECTION))
+
+# ==================== READ PATH ====================
+def expand_page(rows: List[dict], keys: List[dict], limit: int, skip: int, after: Optional[str],
+                more: bool, sort_by: str):
+    """Up to limit rows of history with each compacted entry repeated count times, and the next cursor.
+
+    rows are the history rows of one page starting after the plain cursor
+    `after`, keys their stored _id and result. A page that ends inside an
+    entry continues from an expanded cursor skipping the copies already
+    returned. Each copy's id is `<entry id>:<copy>`, entry_id the stored id.
+    """
+    page = []
+    for index, (row, key) in enumerate(zip(rows, keys)):
+        count = row.pop("count", 1)
+        row.pop("last_seen", None)
+        entry_id = row["id"]
+        first = min(skip, count) if index == 0 else 0
+        take = min(count - first, limit - len(page))
+        page.extend(dict(row, id=f"{entry_id}:{copy}", entry_id=entry_id) for copy in range(first, first + take))
+        if first + take < count:
+            return page, encode_expanded_cursor(after, first + take)
+        after = encode_cursor(key, sort_by)
+        if len(page) == limit:
+            return page, after if index < len(rows) - 1 or more else None
+    return page, None
+
+def compaction_summary(collection) -> dict:
+    """Operations recorded, entries stored and their ratio over a whole collection"""
+    totals = list(collection.aggregate([
+        {"$group": {"_id": None, "entries": {"$sum": 1}, "operations": {"$sum": {"$ifNull": ["$count", 1]}}}},
+    ]))
+    entries = totals[0]["entries"] if totals else 0
+    operations = totals[0]["operations"] if totals else 0
+    return {
+        "operations": operations,
+        "entries": entries,
+        "ratio": operations / entries if entries else 1.0,
+    }
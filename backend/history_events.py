@@ -0,0 +1,76 @@
+# ==================== IMPORTS ====================
+import asyncio
+from collections import deque
+from typing import List, Optional
+
+import fast_response
+
+SSE_MEDIA_TYPE = "text/event-stream"
+
+# ==================== SERVER-SENT EVENTS ====================
+def sse_event(event: str, data) -> bytes:
+    """One Server-Sent Event with a JSON payload"""
+    return b"event: " + event.encode() + b"\ndata: " + fast_response.dumps(data) + b"\n\n"
+
+SSE_KEEPALIVE = b": keep-alive\n\n"
+
+# ==================== BROADCASTER ====================
+class HistoryBroadcaster:
+    """Fan-out of new history rows to the event streams open on this worker.
+
+    Lives on the event loop: publish and the subscriber queues are only used from it.
+    """
+
+    def __init__(self, max_pending: int = 100):
+        self.max_pending = max_pending
+        self._subscribers = set()
+
+    def subscribe(self) -> asyncio.Queue:
+        subscription = asyncio.Queue(maxsize=self.max_pending)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: asyncio.Queue):
+        self._subscribers.discard(subscription)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, rows: List[dict]):
+        for subscription in self._subscribers:
+            try:
+                subscription.put_nowait(rows)
+            except asyncio.QueueFull:
+                # A stalled client misses live rows; its next poll catches up from Mongo
+                pass
+
+class RecentIds:
+    """Bounded set of the history ids an event stream has already sent.
+
+    Ids are kept with the entry's count, so a compacted entry whose count
+    went up is sent again.
+    """
+
+    def __init__(self, size: int = 1000):
+        self._order = deque()
+        self._ids = set()
+        self.size = size
+
+    def __contains__(self, row_key) -> bool:
+        return row_key in self._ids
+
+    def add(self, row_key):
+        if row_key in self._ids:
+            return
+        self._ids.add(row_key)
+        self._order.append(row_key)
+        if len(self._order) > self.size:
+            self._ids.discard(self._order.popleft())
+
+    def unseen(self, rows: List[dict]) -> List[dict]:
+        """Rows not sent yet (or whose count changed), recording them as sent"""
+        fresh = [row for row in rows if (row.get("id"), row.get("count")) not in self]
+        for row in fresh:
+            self.add((row["id"], row.get("count")))
+        return fresh
@@ -0,0 +1,178 @@
+# ==================== IMPORTS ====================
+import csv
+import datetime
+import importlib.util
+import io
+import zlib
+from typing import Iterable, Iterator, List, Optional
+
+import pytz
+from pymongo import ASCENDING
+
+import fast_response
+from history_archive import iter_archived_documents
+from history_query import HISTORY_PROJECTION, InvalidHistoryQuery, build_history_filter
+from history_schema import SCHEMA_VERSION, migrate_document
+
+# Optional: without pyarrow only CSV and JSONL are offered. It is imported on
+# the first Parquet export, since importing it is slow and most processes never need it
+PARQUET_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+EXPORT_COLUMNS = ["id", "created_at", "operation", "numbers", "result", "expression"]
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+GZIP_MEDIA_TYPE = "application/gzip"
+
+# ==================== RECORDS ====================
+def export_record(document: dict) -> dict:
+    """Flat export row; legacy documents are normalized like the migration does"""
+    if document.get("schema_version") != SCHEMA_VERSION:
+        document = migrate_document(document)
+    created_at = document["created_at"]
+    if created_at.tzinfo is None:
+        created_at = pytz.UTC.localize(created_at)
+    return {
+        "id": str(document["_id"]),
+        "created_at": created_at,
+        "operation": document["operation"],
+        "numbers": document["numbers"],
+        "result": document["result"],
+        # Only evaluate entries have one
+        "expression": document.get("expression"),
+    }
+
+def export_documents(collection, archive_dir: Optional[str] = None, operation: Optional[str] = None,
+                     date_from: Optional[datetime.datetime] = None,
+                     date_to: Optional[datetime.datetime] = None,
+                     batch_size: int = 1000) -> Iterator[dict]:
+    """Matching documents oldest first: the archive, then the hot window through a batched cursor"""
+    # Built here so an invalid filter fails before the response starts
+    query = build_history_filter(operation, date_from, date_to)
+
+    def documents():
+        hot_query = query
+        last_archived = None
+        if archive_dir:
+            for document in iter_archived_documents(archive_dir, operation, date_from, date_to):
+                last_archived = document["_id"]
+                yield document
+        if last_archived is not None:
+            # A batch archived but not yet deleted is still in Mongo
+            hot_query = {"$and": [query, {"_id": {"$gt": last_archived}}]}
+        yield from collection.find(hot_query, HISTORY_PROJECTION).sort("_id", ASCENDING).batch_size(batch_size)
+    return documents()
+
+def chunked(records: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# ==================== ENCODERS ====================
+def encode_csv(chunks: Iterable[List[dict]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for chunk in chunks:
+        for record in chunk:
+            writer.writerow([
+                record["id"],
+                record["created_at"].isoformat(),
+                record["operation"],
+                fast_response.dumps(record["numbers"]).decode(),
+                record["result"],
+                record["expression"],
+            ])
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+
+def encode_jsonl(chunks: Iterable[List[dict]]) -> Iterator[bytes]:
+    for chunk in chunks:
+        # orjson writes aware datetimes as RFC 3339
+        yield b"".join(fast_response.dumps(record) + b"\n" for record in chunk)
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands out what has been written since the last take()"""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+def parquet_schema(pa):
+    return pa.schema([
+        ("id", pa.string()),
+        ("created_at", pa.timestamp("us", tz="UTC")),
+        ("operation", pa.string()),
+        ("numbers", pa.list_(pa.float64())),
+        ("result", pa.float64()),
+        ("expression", pa.string()),
+    ])
+
+def encode_parquet(chunks: Iterable[List[dict]]) -> Iterator[bytes]:
+    """One row group per chunk; the footer is sent last"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema(pa)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+ENCODERS = {"csv": encode_csv, "jsonl": encode_jsonl, "parquet": encode_parquet}
+
+def gzip_stream(parts: Iterable[bytes], level: int = 5) -> Iterator[bytes]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for part in parts:
+        data = compressor.compress(part)
+        if data:
+            yield data
+    yield compressor.flush()
+
+# ==================== EXPORT ====================
+def check_export_format(export_format: str, compression: Optional[str]):
+    if export_format not in ENCODERS:
+        raise InvalidHistoryQuery(f"Unsupported export format: {export_format}")
+    if export_format == "parquet" and not PARQUET_AVAILABLE:
+        raise InvalidHistoryQuery("Parquet export requires pyarrow")
+    if compression not in (None, "gzip"):
+        raise InvalidHistoryQuery(f"Unsupported compression: {compression}")
+
+def export_history(documents: Iterable[dict], export_format: str, compression: Optional[str] = None,
+                   chunk_size: int = 1000, gzip_level: int = 5) -> Iterator[bytes]:
+    """Encode documents in fixed-size chunks so memory does not grow with the export"""
+    # A compacted entry is exported once per operation it stands for
+    records = (export_record(document) for document in documents for _ in range(document.get("count", 1)))
+    parts = ENCODERS[export_format](chunked(records, chunk_size))
+    if compression == "gzip":
+        parts = gzip_stream(parts, gzip_level)
+    return parts
@@ -0,0 +1,245 @@
+# ==================== IMPORTS ====================
+import base64
+import datetime
+import json
+from typing import Optional
+
+import pytz
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, DESCENDING
+
+from history_schema import MEXICO_TZ, STATUS_ERROR
+
+# ==================== CONSTANTS ====================
+# Names each operation has been stored under (endpoints, batch, legacy data)
+OPERATION_ALIASES = {
+    "sum": ["sum", "suma"],
+    "subtract": ["subtract", "substract", "sub", "resta"],
+    "multiply": ["multiply", "multiplication", "mul", "multiplicacion"],
+    "divide": ["divide", "division", "div"],
+    "evaluate": ["evaluate"],
+}
+
+SORT_FIELDS = ("date", "result")
+SORT_ORDERS = ("asc", "desc")
+
+# Only the fields the history response needs (legacy names included)
+HISTORY_PROJECTION = {
+    "numbers": 1,
+    "numeros": 1,
+    "a": 1,
+    "b": 1,
+    "result": 1,
+    "resultado": 1,
+    "operation": 1,
+    "operacion": 1,
+    "date": 1,
+    "created_at": 1,
+    "schema_version": 1,
+    "operands": 1,
+    # Evaluate entries: the expression the operands were bound to
+    "expression": 1,
+    # Compacted entries
+    "count": 1,
+    "last_seen": 1,
+    "updated_id": 1,
+}
+
+# Indexes backing every filter/sort combination of the history endpoint.
+# Date filters and date sorting use the _id index (ObjectIds embed the insert time).
+HISTORY_INDEXES = [
+    [("operation", ASCENDING), ("_id", DESCENDING)],
+    [("result", DESCENDING), ("_id", DESCENDING)],
+    [("operation", ASCENDING), ("result", DESCENDING), ("_id", DESCENDING)],
+    # Covers the statistics aggregation (match on created_at, group on the rest)
+    [("created_at", ASCENDING), ("operation", ASCENDING), ("status", ASCENDING), ("result", ASCENDING)],
+]
+
+class InvalidHistoryQuery(ValueError):
+    """Raised when history query parameters cannot be used"""
+
+# ==================== INDEXES ====================
+def ensure_history_indexes(collection):
+    """Create the indexes used by the history endpoint (idempotent)"""
+    for keys in HISTORY_INDEXES:
+        collection.create_index(keys)
+
+# ==================== CURSORS ====================
+def encode_cursor(document: dict, sort_by: str) -> str:
+    """Encode the sort key of the last returned document as an opaque cursor"""
+    value = document.get("result") if sort_by == "result" else None
+    raw = json.dumps([value, str(document["_id"])]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    """Decode a cursor produced by encode_cursor"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value, object_id = json.loads(base64.urlsafe_b64decode(padded))
+        return value, ObjectId(object_id)
+    except (ValueError, TypeError, InvalidId):
+        raise InvalidHistoryQuery("Invalid cursor")
+
+def encode_expanded_cursor(after: Optional[str], skip: int) -> str:
+    """Cursor in the middle of an expanded entry: skip its first copies, after the plain cursor (None = first page)"""
+    raw = json.dumps({"after": after, "skip": skip}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_expanded_cursor(cursor: str):
+    """Plain cursor and copies to skip; a plain cursor skips none"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        decoded = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise InvalidHistoryQuery("Invalid cursor")
+    if not isinstance(decoded, dict):
+        decode_cursor(cursor)  # validates it
+        return cursor, 0
+    after, skip = decoded.get("after"), decoded.get("skip")
+    if not isinstance(skip, int) or skip < 1 or not (after is None or isinstance(after, str)):
+        raise InvalidHistoryQuery("Invalid cursor")
+    if after is not None:
+        decode_cursor(after)
+    return after, skip
+
+# ==================== SYNC TOKENS ====================
+# A sync token is the _id of the newest history entry a client has seen
+def decode_sync_token(token: str) -> ObjectId:
+    try:
+        return ObjectId(token)
+    except (InvalidId, TypeError):
+        raise InvalidHistoryQuery("Invalid sync token")
+
+def since_bound(token: str, lag: float) -> ObjectId:
+    """Lower _id bound for the entries after a sync token.
+
+    Workers flush their queued documents independently, so an entry can be
+    committed after a newer _id; the bound reaches back lag seconds and
+    clients drop the entries they already have by id.
+    """
+    object_id = decode_sync_token(token)
+    return ObjectId.from_datetime(object_id.generation_time - datetime.timedelta(seconds=lag))
+
+def find_newest_id(collection, field: str = "_id", **filters) -> Optional[ObjectId]:
+    """Newest value of field (_id, or a compacted entry's updated_id) matching the filters, through its index"""
+    document = collection.find_one(build_history_filter(**filters), {field: 1}, sort=[(field, DESCENDING)])
+    return document.get(field) if document else None
+
+async def find_newest_id_async(collection, field: str = "_id", **filters) -> Optional[ObjectId]:
+    document = await collection.find_one(build_history_filter(**filters), {field: 1}, sort=[(field, DESCENDING)])
+    return document.get(field) if document else None
+
+# ==================== QUERY BUILDING ====================
+def to_utc(value: datetime.datetime) -> datetime.datetime:
+    """Naive datetimes are interpreted in Mexico City time, like the stored dates"""
+    if value.tzinfo is None:
+        value = MEXICO_TZ.localize(value)
+    return value.astimezone(pytz.UTC)
+
+def build_history_filter(
+    operation: Optional[str] = None,
+    date_from: Optional[datetime.datetime] = None,
+    date_to: Optional[datetime.datetime] = None,
+    since: Optional[ObjectId] = None,
+    since_field: str = "_id",
+) -> dict:
+    """Build the Mongo filter for the operation and date range parameters"""
+    # Failed operations are kept for statistics only
+    clauses = [{"status": {"$ne": STATUS_ERROR}}]
+    if operation:
+        aliases = OPERATION_ALIASES.get(operation)
+        if aliases is None:
+            raise InvalidHistoryQuery(f"Unsupported operation filter: {operation}")
+        clauses.append({"operation": {"$in": aliases}})
+    id_range = {}
+    if date_from is not None:
+        id_range["$gte"] = ObjectId.from_datetime(to_utc(date_from))
+    if date_to is not None:
+        # date_to is exclusive
+        id_range["$lt"] = ObjectId.from_datetime(to_utc(date_to))
+    if since is not None and since_field == "updated_id":
+        # Compacted entries: a repeat bumps updated_id, so the delta also returns older entries whose count changed
+        clauses.append({"$or": [
+            {"updated_id": {"$gte": since}},
+            {"updated_id": {"$exists": False}, "_id": {"$gte": since}},
+        ]})
+    elif since is not None:
+        id_range["$gte"] = max(id_range.get("$gte", since), since)
+    if id_range:
+        clauses.append({"_id": id_range})
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def build_cursor_filter(cursor: str, sort_by: str, order: str) -> dict:
+    """Keyset condition that continues strictly after the cursor position"""
+    value, object_id = decode_cursor(cursor)
+    compare = "$lt" if order == "desc" else "$gt"
+    if sort_by == "date":
+        return {"_id": {compare: object_id}}
+    return {
+        "$or": [
+            {"result": {compare: value}},
+            {"result": value, "_id": {compare: object_id}},
+        ]
+    }
+
+def build_sort(sort_by: str, order: str):
+    """Sort specification matching the keyset cursor"""
+    if sort_by not in SORT_FIELDS:
+        raise InvalidHistoryQuery(f"Unsupported sort field: {sort_by}")
+    if order not in SORT_ORDERS:
+        raise InvalidHistoryQuery(f"Unsupported sort order: {order}")
+    direction = DESCENDING if order == "desc" else ASCENDING
+    if sort_by == "date":
+        return [("_id", direction)]
+    return [("result", direction), ("_id", direction)]
+
+def build_history_query(
+    cursor: Optional[str] = None,
+    operation: Optional[str] = None,
+    date_from: Optional[datetime.datetime] = None,
+    date_to: Optional[datetime.datetime] = None,
+    sort_by: str = "date",
+    order: str = "desc",
+    since: Optional[ObjectId] = None,
+    since_field: str = "_id",
+):
+    """Mongo filter and sort for one history page"""
+    sort = build_sort(sort_by, order)
+    query = build_history_filter(operation, date_from, date_to, since, since_field)
+    if cursor:
+        cursor_filter = build_cursor_filter(cursor, sort_by, order)
+        query = {"$and": [query, cursor_filter]} if query else cursor_filter
+    return query, sort
+
+def split_page(documents: list, limit: int, sort_by: str):
+    """Trim the look-ahead document and compute the next cursor"""
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(documents[-1], sort_by)
+    return documents, next_cursor
+
+def find_history_documents(collection, limit: int, sort_by: str = "date", **params) -> list:
+    """Fetch up to limit + 1 raw history documents with a blocking driver"""
+    query, sort = build_history_query(sort_by=sort_by, **params)
+    # One extra document tells us whether another page exists
+    return list(
+        collection.find(query, HISTORY_PROJECTION).sort(sort).limit(limit + 1)
+    )
+
+async def find_history_documents_async(collection, limit: int, sort_by: str = "date", **params) -> list:
+    """Fetch up to limit + 1 raw history documents with the async driver"""
+    query, sort = build_history_query(sort_by=sort_by, **params)
+    cursor = collection.find(query, HISTORY_PROJECTION).sort(sort).limit(limit + 1)
+    return await cursor.to_list(limit + 1)
+
+def find_history_page(collection, limit: int, sort_by: str = "date", **params):
+    """Fetch one page of raw history documents with a blocking driver"""
+    documents = find_history_documents(collection, limit, sort_by=sort_by, **params)
+    return split_page(documents, limit, sort_by)
+
+async def find_history_page_async(collection, limit: int, sort_by: str = "date", **params):
+    """Fetch one page of raw history documents with the async driver"""
+    documents = await find_history_documents_async(collection, limit, sort_by=sort_by, **params)
+    return split_page(documents, limit, sort_by)
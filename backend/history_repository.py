@@ -0,0 +1,588 @@
+# ==================== IMPORTS ====================
+import bisect
+import datetime
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Callable, Iterator, List, Optional
+
+import orjson
+import pytz
+from bson import ObjectId
+from fastapi.concurrency import run_in_threadpool
+
+from history_archive import (
+    archive_filter,
+    archive_overlaps,
+    document_sort_key,
+    find_archived_documents,
+    merge_documents,
+    result_sort_key,
+)
+from history_compaction import CompactingCollection, ensure_compaction_index
+from history_export import export_documents
+from history_query import (
+    HISTORY_PROJECTION,
+    OPERATION_ALIASES,
+    InvalidHistoryQuery,
+    build_sort,
+    decode_cursor,
+    ensure_history_indexes,
+    find_history_documents,
+    find_history_documents_async,
+    find_newest_id,
+    find_newest_id_async,
+    to_utc,
+)
+from history_schema import STATUS_ERROR, STATUS_OK, utc_now
+from history_stats import (
+    BUCKET_SIZES,
+    aggregate_rows,
+    as_utc,
+    document_rows,
+    earliest_start,
+    filter_operation,
+    fold_into_rollups,
+    history_stats,
+    stats_window,
+    summarize,
+)
+
+HISTORY_BACKENDS = ("mongo", "memory", "sqlite")
+
+# Fields of a history page document; history_row may then change the copy in place
+PROJECTED_FIELDS = frozenset(HISTORY_PROJECTION) | {"_id"}
+
+def project(document: dict) -> dict:
+    return {field: value for field, value in document.items() if field in PROJECTED_FIELDS}
+
+# ==================== INTERFACE ====================
+class HistoryRepository(ABC):
+    """Where history documents are stored and queried.
+
+    Documents keep the history_schema format and their ObjectId _id on every
+    backend, so cursors, sync tokens and date filters mean the same everywhere.
+    Page and sync-token reads are async (request path); stats and exports are
+    blocking and run in the threadpool. A backend missing an abstract method
+    fails when it is constructed, not on the first request that needs it.
+    """
+
+    name = "base"
+
+    # ---------- writes ----------
+    def append(self, document: dict):
+        self.append_many([document])
+
+    @abstractmethod
+    def append_many(self, documents: List[dict]):
+        """Store documents; ones already stored (same _id) are skipped"""
+
+    def insert_many(self, documents: List[dict], ordered: bool = False):
+        """Collection-style bulk append: what HistoryWriter and the spool replay call"""
+        self.append_many(documents)
+
+    def sink(self):
+        """Target the history writer inserts a submitted batch into"""
+        return self
+
+    def replayed(self, documents: List[dict]):
+        """Documents the spool stored late; backends with precomputed stats fold them in"""
+
+    @property
+    def publishes_stored(self) -> bool:
+        """Whether new entries are published by the sink once stored, instead of as submitted"""
+        return False
+
+    # ---------- lifecycle ----------
+    def prepare(self):
+        """Create the schema and indexes (idempotent)"""
+
+    def close(self):
+        pass
+
+    def health(self) -> dict:
+        return {"status": "ok"}
+
+    # ---------- reads ----------
+    @abstractmethod
+    async def find_documents(self, limit: int, cursor: Optional[str] = None, operation: Optional[str] = None,
+                             date_from: Optional[datetime.datetime] = None,
+                             date_to: Optional[datetime.datetime] = None,
+                             sort_by: str = "date", order: str = "desc",
+                             since: Optional[ObjectId] = None) -> List[dict]:
+        """Up to limit + 1 documents of a history page; the extra one means another page exists"""
+
+    @abstractmethod
+    async def newest_id(self) -> Optional[ObjectId]:
+        """_id of the newest listed entry (the sync token)"""
+
+    def stats(self, bucket: str = "day", date_from: Optional[datetime.datetime] = None,
+              date_to: Optional[datetime.datetime] = None, operation: Optional[str] = None,
+              now: Optional[datetime.datetime] = None, grace: float = 300, max_buckets: int = 2000) -> dict:
+        """Statistics response, aggregated live over the stored documents"""
+        window = stats_window(bucket, date_from, date_to, operation, now or utc_now(), max_buckets,
+                              self.earliest_created_at)
+        if window is None:
+            return summarize([])
+        return summarize(filter_operation(self.aggregate_rows(window[0], window[1], bucket), operation))
+
+    @abstractmethod
+    def earliest_created_at(self) -> Optional[datetime.datetime]:
+        """Creation time of the oldest stored document"""
+
+    @abstractmethod
+    def aggregate_rows(self, start: datetime.datetime, end: datetime.datetime, bucket: str) -> List[dict]:
+        """Per-operation, per-bucket counters for documents created in [start, end)"""
+
+    @abstractmethod
+    def iter_documents(self, operation: Optional[str] = None, date_from: Optional[datetime.datetime] = None,
+                       date_to: Optional[datetime.datetime] = None, batch_size: int = 1000) -> Iterator[dict]:
+        """Matching documents oldest first, read batch_size at a time; an invalid filter raises before iteration starts"""
+
+# ==================== MONGO ====================
+def needs_archive(documents: list, limit: int, sort_by: str, order: str, archive_dir: str, date_from) -> bool:
+    """Whether archived history can contribute to this page"""
+    # Newest first and the hot window already filled the page: the archive is all older
+    if sort_by == "date" and order == "desc" and len(documents) > limit:
+        return False
+    return archive_overlaps(archive_dir, date_from)
+
+class MongoHistoryRepository(HistoryRepository):
+    """The app's Mongo collections plus the day archive.
+
+    Getters are evaluated on every call, so the collections opened in the
+    lifespan (or swapped in by tests) are always the ones used. Pages go
+    through the async driver when it is connected. With a compaction_window,
+    identical operations within each window are stored as one counted entry,
+    and on_compacted(collection, keys) is called from the writer after each
+    bulk of upserts. Pages sorted by result read at most archive_result_days
+    archived days.
+    """
+
+    name = "mongo"
+
+    def __init__(self, collection_getter: Callable, async_collection_getter: Callable,
+                 rollups_getter: Callable, archive_dir_getter: Callable[[], Optional[str]] = lambda: None,
+                 compaction_window: Optional[float] = None, archive_result_days: int = 7,
+                 on_compacted: Optional[Callable] = None):
+        self.collection_getter = collection_getter
+        self.async_collection_getter = async_collection_getter
+        self.rollups_getter = rollups_getter
+        self.archive_dir_getter = archive_dir_getter
+        self.compaction_window = compaction_window
+        self.archive_result_days = archive_result_days
+        self.on_compacted = on_compacted
+        self._compacting = None
+
+    def sink(self):
+        # The collection itself: the writer's insert timeout and the replay's duplicate handling are pymongo's
+        collection = self.collection_getter()
+        if not self.compaction_window:
+            return collection
+        # One sink per collection, so the writer still groups a flush into a single bulk
+        if self._compacting is None or self._compacting.collection is not collection:
+            self._compacting = CompactingCollection(collection, self.compaction_window, self.on_compacted)
+        return self._compacting
+
+    @property
+    def publishes_stored(self) -> bool:
+        # A compacted entry only has its id and count once the upsert is done
+        return bool(self.compaction_window)
+
+    def append_many(self, documents: List[dict]):
+        self.sink().insert_many(documents, ordered=False)
+
+    def replayed(self, documents: List[dict]):
+        # Their buckets may have closed, or been archived, while they sat in the spool
+        rollups = self.rollups_getter()
+        if rollups is not None:
+            fold_into_rollups(rollups, documents)
+
+    def prepare(self):
+        ensure_history_indexes(self.collection_getter())
+        if self.compaction_window:
+            ensure_compaction_index(self.collection_getter())
+
+    async def find_documents(self, limit: int, sort_by: str = "date", order: str = "desc", since=None, **params):
+        if since is not None and self.compaction_window:
+            params["since_field"] = "updated_id"
+        async_collection = self.async_collection_getter()
+        if async_collection is not None:
+            documents = await find_history_documents_async(
+                async_collection, limit, sort_by=sort_by, order=order, since=since, **params
+            )
+        else:
+            # Blocking collection (e.g. mongomock in tests): keep it off the event loop
+            documents = await run_in_threadpool(
+                find_history_documents, self.collection_getter(), limit, sort_by=sort_by, order=order, since=since,
+                **params
+            )
+        archive_dir = self.archive_dir_getter()
+        # Entries after a sync token are always recent, never archived
+        if archive_dir and since is None and needs_archive(
+            documents, limit, sort_by, order, archive_dir, params.get("date_from")
+        ):
+            archived = await run_in_threadpool(
+                find_archived_documents, archive_dir, limit, sort_by=sort_by, order=order,
+                max_result_days=self.archive_result_days, **params
+            )
+            documents = merge_documents(documents, archived, limit, sort_by, order)
+        return documents
+
+    async def newest_id(self) -> Optional[ObjectId]:
+        # Compacted entries also move the token when a repeat bumps their count
+        fields = ("_id", "updated_id") if self.compaction_window else ("_id",)
+        async_collection = self.async_collection_getter()
+        if async_collection is not None:
+            ids = [await find_newest_id_async(async_collection, field) for field in fields]
+        else:
+            collection = self.collection_getter()
+            ids = [await run_in_threadpool(find_newest_id, collection, field) for field in fields]
+        ids = [object_id for object_id in ids if object_id is not None]
+        return max(ids) if ids else None
+
+    def stats(self, bucket: str = "day", date_from=None, date_to=None, operation=None, now=None,
+              grace: float = 300, max_buckets: int = 2000) -> dict:
+        # Closed buckets come from the rollups collection, which also covers archived history
+        return history_stats(
+            self.collection_getter(), self.rollups_getter(), bucket=bucket, date_from=date_from, date_to=date_to,
+            operation=operation, now=now, grace=grace, max_buckets=max_buckets,
+        )
+
+    def earliest_created_at(self) -> Optional[datetime.datetime]:
+        # Archived history only remains as rollups
+        return earliest_start(self.collection_getter(), self.rollups_getter(), "day")
+
+    def aggregate_rows(self, start, end, bucket: str) -> List[dict]:
+        return aggregate_rows(self.collection_getter(), start, end, bucket)
+
+    def iter_documents(self, operation=None, date_from=None, date_to=None, batch_size: int = 1000):
+        return export_documents(
+            self.collection_getter(), self.archive_dir_getter(), operation=operation,
+            date_from=date_from, date_to=date_to, batch_size=batch_size,
+        )
+
+# ==================== IN-MEMORY RING BUFFER ====================
+def document_id(document: dict) -> ObjectId:
+    return document["_id"]
+
+def id_bounds(date_from=None, date_to=None, since: Optional[ObjectId] = None):
+    """_id range [low, high) of a date filter and sync token, like build_history_filter"""
+    low = ObjectId.from_datetime(to_utc(date_from)) if date_from is not None else None
+    high = ObjectId.from_datetime(to_utc(date_to)) if date_to is not None else None
+    if since is not None:
+        low = since if low is None else max(low, since)
+    return low, high
+
+class MemoryHistoryRepository(HistoryRepository):
+    """The most recent max_documents documents of this process, for ephemeral or edge deployments.
+
+    The buffer is kept ordered by _id, so date filters, date cursors and sync
+    tokens are a bisect. Reads hold the lock only to bisect and copy the span
+    they need; an out-of-order batch (a racing backpressure write) is merged
+    in by rebuilding the buffer. History is per worker and is lost on restart;
+    once the buffer is full the oldest documents are dropped.
+    """
+
+    name = "memory"
+
+    def __init__(self, max_documents: int = 10000):
+        self._documents = deque(maxlen=max_documents)
+        self._lock = threading.Lock()
+        self._newest = None
+
+    def __len__(self):
+        return len(self._documents)
+
+    def append_many(self, documents: List[dict]):
+        if not documents:
+            return
+        batch = sorted(documents, key=document_id)
+        with self._lock:
+            if not self._documents or batch[0]["_id"] > self._documents[-1]["_id"]:
+                self._documents.extend(batch)
+            else:
+                merged = heapq.merge(self._documents, batch, key=document_id)
+                self._documents = deque(merged, maxlen=self._documents.maxlen)
+            newest = max((document["_id"] for document in batch if document.get("status") != STATUS_ERROR),
+                         default=None)
+            if newest is not None and (self._newest is None or newest > self._newest):
+                self._newest = newest
+
+    def health(self) -> dict:
+        return {"status": "ok", "documents": len(self._documents)}
+
+    def _span(self, low: Optional[ObjectId] = None, high: Optional[ObjectId] = None):
+        """Index range of the documents with low <= _id < high; the caller holds the lock"""
+        lo = 0 if low is None else bisect.bisect_left(self._documents, low, key=document_id)
+        high_index = len(self._documents) if high is None else bisect.bisect_left(self._documents, high, key=document_id)
+        return lo, max(lo, high_index)
+
+    def _snapshot(self, low: Optional[ObjectId] = None, high: Optional[ObjectId] = None) -> List[dict]:
+        with self._lock:
+            lo, hi = self._span(low, high)
+            return list(itertools.islice(self._documents, lo, hi))
+
+    def find(self, limit: int, cursor: Optional[str] = None, operation: Optional[str] = None,
+             date_from=None, date_to=None, sort_by: str = "date", order: str = "desc", since=None) -> List[dict]:
+        build_sort(sort_by, order)  # validates sort_by and order
+        matches = archive_filter(operation, date_from, date_to)
+        descending = order == "desc"
+        low, high = id_bounds(date_from, date_to, since)
+        if sort_by != "date":
+            # Ordered by result: every document in the date range is a candidate
+            key = document_sort_key(sort_by)
+            documents = (document for document in self._snapshot(low, high) if matches(document))
+            if cursor:
+                value, object_id = decode_cursor(cursor)
+                after = (result_sort_key(value), object_id)
+                documents = (
+                    document for document in documents
+                    if (key(document) < after if descending else key(document) > after)
+                )
+            select = heapq.nlargest if descending else heapq.nsmallest
+            return [project(document) for document in select(limit + 1, documents, key=key)]
+        page = []
+        with self._lock:
+            lo, hi = self._span(low, high)
+            if cursor:
+                # Keyset: strictly before (desc) or after (asc) the cursor's _id
+                object_id = decode_cursor(cursor)[1]
+                if descending:
+                    hi = min(hi, bisect.bisect_left(self._documents, object_id, key=document_id))
+                else:
+                    lo = max(lo, bisect.bisect_right(self._documents, object_id, key=document_id))
+            for index in (range(hi - 1, lo - 1, -1) if descending else range(lo, hi)):
+                document = self._documents[index]
+                if matches(document):
+                    page.append(project(document))
+                    if len(page) > limit:
+                        break
+        return page
+
+    async def find_documents(self, limit: int, **params) -> List[dict]:
+        return self.find(limit, **params)
+
+    async def newest_id(self) -> Optional[ObjectId]:
+        return self._newest
+
+    def earliest_created_at(self) -> Optional[datetime.datetime]:
+        return min((as_utc(document["created_at"]) for document in self._snapshot()), default=None)
+
+    def aggregate_rows(self, start, end, bucket: str) -> List[dict]:
+        return document_rows(
+            (document for document in self._snapshot() if start <= as_utc(document["created_at"]) < end), bucket
+        )
+
+    def iter_documents(self, operation=None, date_from=None, date_to=None, batch_size: int = 1000):
+        matches = archive_filter(operation, date_from, date_to)
+        low, high = id_bounds(date_from, date_to)
+        # One snapshot for the whole export: later writes are not part of it
+        documents = self._snapshot(low, high)
+        return (document for document in documents if matches(document))
+
+# ==================== SQLITE ====================
+# The _id is stored as its hex string, which sorts like the ObjectId; the
+# indexes mirror HISTORY_INDEXES. Remaining document fields go in a JSON blob
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    operation TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result REAL,
+    fields BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS history_operation ON history (operation, id);
+CREATE INDEX IF NOT EXISTS history_result ON history (result, id);
+CREATE INDEX IF NOT EXISTS history_operation_result ON history (operation, result, id);
+CREATE INDEX IF NOT EXISTS history_stats ON history (created_at, operation, status, result);
+"""
+SQLITE_COLUMNS = "id, created_at, operation, status, result, fields"
+COLUMN_FIELDS = frozenset({"_id", "created_at", "operation", "status", "result"})
+
+def sqlite_row(document: dict) -> tuple:
+    fields = {field: value for field, value in document.items() if field not in COLUMN_FIELDS}
+    return (
+        str(document["_id"]),
+        as_utc(document["created_at"]).timestamp(),
+        document["operation"],
+        document.get("status", STATUS_OK),
+        document.get("result"),
+        orjson.dumps(fields, option=orjson.OPT_SERIALIZE_NUMPY),
+    )
+
+def sqlite_document(row: tuple) -> dict:
+    object_id, created_at, operation, status, result, fields = row
+    document = orjson.loads(fields)
+    document.update(
+        _id=ObjectId(object_id),
+        created_at=datetime.datetime.fromtimestamp(created_at, pytz.UTC),
+        operation=operation,
+        status=status,
+        result=result,
+    )
+    return document
+
+def sqlite_filter(operation: Optional[str] = None, date_from=None, date_to=None, since: Optional[ObjectId] = None):
+    """WHERE clauses and parameters equivalent to build_history_filter"""
+    clauses = ["status != ?"]
+    values = [STATUS_ERROR]
+    if operation:
+        aliases = OPERATION_ALIASES.get(operation)
+        if aliases is None:
+            raise InvalidHistoryQuery(f"Unsupported operation filter: {operation}")
+        clauses.append(f"operation IN ({', '.join('?' * len(aliases))})")
+        values.extend(aliases)
+    low = ObjectId.from_datetime(to_utc(date_from)) if date_from is not None else None
+    if since is not None:
+        low = since if low is None else max(low, since)
+    if low is not None:
+        clauses.append("id >= ?")
+        values.append(str(low))
+    if date_to is not None:
+        # date_to is exclusive
+        clauses.append("id < ?")
+        values.append(str(ObjectId.from_datetime(to_utc(date_to))))
+    return clauses, values
+
+class SQLiteHistoryRepository(HistoryRepository):
+    """History in an embedded SQLite file, for single-node installs.
+
+    WAL mode lets readers run while a write commits, also across the worker
+    processes sharing the file. Every thread opens its own connection.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, busy_timeout: float = 5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._prepared = False
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # With WAL a crash can only lose the last commits, never corrupt the file
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+                if not self._prepared:
+                    connection.executescript(SQLITE_SCHEMA)
+                    self._prepared = True
+        return connection
+
+    def prepare(self):
+        self.connection()
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+            self._local = threading.local()
+
+    def health(self) -> dict:
+        try:
+            self.connection().execute("SELECT 1").fetchone()
+        except sqlite3.Error as e:
+            return {"status": "down", "error": str(e)}
+        return {"status": "ok"}
+
+    def append_many(self, documents: List[dict]):
+        connection = self.connection()
+        # One transaction per batch; replayed documents that are already stored are skipped
+        with connection:
+            connection.executemany(
+                f"INSERT OR IGNORE INTO history ({SQLITE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                [sqlite_row(document) for document in documents],
+            )
+
+    def find(self, limit: int, cursor: Optional[str] = None, operation: Optional[str] = None,
+             date_from=None, date_to=None, sort_by: str = "date", order: str = "desc", since=None) -> List[dict]:
+        build_sort(sort_by, order)  # validates sort_by and order
+        clauses, values = sqlite_filter(operation, date_from, date_to, since)
+        compare = "<" if order == "desc" else ">"
+        if cursor:
+            value, object_id = decode_cursor(cursor)
+            if sort_by == "date":
+                clauses.append(f"id {compare} ?")
+                values.append(str(object_id))
+            else:
+                clauses.append(f"(result {compare} ? OR (result = ? AND id {compare} ?))")
+                values.extend([value, value, str(object_id)])
+        direction = "DESC" if order == "desc" else "ASC"
+        order_by = f"id {direction}" if sort_by == "date" else f"result {direction}, id {direction}"
+        rows = self.connection().execute(
+            f"SELECT {SQLITE_COLUMNS} FROM history WHERE {' AND '.join(clauses)} ORDER BY {order_by} LIMIT ?",
+            values + [limit + 1],
+        ).fetchall()
+        return [project(sqlite_document(row)) for row in rows]
+
+    async def find_documents(self, limit: int, **params) -> List[dict]:
+        return await run_in_threadpool(self.find, limit, **params)
+
+    def find_newest_id(self) -> Optional[ObjectId]:
+        row = self.connection().execute(
+            "SELECT id FROM history WHERE status != ? ORDER BY id DESC LIMIT 1", [STATUS_ERROR]
+        ).fetchone()
+        return ObjectId(row[0]) if row else None
+
+    async def newest_id(self) -> Optional[ObjectId]:
+        return await run_in_threadpool(self.find_newest_id)
+
+    def earliest_created_at(self) -> Optional[datetime.datetime]:
+        (first,) = self.connection().execute("SELECT MIN(created_at) FROM history").fetchone()
+        return datetime.datetime.fromtimestamp(first, pytz.UTC) if first is not None else None
+
+    def aggregate_rows(self, start, end, bucket: str) -> List[dict]:
+        # Buckets are whole hours or UTC days, so they are multiples of their size since the epoch
+        size = BUCKET_SIZES[bucket].total_seconds()
+        rows = self.connection().execute(
+            "SELECT operation, CAST(created_at / ? AS INTEGER) AS slot, COUNT(*), SUM(status = ?),"
+            " MIN(result), MAX(result), TOTAL(result)"
+            " FROM history WHERE created_at >= ? AND created_at < ? GROUP BY operation, slot",
+            [size, STATUS_ERROR, start.timestamp(), end.timestamp()],
+        ).fetchall()
+        return [
+            {
+                "operation": operation,
+                "bucket": datetime.datetime.fromtimestamp(slot * size, pytz.UTC),
+                "count": count,
+                "errors": errors,
+                "min": minimum,
+                "max": maximum,
+                "total": total,
+            }
+            for operation, slot, count, errors, minimum, maximum, total in rows
+        ]
+
+    def iter_documents(self, operation=None, date_from=None, date_to=None, batch_size: int = 1000):
+        # Built here so an invalid filter fails before the response starts
+        clauses, values = sqlite_filter(operation, date_from, date_to)
+        query = f"SELECT {SQLITE_COLUMNS} FROM history WHERE {' AND '.join(clauses)} AND id > ? ORDER BY id LIMIT ?"
+
+        def documents():
+            last = ""
+            while True:
+                # Keyset batches: each one may be pulled from a different threadpool thread
+                rows = self.connection().execute(query, values + [last, batch_size]).fetchall()
+                if not rows:
+                    return
+                for row in rows:
+                    yield sqlite_document(row)
+                last = rows[-1][0]
+        return documents()
@@ -0,0 +1,201 @@
+# ==================== IMPORTS ====================
+import datetime
+import os
+from functools import lru_cache
+from typing import List, Optional
+
+import pytz
+from bson import ObjectId
+
+# ==================== SCHEMA ====================
+# Version 2: UTC created_at datetime and normalized numbers/result/operation fields
+SCHEMA_VERSION = 2
+
+# Failed operations are stored too (for error rates) but never listed as history
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+
+MEXICO_TZ = pytz.timezone('America/Mexico_City')
+DISPLAY_DATE_FORMAT = '%d/%m/%Y %H:%M'
+
+# Every operation name found in history mapped to its canonical name
+CANONICAL_OPERATIONS = {
+    "sum": "sum",
+    "suma": "sum",
+    "subtract": "subtract",
+    "substract": "subtract",
+    "sub": "subtract",
+    "resta": "subtract",
+    "multiplication": "multiplication",
+    "multiply": "multiplication",
+    "mul": "multiplication",
+    "multiplicacion": "multiplication",
+    "division": "division",
+    "divide": "division",
+    "div": "division",
+}
+
+def canonical_operation(operation: Optional[str]) -> str:
+    """Canonical name of an operation; unknown names are kept as they are"""
+    if operation is None:
+        return "unknown"
+    return CANONICAL_OPERATIONS.get(operation, operation)
+
+def utc_now() -> datetime.datetime:
+    """Current time as a timezone-aware UTC datetime"""
+    return datetime.datetime.now(pytz.UTC)
+
+def build_history_document(operation: str, numbers: List[float], result, created_at: datetime.datetime,
+                           object_id: Optional[ObjectId] = None) -> dict:
+    """Build a history document in the canonical schema.
+
+    The _id is assigned here (or taken from object_ids()) so retried writes
+    of the same document are recognisable.
+    """
+    return {
+        "_id": object_id or ObjectId(),
+        "schema_version": SCHEMA_VERSION,
+        "operation": canonical_operation(operation),
+        "numbers": numbers,
+        "result": result,
+        "status": STATUS_OK,
+        "created_at": created_at,
+    }
+
+def build_history_error_document(operation: str, numbers: List[float], error: str, created_at: datetime.datetime,
+                                 object_id: Optional[ObjectId] = None) -> dict:
+    """Build the history document of a failed operation"""
+    document = build_history_document(operation, numbers, None, created_at, object_id)
+    document["status"] = STATUS_ERROR
+    document["error"] = error
+    return document
+
+# ==================== BULK DOCUMENTS ====================
+# ObjectIds end in a 3-byte counter
+OBJECT_ID_COUNTER_RANGE = 1 << 24
+
+def object_ids(created_at: datetime.datetime, count: int) -> List[ObjectId]:
+    """count distinct ObjectIds stamped with created_at, in increasing order.
+
+    Built from bytes: created_at's seconds, a random 5-byte prefix per call
+    (per 2**24 ids) and a counter, instead of one ObjectId() per document.
+    """
+    seconds = int(created_at.timestamp()).to_bytes(4, "big")
+    ids = []
+    for start in range(0, count, OBJECT_ID_COUNTER_RANGE):
+        prefix = seconds + os.urandom(5)
+        size = min(OBJECT_ID_COUNTER_RANGE, count - start)
+        ids.extend(ObjectId(prefix + counter.to_bytes(3, "big")) for counter in range(size))
+    return ids
+
+def build_history_documents(ids: List[ObjectId], operations: List[str], numbers: List[List[float]], results: list,
+                            created_at: datetime.datetime) -> List[dict]:
+    """build_history_document for many successful operations sharing created_at, one column per argument"""
+    canonical = {operation: canonical_operation(operation) for operation in set(operations)}
+    return [
+        {
+            "_id": object_id,
+            "schema_version": SCHEMA_VERSION,
+            "operation": canonical[operation],
+            "numbers": item_numbers,
+            "result": result,
+            "status": STATUS_OK,
+            "created_at": created_at,
+        }
+        for object_id, operation, item_numbers, result in zip(ids, operations, numbers, results)
+    ]
+
+# ==================== DATE FORMATTING ====================
+@lru_cache(maxsize=4096)
+def _format_minute(year: int, month: int, day: int, hour: int, minute: int) -> str:
+    utc = datetime.datetime(year, month, day, hour, minute, tzinfo=pytz.UTC)
+    return utc.astimezone(MEXICO_TZ).strftime(DISPLAY_DATE_FORMAT)
+
+def format_date(value: datetime.datetime) -> str:
+    """Format a stored UTC datetime in Mexico City time (cached per minute)"""
+    # Mongo returns naive datetimes that are in UTC; the cache is keyed on plain
+    # fields because datetime.replace() costs more than the lookup itself
+    if value.tzinfo is not None:
+        value = value.astimezone(pytz.UTC)
+    return _format_minute(value.year, value.month, value.day, value.hour, value.minute)
+
+def parse_legacy_date(value, fallback: datetime.datetime) -> datetime.datetime:
+    """Parse a legacy date value into a UTC datetime"""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=pytz.UTC)
+        return value.astimezone(pytz.UTC)
+    if isinstance(value, str):
+        try:
+            local = datetime.datetime.strptime(value, DISPLAY_DATE_FORMAT)
+            return MEXICO_TZ.localize(local).astimezone(pytz.UTC)
+        except ValueError:
+            pass
+    return fallback
+
+# ==================== READ PATH ====================
+def history_row(document: dict) -> dict:
+    """Convert a stored document into a history response row.
+
+    Documents in the current schema are turned into the row in place.
+    """
+    if document.get("schema_version") == SCHEMA_VERSION:
+        # Fast path: the projected fields already are the row, only the date needs formatting.
+        # Large vector inputs also carry an operands summary; numbers then only holds a preview
+        document["id"] = str(document.pop("_id"))
+        del document["schema_version"]
+        document["date"] = format_date(document.pop("created_at"))
+        if "last_seen" in document:
+            # Compacted entry: date is when it was first seen, count how many times since
+            document["last_seen"] = format_date(document["last_seen"])
+        if "updated_id" in document:
+            document["updated_id"] = str(document["updated_id"])
+        return document
+    return legacy_history_row(document)
+
+def legacy_history_row(document: dict) -> dict:
+    """Row for documents written before schema version 2"""
+    # Handle both string dates and datetime objects
+    date_value = document.get("date")
+    if isinstance(date_value, str):
+        formatted_date = date_value
+    elif isinstance(date_value, datetime.datetime):
+        formatted_date = format_date(date_value)
+    else:
+        formatted_date = str(date_value)
+
+    # Handle both old and new field names for compatibility
+    numbers = document.get("numbers", document.get("numeros", [document.get("a"), document.get("b")]))
+    result = document.get("result", document.get("resultado"))
+    operation_type = document.get("operation", document.get("operacion", "unknown"))
+
+    row = {
+        "numbers": numbers,
+        "result": result,
+        "operation": operation_type,
+        "date": formatted_date
+    }
+    if "_id" in document:
+        row["id"] = str(document["_id"])
+    return row
+
+# ==================== MIGRATION ====================
+def migrate_document(document: dict) -> dict:
+    """Rewrite a legacy document in the canonical schema, keeping its _id"""
+    numbers = document.get("numbers", document.get("numeros"))
+    if numbers is None:
+        numbers = [document.get("a"), document.get("b")]
+    result = document.get("result", document.get("resultado"))
+    # Early batch documents stored the whole {"operation", "result"} object
+    if isinstance(result, dict):
+        result = result.get("result")
+    fallback = document["_id"].generation_time if isinstance(document.get("_id"), ObjectId) else utc_now()
+    return {
+        "_id": document["_id"],
+        "schema_version": SCHEMA_VERSION,
+        "operation": canonical_operation(document.get("operation", document.get("operacion"))),
+        "numbers": numbers,
+        "result": result,
+        "status": STATUS_OK,
+        "created_at": parse_legacy_date(document.get("date"), fallback),
+    }
@@ -0,0 +1,158 @@
+# ==================== IMPORTS ====================
+import fcntl
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import bson
+from pymongo.errors import BulkWriteError
+
+from metrics import (
+    HISTORY_SPOOL_BYTES,
+    HISTORY_SPOOL_REPLAY_LAG_SECONDS,
+    HISTORY_SPOOL_REPLAYED_DOCUMENTS,
+    HISTORY_SPOOLED_DOCUMENTS,
+)
+
+SEGMENT_SUFFIX = ".spool"
+DUPLICATE_KEY = 11000
+
+# ==================== RECORDS ====================
+def read_documents(spool_file, limit: int) -> Tuple[List[dict], int, bool]:
+    """Up to limit BSON documents from the current position.
+
+    Returns the documents, the offset after the last complete one and whether
+    the segment is exhausted. A record cut short by an interrupted append ends
+    the segment: it was never acknowledged.
+    """
+    documents = []
+    offset = spool_file.tell()
+    while len(documents) < limit:
+        header = spool_file.read(4)
+        size = int.from_bytes(header, "little") if len(header) == 4 else 0
+        body = spool_file.read(size - 4) if size > 4 else b""
+        if size <= 4 or len(body) < size - 4:
+            return documents, offset, True
+        documents.append(bson.decode(header + body))
+        offset += size
+    return documents, offset, False
+
+def insert_ignoring_duplicates(collection, documents: List[dict]) -> List[dict]:
+    """insert_many where documents that are already stored count as written; returns the ones stored now"""
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        # Every spooled document has its _id already, so a replay never duplicates
+        errors = e.details.get("writeErrors", [])
+        if e.details.get("writeConcernErrors") or any(error["code"] != DUPLICATE_KEY for error in errors):
+            raise
+        duplicates = {error["index"] for error in errors}
+        return [document for index, document in enumerate(documents) if index not in duplicates]
+    return documents
+
+# ==================== SPOOL ====================
+class HistorySpool:
+    """Append-only local spool for history documents that could not be written to Mongo.
+
+    Documents are appended as BSON to segment files with one fsync per batch.
+    Each process holds an exclusive flock on the segment it appends to, so a
+    replayer in any process only picks up sealed segments and the segments
+    left behind by processes that died.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._active = None
+        self._offsets = {}
+        self._lock = threading.Lock()
+
+    # ---------- appending ----------
+    def append(self, documents: List[dict]):
+        """Append documents durably: they are on disk when this returns"""
+        data = b"".join(bson.encode(document) for document in documents)
+        with self._lock:
+            if self._active is None or self._active.tell() >= self.segment_bytes:
+                self._seal()
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, f"{time.time_ns():020d}-{os.getpid()}{SEGMENT_SUFFIX}")
+                self._active = open(path, "ab")
+                fcntl.flock(self._active, fcntl.LOCK_EX)
+            self._active.write(data)
+            self._active.flush()
+            os.fsync(self._active.fileno())
+        HISTORY_SPOOLED_DOCUMENTS.inc(len(documents))
+        self.update_metrics()
+
+    def seal(self):
+        """Close the segment being appended to so it can be replayed"""
+        with self._lock:
+            self._seal()
+
+    def _seal(self):
+        if self._active is not None:
+            # Closing releases the flock
+            self._active.close()
+            self._active = None
+
+    # ---------- replay ----------
+    def segments(self) -> List[str]:
+        """Segment paths, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def pending(self) -> bool:
+        return bool(self.segments())
+
+    def replay(self, collection, max_documents: int = 1000,
+               on_stored: Optional[Callable[[List[dict]], None]] = None) -> int:
+        """Write up to max_documents spooled documents back to Mongo; returns how many.
+
+        A failed insert leaves the segment where it was, so nothing is lost;
+        a segment is deleted only after all of its documents are stored.
+        on_stored gets the documents this replay stored (not the ones already there).
+        """
+        self.seal()
+        for path in self.segments():
+            try:
+                spool_file = open(path, "rb")
+            except FileNotFoundError:
+                continue  # replayed by another process in the meantime
+            with spool_file:
+                try:
+                    fcntl.flock(spool_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # still being appended to, or replayed elsewhere
+                spool_file.seek(self._offsets.get(path, 0))
+                documents, offset, exhausted = read_documents(spool_file, max_documents)
+                if documents:
+                    stored = insert_ignoring_duplicates(collection, documents)
+                    HISTORY_SPOOL_REPLAYED_DOCUMENTS.inc(len(documents))
+                    if stored and on_stored is not None:
+                        on_stored(stored)
+                if exhausted:
+                    os.remove(path)
+                    self._offsets.pop(path, None)
+                else:
+                    self._offsets[path] = offset
+            self.update_metrics()
+            return len(documents)
+        return 0
+
+    # ---------- metrics ----------
+    def update_metrics(self):
+        """Spool size, and replay lag as the age of the oldest segment"""
+        total = 0
+        oldest = None
+        for path in self.segments():
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+            if oldest is None:
+                oldest = int(os.path.basename(path).split("-", 1)[0]) / 1e9
+        HISTORY_SPOOL_BYTES.set(total)
+        HISTORY_SPOOL_REPLAY_LAG_SECONDS.set(time.time() - oldest if oldest is not None else 0)
@@ -0,0 +1,274 @@
+# ==================== IMPORTS ====================
+import datetime
+from typing import Callable, List, Optional
+
+import pytz
+from pymongo import ASCENDING, ReplaceOne
+
+from history_query import OPERATION_ALIASES, InvalidHistoryQuery, to_utc
+from history_schema import STATUS_ERROR, utc_now
+
+# ==================== BUCKETS ====================
+BUCKET_SIZES = {
+    "hour": datetime.timedelta(hours=1),
+    "day": datetime.timedelta(days=1),
+}
+
+def bucket_floor(value: datetime.datetime, bucket: str) -> datetime.datetime:
+    """Start of the bucket containing value"""
+    value = value.replace(minute=0, second=0, microsecond=0)
+    if bucket == "day":
+        value = value.replace(hour=0)
+    return value
+
+def bucket_ceil(value: datetime.datetime, bucket: str) -> datetime.datetime:
+    """First bucket start at or after value"""
+    floor = bucket_floor(value, bucket)
+    return floor if floor == value else floor + BUCKET_SIZES[bucket]
+
+def rollup_id(bucket: str, start: datetime.datetime) -> str:
+    return f"{bucket}:{start.strftime('%Y-%m-%dT%H')}"
+
+def as_utc(value: datetime.datetime) -> datetime.datetime:
+    """Aware UTC datetime; naive values (as Mongo and BSON return them) are already in UTC"""
+    return value.replace(tzinfo=pytz.UTC) if value.tzinfo is None else value.astimezone(pytz.UTC)
+
+# ==================== AGGREGATION ====================
+def aggregate_rows(collection, start: datetime.datetime, end: datetime.datetime, bucket: str) -> List[dict]:
+    """Per-operation, per-bucket counters for documents created in [start, end)"""
+    match = {"created_at": {"$gte": start, "$lt": end}}
+    group_key = {
+        "operation": "$operation",
+        "year": {"$year": "$created_at"},
+        "month": {"$month": "$created_at"},
+        "day": {"$dayOfMonth": "$created_at"},
+    }
+    if bucket == "hour":
+        group_key["hour"] = {"$hour": "$created_at"}
+    # A compacted entry stands for count operations; every other document for one
+    weight = {"$ifNull": ["$count", 1]}
+    pipeline = [
+        {"$match": match},
+        # Only the fields the groups need
+        {"$project": {"_id": 0, "created_at": 1, "operation": 1, "status": 1, "result": 1, "count": 1}},
+        {"$group": {
+            "_id": group_key,
+            "count": {"$sum": weight},
+            "errors": {"$sum": {"$cond": [{"$eq": ["$status", STATUS_ERROR]}, weight, 0]}},
+            "min": {"$min": "$result"},
+            "max": {"$max": "$result"},
+            "total": {"$sum": {"$multiply": ["$result", weight]}},
+        }},
+    ]
+    rows = []
+    for group in collection.aggregate(pipeline):
+        key = group.pop("_id")
+        group["operation"] = key["operation"]
+        group["bucket"] = datetime.datetime(
+            key["year"], key["month"], key["day"], key.get("hour", 0), tzinfo=pytz.UTC
+        )
+        rows.append(group)
+    return rows
+
+def closed_bucket_rows(collection, rollups, bucket: str,
+                       start: datetime.datetime, end: datetime.datetime) -> List[dict]:
+    """Rows for complete buckets in [start, end), served from precomputed rollups"""
+    size = BUCKET_SIZES[bucket]
+    starts = []
+    current = start
+    while current < end:
+        starts.append(current)
+        current += size
+
+    cached = {
+        document["_id"]: document
+        for document in rollups.find({"_id": {"$in": [rollup_id(bucket, s) for s in starts]}})
+    }
+    rows = []
+    missing = []
+    for bucket_start in starts:
+        document = cached.get(rollup_id(bucket, bucket_start))
+        if document is None:
+            missing.append(bucket_start)
+            continue
+        for row in document["rows"]:
+            rows.append(dict(row, bucket=bucket_start))
+
+    if missing:
+        missing_set = set(missing)
+        computed = {}
+        for row in aggregate_rows(collection, missing[0], missing[-1] + size, bucket):
+            if row["bucket"] in missing_set:
+                computed.setdefault(row["bucket"], []).append(row)
+        requests = []
+        for bucket_start in missing:
+            bucket_rows = computed.get(bucket_start, [])
+            rows.extend(bucket_rows)
+            # Empty buckets are stored too so they are never recomputed
+            requests.append(ReplaceOne(
+                {"_id": rollup_id(bucket, bucket_start)},
+                {
+                    "granularity": bucket,
+                    "start": bucket_start,
+                    "rows": [{k: v for k, v in row.items() if k != "bucket"} for row in bucket_rows],
+                    "computed_at": utc_now(),
+                },
+                upsert=True,
+            ))
+        rollups.bulk_write(requests, ordered=False)
+    return rows
+
+def new_row(operation: str, bucket: Optional[datetime.datetime]) -> dict:
+    return {"operation": operation, "bucket": bucket, "count": 0, "errors": 0, "min": None, "max": None, "total": 0}
+
+def document_rows(documents, bucket: str) -> List[dict]:
+    """aggregate_rows over documents already in memory"""
+    rows = {}
+    for document in documents:
+        key = (document["operation"], bucket_floor(as_utc(document["created_at"]), bucket))
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = new_row(*key)
+        weight = document.get("count", 1)
+        row["count"] += weight
+        if document.get("status") == STATUS_ERROR:
+            row["errors"] += weight
+        result = document.get("result")
+        if result is not None:
+            row["total"] += result * weight
+            row["min"] = result if row["min"] is None else min(row["min"], result)
+            row["max"] = result if row["max"] is None else max(row["max"], result)
+    return list(rows.values())
+
+def fold_into_rollups(rollups, documents: List[dict], attempts: int = 5):
+    """Add documents stored after their bucket was rolled up (spool replay) to the stored rollups.
+
+    The rollup is updated rather than dropped: once a day is archived it is
+    the only copy of that day's counters. Buckets without a rollup are left
+    alone, they are aggregated from the collection when first needed.
+    """
+    for bucket in BUCKET_SIZES:
+        added = {}
+        for row in document_rows(documents, bucket):
+            added.setdefault(rollup_id(bucket, row["bucket"]), []).append(row)
+        for _id, rows in added.items():
+            # Compare-and-swap on computed_at: another worker may be folding into the same bucket
+            for _ in range(attempts):
+                current = rollups.find_one({"_id": _id})
+                if current is None:
+                    break
+                merged = {row["operation"]: row for row in current["rows"]}
+                for row in rows:
+                    _merge(merged.setdefault(row["operation"], new_row(row["operation"], None)), row)
+                stored = [{k: v for k, v in row.items() if k != "bucket"} for row in merged.values()]
+                result = rollups.replace_one(
+                    {"_id": _id, "computed_at": current["computed_at"]},
+                    dict(current, rows=stored, computed_at=utc_now()),
+                )
+                if result.matched_count:
+                    break
+
+# ==================== SUMMARY ====================
+def _merge(target: dict, row: dict):
+    target["count"] += row["count"]
+    target["errors"] += row["errors"]
+    target["total"] += row["total"] or 0
+    for field, pick in (("min", min), ("max", max)):
+        if row[field] is not None:
+            target[field] = row[field] if target[field] is None else pick(target[field], row[field])
+
+def _finish(entry: dict) -> dict:
+    succeeded = entry["count"] - entry["errors"]
+    return {
+        "count": entry["count"],
+        "errors": entry["errors"],
+        "error_rate": entry["errors"] / entry["count"] if entry["count"] else 0.0,
+        "min_result": entry["min"],
+        "max_result": entry["max"],
+        "avg_result": entry["total"] / succeeded if succeeded and entry["min"] is not None else None,
+    }
+
+def summarize(rows: List[dict]) -> dict:
+    """Combine per-operation, per-bucket rows into the stats response"""
+    empty = lambda: {"count": 0, "errors": 0, "total": 0, "min": None, "max": None}
+    overall = empty()
+    by_operation = {}
+    by_bucket = {}
+    for row in rows:
+        _merge(overall, row)
+        _merge(by_operation.setdefault(row["operation"], empty()), row)
+        _merge(by_bucket.setdefault(row["bucket"], empty()), row)
+
+    return {
+        **_finish(overall),
+        "by_operation": [
+            dict(operation=operation, **_finish(entry))
+            for operation, entry in sorted(by_operation.items())
+        ],
+        "buckets": [
+            {"start": start.isoformat(), "count": entry["count"], "errors": entry["errors"]}
+            for start, entry in sorted(by_bucket.items())
+        ],
+    }
+
+# ==================== STATS ====================
+def earliest_start(collection, rollups, bucket: str) -> Optional[datetime.datetime]:
+    """Oldest point with history: the first live document or the first stored rollup (archived history)"""
+    candidates = []
+    first = collection.find_one({"created_at": {"$exists": True}}, {"created_at": 1}, sort=[("created_at", ASCENDING)])
+    if first is not None:
+        candidates.append(first["created_at"].replace(tzinfo=pytz.UTC))
+    first_rollup = rollups.find_one({"granularity": bucket}, {"start": 1}, sort=[("start", ASCENDING)])
+    if first_rollup is not None:
+        candidates.append(first_rollup["start"].replace(tzinfo=pytz.UTC))
+    return min(candidates) if candidates else None
+
+def stats_window(bucket: str, date_from: Optional[datetime.datetime], date_to: Optional[datetime.datetime],
+                 operation: Optional[str], now: datetime.datetime, max_buckets: int,
+                 earliest: Callable[[], Optional[datetime.datetime]]):
+    """Validated [start, end) range of a stats query, or None when it is empty"""
+    if bucket not in BUCKET_SIZES:
+        raise InvalidHistoryQuery(f"Unsupported bucket: {bucket}")
+    if operation and operation not in OPERATION_ALIASES:
+        raise InvalidHistoryQuery(f"Unsupported operation filter: {operation}")
+    end = to_utc(date_to) if date_to else now
+    start = to_utc(date_from) if date_from else earliest()
+    if start is None or end <= start:
+        return None
+    if (end - start) / BUCKET_SIZES[bucket] > max_buckets:
+        raise InvalidHistoryQuery("Too many buckets: use a larger bucket or a shorter date range")
+    return start, end
+
+def filter_operation(rows: List[dict], operation: Optional[str]) -> List[dict]:
+    if not operation:
+        return rows
+    aliases = OPERATION_ALIASES[operation]
+    return [row for row in rows if row["operation"] in aliases]
+
+def history_stats(collection, rollups, bucket: str = "day",
+                  date_from: Optional[datetime.datetime] = None,
+                  date_to: Optional[datetime.datetime] = None,
+                  operation: Optional[str] = None,
+                  now: Optional[datetime.datetime] = None,
+                  grace: float = 300, max_buckets: int = 2000) -> dict:
+    """Statistics over history; closed buckets come from rollups, the rest is aggregated live"""
+    now = now or utc_now()
+    window = stats_window(bucket, date_from, date_to, operation, now, max_buckets,
+                          lambda: earliest_start(collection, rollups, bucket))
+    if window is None:
+        return summarize([])
+    start, end = window
+
+    # Buckets that ended more than `grace` seconds ago no longer receive writes
+    closed_start = bucket_ceil(start, bucket)
+    closed_end = min(bucket_floor(end, bucket), bucket_floor(now - datetime.timedelta(seconds=grace), bucket))
+    rows = []
+    live_ranges = [(start, end)]
+    if closed_start < closed_end:
+        rows.extend(closed_bucket_rows(collection, rollups, bucket, closed_start, closed_end))
+        live_ranges = [(start, closed_start), (closed_end, end)]
+    for range_start, range_end in live_ranges:
+        if range_start < range_end:
+            rows.extend(aggregate_rows(collection, range_start, range_end, bucket))
+
+    return summarize(filter_operation(rows, operation))
@@ -0,0 +1,248 @@
+# ==================== IMPORTS ====================
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+
+import pymongo
+
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from history_spool import HistorySpool
+from logger_config import events
+from metrics import (
+    HISTORY_BACKPRESSURE,
+    HISTORY_BREAKER_STATE,
+    HISTORY_FLUSH_ERRORS,
+    HISTORY_FLUSH_SECONDS,
+    HISTORY_FLUSHED_DOCUMENTS,
+    HISTORY_LAST_FLUSH_SECONDS,
+    HISTORY_QUEUE_DEPTH,
+)
+
+# ==================== DURABILITY MODES ====================
+# buffered: the request is acknowledged as soon as the document is queued
+# acknowledged: the request waits until the batch containing it is written
+DURABILITY_BUFFERED = "buffered"
+DURABILITY_ACKNOWLEDGED = "acknowledged"
+DURABILITY_MODES = (DURABILITY_BUFFERED, DURABILITY_ACKNOWLEDGED)
+
+# ==================== DEGRADED MODE ====================
+BREAKER_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+def report_breaker_state(state: str):
+    HISTORY_BREAKER_STATE.set(BREAKER_STATE_VALUES[state])
+    events.warning("history write breaker", state=state)
+
+# ==================== HISTORY WRITER ====================
+class HistoryWriter:
+    """Write-behind sink that groups history documents into insert_many batches.
+
+    With a spool, batches go to a local file while the breaker is open (Mongo
+    failing or slow) and are replayed once it closes; a spooled batch counts
+    as acknowledged because it is already on disk.
+    """
+
+    def __init__(
+        self,
+        collection_getter: Callable,
+        batch_size: int = 500,
+        flush_interval: float = 0.2,
+        max_queue_size: int = 10000,
+        durability: str = DURABILITY_BUFFERED,
+        put_timeout: float = 1.0,
+        spool: Optional[HistorySpool] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        write_timeout: Optional[float] = None,
+        replay_batch_size: int = 1000,
+        on_replayed: Optional[Callable[[List[dict]], None]] = None,
+    ):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown history durability mode: {durability}")
+        self.collection_getter = collection_getter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.put_timeout = put_timeout
+        self.spool = spool
+        self.breaker = breaker if breaker is not None or spool is None else CircuitBreaker()
+        self.write_timeout = write_timeout
+        self.replay_batch_size = replay_batch_size
+        self.on_replayed = on_replayed
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stop_event = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    # ---------- lifecycle ----------
+    def start(self):
+        """Start the background flusher if it is not running yet"""
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="history-writer", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Drain the queue and stop the flusher"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            events.error("history writer did not drain", timeout=timeout, pending=self._queue.qsize())
+        self._thread = None
+        if self.spool is not None:
+            # Left for the next start, or for another worker to replay
+            self.spool.seal()
+
+    def flush(self):
+        """Block until every queued document has been written"""
+        self.start()
+        self._queue.join()
+
+    # ---------- producers ----------
+    def submit(self, document: dict, block: bool = True) -> Optional[Future]:
+        """Queue one document; returns a future in acknowledged mode"""
+        return self.submit_many([document], block)
+
+    def submit_many(self, documents: List[dict], block: bool = True) -> Optional[Future]:
+        """Queue several documents that are acknowledged together.
+
+        With block=False a full queue raises queue.Full instead of waiting,
+        so callers on an event loop can retry from a worker thread.
+        """
+        if not documents:
+            return None
+        self.start()
+        future = Future() if self.durability == DURABILITY_ACKNOWLEDGED else None
+        item = (self.collection_getter(), documents, future)
+        if not block:
+            self._queue.put_nowait(item)
+            HISTORY_QUEUE_DEPTH.set(self._queue.qsize())
+            return future
+        try:
+            self._queue.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            # Backpressure: the caller pays for the write instead of growing the queue
+            HISTORY_BACKPRESSURE.inc()
+            self._write([item])
+            return future
+        HISTORY_QUEUE_DEPTH.set(self._queue.qsize())
+        return future
+
+    # ---------- flusher ----------
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch:
+                self._write(batch)
+                for _ in batch:
+                    self._queue.task_done()
+                HISTORY_QUEUE_DEPTH.set(self._queue.qsize())
+            elif self._stop_event.is_set():
+                return
+            if self.spool is not None:
+                self._replay()
+
+    def _collect_batch(self):
+        """Wait for the first item, then gather until batch_size or flush_interval"""
+        try:
+            first = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+        batch = [first]
+        count = len(first[1])
+        deadline = time.monotonic() + self.flush_interval
+        while count < self.batch_size:
+            # On shutdown we stop waiting and just take what is already queued
+            remaining = 0 if self._stop_event.is_set() else deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    item = self._queue.get_nowait()
+                else:
+                    item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            count += len(item[1])
+        return batch
+
+    def _write(self, batch):
+        """Write queued items with one insert_many per target collection"""
+        groups = {}
+        for collection, documents, future in batch:
+            group = groups.setdefault(id(collection), (collection, [], []))
+            group[1].extend(documents)
+            if future is not None:
+                group[2].append(future)
+
+        for collection, documents, futures in groups.values():
+            if self.breaker is not None and not self.breaker.allow():
+                # Degraded mode: do not wait on Mongo at all
+                self._spool(documents, futures)
+                continue
+            started = time.perf_counter()
+            try:
+                # Bounded, so a stalled server fails the batch instead of holding the flusher
+                with pymongo.timeout(self.write_timeout):
+                    collection.insert_many(documents, ordered=False)
+            except Exception as e:
+                HISTORY_FLUSH_ERRORS.inc()
+                events.error("history flush error", documents=len(documents), error=e)
+                if self.breaker is not None:
+                    self.breaker.record(False)
+                if self.spool is not None:
+                    # Part of the batch may be stored already; the replay skips those _ids
+                    self._spool(documents, futures, e)
+                    continue
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            elapsed = time.perf_counter() - started
+            if self.breaker is not None:
+                self.breaker.record(True, elapsed)
+            HISTORY_FLUSH_SECONDS.observe(elapsed)
+            HISTORY_LAST_FLUSH_SECONDS.set(elapsed)
+            HISTORY_FLUSHED_DOCUMENTS.inc(len(documents))
+            for future in futures:
+                future.set_result(len(documents))
+
+    # ---------- degraded mode ----------
+    def _spool(self, documents: List[dict], futures: List[Future], error: Optional[Exception] = None):
+        try:
+            self.spool.append(documents)
+        except OSError as spool_error:
+            events.error("history spool error", documents=len(documents), error=spool_error)
+            for future in futures:
+                future.set_exception(error or spool_error)
+            return
+        for future in futures:
+            future.set_result(len(documents))
+
+    def _replayed(self, documents: List[dict]):
+        # Already stored: a failure here must not make the replay look failed
+        if self.on_replayed is None:
+            return
+        try:
+            self.on_replayed(documents)
+        except Exception as e:
+            events.error("history replay callback error", documents=len(documents), error=e)
+
+    def _replay(self):
+        """Write one chunk of spooled documents back to Mongo; when half-open the replay is the probe"""
+        collection = self.collection_getter()
+        if collection is None or not self.spool.pending() or not self.breaker.allow():
+            return
+        started = time.perf_counter()
+        try:
+            with pymongo.timeout(self.write_timeout):
+                replayed = self.spool.replay(collection, self.replay_batch_size, on_stored=self._replayed)
+        except Exception as e:
+            self.breaker.record(False)
+            events.error("history spool replay error", error=e)
+            return
+        self.breaker.record(True, time.perf_counter() - started)
@@ -1,7 +1,303 @@
 import os, sys
+import gzip
+import hashlib
+import itertools
+import json
+import queue
+import threading
+import time
 import logging
-from loki_logger_handler.loki_logger_handler import LokiLoggerHandler
+from array import array
+from typing import Optional
+from logging.handlers import QueueHandler, QueueListener
 
+import requests
+
+from metrics import (
+    LOG_RECORDS_DROPPED,
+    LOG_RECORDS_QUEUED,
+    LOG_RECORDS_SHIPPED,
+    LOG_SHIP_ERRORS,
+)
+
+# ==================== CONFIGURATION ====================
+LOKI_URL = os.getenv("LOKI_URL", "http://loki:3100/loki/api/v1/push")
+LOKI_LABELS = {"application": "FastApi"}
+LOKI_BATCH_SIZE = int(os.getenv("LOKI_BATCH_SIZE", "500"))
+LOKI_FLUSH_INTERVAL_MS = int(os.getenv("LOKI_FLUSH_INTERVAL_MS", "1000"))
+LOKI_TIMEOUT_SECONDS = float(os.getenv("LOKI_TIMEOUT_SECONDS", "5"))
+# Records waiting to be shipped; when full, LOG_DROP_POLICY decides what is lost
+LOG_QUEUE_MAX_SIZE = int(os.getenv("LOG_QUEUE_MAX_SIZE", "10000"))
+LOG_DROP_POLICY = os.getenv("LOG_DROP_POLICY", "drop_newest")  # drop_newest | drop_oldest
+# Successful (INFO) events are logged 1 in N per event name; warnings and errors always are
+LOG_SUCCESS_SAMPLE_RATE = int(os.getenv("LOG_SUCCESS_SAMPLE_RATE", "1"))
+# Operand lists longer than this are logged as their first values, count and hash
+LOG_OPERANDS_MAX = int(os.getenv("LOG_OPERANDS_MAX", "8"))
+LOG_FIELD_MAX_CHARS = int(os.getenv("LOG_FIELD_MAX_CHARS", "256"))
+
+# ==================== NON-BLOCKING QUEUE HANDLER ====================
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks the caller; drops records when the queue is full.
+
+    Records are queued unformatted: the listener thread formats the ones it
+    ships, and a dropped record is never formatted at all.
+    """
+
+    def __init__(self, log_queue: queue.Queue, drop_policy: str = "drop_newest",
+                 drop_reason: Optional[str] = None, report_queued: bool = True):
+        if drop_policy not in ("drop_newest", "drop_oldest"):
+            raise ValueError(f"Unknown log drop policy: {drop_policy}")
+        super().__init__(log_queue)
+        self.drop_policy = drop_policy
+        self._dropped = LOG_RECORDS_DROPPED.labels(drop_reason or drop_policy)
+        # log_records_queued is the Loki queue's depth
+        self.report_queued = report_queued
+
+    def prepare(self, record):
+        # QueueHandler.prepare formats on the calling thread; the shipper calls getMessage() itself
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._dropped.inc()
+            if self.drop_policy == "drop_oldest":
+                try:
+                    self.queue.get_nowait()
+                    self.queue.put_nowait(record)
+                except (queue.Empty, queue.Full):
+                    pass
+        if self.report_queued:
+            LOG_RECORDS_QUEUED.set(self.queue.qsize())
+
+# ==================== BACKGROUND CONSOLE ====================
+class BackgroundConsole:
+    """Console output written by a listener thread while the app runs.
+
+    start() swaps the logger's console handler for a queue handler, so request
+    threads only enqueue records and the listener formats and writes them;
+    stop() swaps back and writes what is still queued. Outside the app (CLI
+    scripts, tests) the console handler stays synchronous.
+    """
+
+    def __init__(self, logger: logging.Logger, handler: logging.Handler, max_size: int,
+                 drop_policy: str = "drop_newest"):
+        self.logger = logger
+        self.handler = handler
+        self.queue_handler = DroppingQueueHandler(
+            queue.Queue(maxsize=max_size), drop_policy, drop_reason="console", report_queued=False
+        )
+        self.queue_handler.setLevel(handler.level)
+        self._listener = None
+
+    @property
+    def running(self) -> bool:
+        return self._listener is not None
+
+    def start(self):
+        if self._listener is not None:
+            return
+        self._listener = QueueListener(self.queue_handler.queue, self.handler, respect_handler_level=True)
+        self._listener.start()
+        self.logger.addHandler(self.queue_handler)
+        self.logger.removeHandler(self.handler)
+
+    def stop(self):
+        if self._listener is None:
+            return
+        self.logger.addHandler(self.handler)
+        self.logger.removeHandler(self.queue_handler)
+        try:
+            self._listener.stop()
+        except queue.Full:
+            # No room for the stop sentinel: the daemon listener keeps draining until exit
+            pass
+        self._listener = None
+
+# ==================== STRUCTURED EVENTS ====================
+def format_operands(values, max_operands: int) -> str:
+    """An operand list, truncated to max_operands with its count and a hash of every value"""
+    count = len(values)
+    if count <= max_operands:
+        return str(list(values))
+    try:
+        data = array("d", values).tobytes()
+    except (TypeError, ValueError):
+        data = repr(values).encode()
+    head = ", ".join(str(value) for value in list(values[:max_operands]))
+    digest = hashlib.blake2b(data, digest_size=8).hexdigest()
+    return f"[{head}, ...] (count={count}, hash={digest})"
+
+def format_field(value, max_operands: int, max_chars: int) -> str:
+    if isinstance(value, (list, tuple)) or getattr(value, "ndim", 0) > 0:
+        return format_operands(value, max_operands)
+    text = str(value)
+    if len(text) > max_chars:
+        return f"{text[:max_chars]}... ({len(text)} chars)"
+    return text
+
+class EventMessage:
+    """Log message formatted only when a handler needs it, with bounded field sizes"""
+
+    __slots__ = ("event", "fields", "max_operands", "max_chars")
+
+    def __init__(self, event: str, fields: dict, max_operands: int, max_chars: int):
+        self.event = event
+        self.fields = fields
+        self.max_operands = max_operands
+        self.max_chars = max_chars
+
+    def __str__(self):
+        fields = ", ".join(
+            f"{name}={format_field(value, self.max_operands, self.max_chars)}" for name, value in self.fields.items()
+        )
+        return f"{self.event}: {fields}" if fields else self.event
+
+class EventLogger:
+    """Structured events on top of a logger: lazy formatting and sampled successes.
+
+    info() events are sampled 1 in sample_rate per event name, so a hot success
+    path logs a steady fraction of its calls; warning() and error() always log.
+    Nothing is formatted for events below the logger level or sampled out.
+    """
+
+    def __init__(self, logger: logging.Logger, sample_rate: int = 1,
+                 max_operands: int = 8, max_chars: int = 256):
+        self.logger = logger
+        self.sample_rate = max(sample_rate, 1)
+        self.max_operands = max_operands
+        self.max_chars = max_chars
+        self._counters = {}
+        self._sampled_out = LOG_RECORDS_DROPPED.labels("sampled")
+
+    def sampled(self, event: str) -> bool:
+        if self.sample_rate == 1:
+            return True
+        counter = self._counters.get(event)
+        if counter is None:
+            counter = self._counters.setdefault(event, itertools.count())
+        if next(counter) % self.sample_rate == 0:
+            return True
+        self._sampled_out.inc()
+        return False
+
+    def log(self, level: int, event: str, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        message = EventMessage(event, fields, self.max_operands, self.max_chars)
+        # stacklevel points module/function at the caller of info()/warning()/error()
+        self.logger.log(level, message, extra={"event": event}, stacklevel=3)
+
+    def info(self, event: str, **fields):
+        if self.logger.isEnabledFor(logging.INFO) and self.sampled(event):
+            self.log(logging.INFO, event, **fields)
+
+    def warning(self, event: str, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event: str, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+# ==================== LOKI SHIPPER ====================
+class LokiShipper:
+    """Background listener that ships queued records to Loki in gzip-compressed batches"""
+
+    def __init__(self, log_queue: queue.Queue, url: str, labels: dict,
+                 batch_size: int = 500, flush_interval: float = 1.0, timeout: float = 5.0):
+        self.queue = log_queue
+        self.url = url
+        self.labels = labels
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.session = requests.Session()
+        # None until the first push; then whether the latest push reached Loki
+        self.last_push_ok = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="loki-shipper", daemon=True)
+        self._thread.start()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def health(self) -> dict:
+        """Shipper state for the readiness endpoint"""
+        if not self.running:
+            return {"status": "stopped"}
+        status = {None: "idle", True: "ok", False: "failing"}[self.last_push_ok]
+        return {"status": status, "queued": self.queue.qsize()}
+
+    def stop(self, timeout: float = 5.0):
+        """Ship what is left in the queue and stop the listener"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch:
+                self._push(batch)
+            elif self._stop_event.is_set():
+                return
+
+    def _collect_batch(self):
+        """Gather records until batch_size is reached or flush_interval elapses"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = 0 if self._stop_event.is_set() else deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        LOG_RECORDS_QUEUED.set(self.queue.qsize())
+        return batch
+
+    def _push(self, records):
+        """Send one batch as a single gzip-compressed push request"""
+        values = []
+        for record in records:
+            line = json.dumps({
+                "message": record.getMessage(),
+                "level": record.levelname,
+                "name": record.name,
+                "module": record.module,
+                "function": record.funcName,
+                "event": getattr(record, "event", None),
+            })
+            values.append([str(int(record.created * 1e9)), line])
+        payload = json.dumps({"streams": [{"stream": self.labels, "values": values}]})
+        try:
+            response = self.session.post(
+                self.url,
+                data=gzip.compress(payload.encode("utf-8")),
+                headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            self.last_push_ok = True
+            LOG_RECORDS_SHIPPED.inc(len(records))
+        except requests.RequestException:
+            self.last_push_ok = False
+            # Loki is unavailable: the batch is dropped, the console handler still has it
+            LOG_SHIP_ERRORS.inc()
+            LOG_RECORDS_DROPPED.labels("ship_error").inc(len(records))
+
+# ==================== LOGGER SETUP ====================
 # Set up logging
 logger = logging.getLogger("custom_logger")
 logging_data = os.getenv("LOG_LEVEL", "INFO").upper()
@@ -19,14 +315,27 @@ formatter = logging.Formatter(
 )
 console_handler.setFormatter(formatter)
 
-# Create an instance of the custom handler
-loki_handler = LokiLoggerHandler(
-    url="http://loki:3100/loki/api/v1/push",
-    labels={"application": "FastApi"},
-    label_keys={},
-    timeout=10,
+# Loki records go through a bounded queue and are shipped by a background thread.
+# Nothing connects at import: the app starts the shipper in its lifespan
+log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX_SIZE)
+queue_handler = DroppingQueueHandler(log_queue, LOG_DROP_POLICY)
+loki_shipper = LokiShipper(
+    log_queue,
+    LOKI_URL,
+    LOKI_LABELS,
+    batch_size=LOKI_BATCH_SIZE,
+    flush_interval=LOKI_FLUSH_INTERVAL_MS / 1000,
+    timeout=LOKI_TIMEOUT_SECONDS,
 )
 
-logger.addHandler(loki_handler)
+logger.addHandler(queue_handler)
 logger.addHandler(console_handler)
-logger.info("Logger initialized")
+# Started by the app's lifespan: request threads then only enqueue console records
+background_console = BackgroundConsole(logger, console_handler, LOG_QUEUE_MAX_SIZE, LOG_DROP_POLICY)
+
+events = EventLogger(
+    logger,
+    sample_rate=LOG_SUCCESS_SAMPLE_RATE,
+    max_operands=LOG_OPERANDS_MAX,
+    max_chars=LOG_FIELD_MAX_CHARS,
+)
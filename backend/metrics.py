@@ -0,0 +1,174 @@
+# ==================== IMPORTS ====================
+import os
+
+from prometheus_client import Counter, Gauge, Histogram, multiprocess
+
+# ==================== MULTIPROCESS MODE ====================
+# Set by serve.py when running several workers; each worker writes its samples to files there
+MULTIPROCESS_MODE = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+def mark_worker_stopped():
+    """Remove this worker's live gauges from the multiprocess totals"""
+    if MULTIPROCESS_MODE:
+        multiprocess.mark_process_dead(os.getpid())
+
+# ==================== HISTORY WRITER METRICS ====================
+HISTORY_QUEUE_DEPTH = Gauge(
+    "history_writer_queue_depth",
+    "History documents waiting in the write-behind queue",
+    multiprocess_mode="livesum",
+)
+HISTORY_FLUSH_SECONDS = Histogram(
+    "history_writer_flush_seconds",
+    "Time spent writing one batch of history documents",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+HISTORY_LAST_FLUSH_SECONDS = Gauge(
+    "history_writer_last_flush_seconds",
+    "Duration of the most recent history batch write",
+    multiprocess_mode="mostrecent",
+)
+HISTORY_FLUSHED_DOCUMENTS = Counter(
+    "history_writer_flushed_documents_total",
+    "History documents written by the write-behind flusher",
+)
+HISTORY_FLUSH_ERRORS = Counter(
+    "history_writer_flush_errors_total",
+    "History batch writes that failed",
+)
+HISTORY_BACKPRESSURE = Counter(
+    "history_writer_backpressure_total",
+    "Submissions written inline because the history queue was full",
+)
+HISTORY_BREAKER_STATE = Gauge(
+    "history_writer_breaker_state",
+    "History write circuit breaker: 0 closed, 1 half-open, 2 open",
+    multiprocess_mode="livemax",
+)
+# Every worker sees the same spool directory, so the values are not summed
+HISTORY_SPOOL_BYTES = Gauge(
+    "history_spool_bytes",
+    "Bytes of history waiting in the local spool",
+    multiprocess_mode="livemax",
+)
+HISTORY_SPOOL_REPLAY_LAG_SECONDS = Gauge(
+    "history_spool_replay_lag_seconds",
+    "Age of the oldest spooled history not yet replayed to Mongo",
+    multiprocess_mode="livemax",
+)
+HISTORY_SPOOLED_DOCUMENTS = Counter(
+    "history_spooled_documents_total",
+    "History documents written to the local spool instead of Mongo",
+)
+HISTORY_SPOOL_REPLAYED_DOCUMENTS = Counter(
+    "history_spool_replayed_documents_total",
+    "Spooled history documents replayed to Mongo",
+)
+HISTORY_ARCHIVED_DOCUMENTS = Counter(
+    "history_archived_documents_total",
+    "History documents moved from Mongo to the local archive",
+)
+HISTORY_ARCHIVE_ERRORS = Counter(
+    "history_archive_errors_total",
+    "Archive passes that failed",
+)
+# Compaction ratio: operations / entries
+HISTORY_COMPACTION_OPERATIONS = Counter(
+    "history_compaction_operations_total",
+    "Operations written through history compaction",
+)
+HISTORY_COMPACTION_ENTRIES = Counter(
+    "history_compaction_entries_total",
+    "New compacted history entries stored",
+)
+
+# ==================== RESULT CACHE METRICS ====================
+RESULT_CACHE_HITS = Counter(
+    "calculator_result_cache_hits_total",
+    "Calculator results served from the result cache",
+    ["operation"],
+)
+RESULT_CACHE_MISSES = Counter(
+    "calculator_result_cache_misses_total",
+    "Calculator results that had to be computed",
+    ["operation"],
+)
+RESULT_CACHE_EVICTIONS = Counter(
+    "calculator_result_cache_evictions_total",
+    "Result cache entries evicted",
+    ["reason"],
+)
+RESULT_CACHE_ENTRIES = Gauge(
+    "calculator_result_cache_entries",
+    "Entries currently held by the result cache",
+    multiprocess_mode="livesum",
+)
+
+# ==================== LOG SHIPPING METRICS ====================
+LOG_RECORDS_QUEUED = Gauge(
+    "log_records_queued",
+    "Log records waiting to be shipped to Loki",
+    multiprocess_mode="livesum",
+)
+LOG_RECORDS_DROPPED = Counter(
+    "log_records_dropped_total",
+    "Log records that were not shipped to Loki",
+    ["reason"],
+)
+LOG_RECORDS_SHIPPED = Counter(
+    "log_records_shipped_total",
+    "Log records shipped to Loki",
+)
+LOG_SHIP_ERRORS = Counter(
+    "log_ship_errors_total",
+    "Loki push requests that failed",
+)
+
+# ==================== REQUEST STAGE METRICS ====================
+# Labels only take values from fixed sets (stage names, canonical operations,
+# "batch", "history", "history_stats") so cardinality stays bounded
+STAGE_SECONDS = Histogram(
+    "calculator_stage_seconds",
+    "Time spent in each stage of a request",
+    ["stage", "operation"],
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+             0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+BATCH_SIZE = Histogram(
+    "calculator_batch_size",
+    "Operations per batch request",
+    ["engine"],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000),
+)
+OPERAND_COUNT = Histogram(
+    "calculator_operand_count",
+    "Operands per calculator request",
+    ["operation"],
+    buckets=(2, 3, 4, 8, 16, 32, 64, 128, 256, 1024, 4096),
+)
+
+# ==================== ADMISSION CONTROL METRICS ====================
+# route takes the fixed limiter names configured in main.py
+ADMISSION_QUEUE_SECONDS = Histogram(
+    "admission_queue_seconds",
+    "Time admitted requests waited for a concurrency slot",
+    ["route"],
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+ADMISSION_SHED = Counter(
+    "admission_shed_total",
+    "Requests answered with 503 instead of being admitted",
+    ["route", "reason"],
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "admission_in_flight",
+    "Concurrency units in use (requests, or operations for batch costs)",
+    ["route"],
+    multiprocess_mode="livesum",
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "admission_queue_depth",
+    "Requests waiting for a concurrency slot",
+    ["route"],
+    multiprocess_mode="livesum",
+)
@@ -0,0 +1,306 @@
+# ==================== IMPORTS ====================
+import heapq
+import hmac
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+PROFILE_FORMATS = ("collapsed", "speedscope")
+
+# ==================== STACKS ====================
+# (function, file, first line): function-level frames aggregate better than line-level ones
+FrameKey = Tuple[str, str, int]
+
+class Sample(NamedTuple):
+    timestamp: float
+    thread: str
+    stack: Tuple[FrameKey, ...]  # root first
+
+# Code objects seen by the samplers; cleared when full, since code created at
+# runtime (exec, lambdas in generated code) would otherwise accumulate forever
+FRAME_KEYS_MAX = 65536
+_frame_keys: Dict[object, FrameKey] = {}
+
+def frame_key(code) -> FrameKey:
+    key = _frame_keys.get(code)
+    if key is None:
+        if len(_frame_keys) >= FRAME_KEYS_MAX:
+            _frame_keys.clear()
+        key = _frame_keys.setdefault(code, (code.co_name, code.co_filename, code.co_firstlineno))
+    return key
+
+def frame_stack(frame) -> Tuple[FrameKey, ...]:
+    stack = []
+    while frame is not None:
+        stack.append(frame_key(frame.f_code))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+# ==================== PROFILE ====================
+class Profile:
+    """Stack samples of one profiling session, exportable for flamegraph tools"""
+
+    def __init__(self, samples: List[Sample], interval: float, started: float, ended: float, **info):
+        self.samples = samples
+        self.interval = interval
+        self.started = started
+        self.ended = ended
+        self.info = info
+
+    def summary(self) -> dict:
+        return dict(self.info, samples=len(self.samples), seconds=round(self.ended - self.started, 6))
+
+    def collapsed(self) -> str:
+        """Brendan Gregg's collapsed-stack format: `thread;root;...;leaf count` per line"""
+        counts = {}
+        for sample in self.samples:
+            frames = [sample.thread.replace(";", ",")] + [
+                f"{name} ({os.path.basename(filename)}:{line})" for name, filename, line in sample.stack
+            ]
+            line = ";".join(frames)
+            counts[line] = counts.get(line, 0) + 1
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+    def speedscope(self) -> dict:
+        """speedscope's sampled-profile file format, one profile per thread"""
+        frames = []
+        frame_index = {}
+        threads = {}
+        for sample in self.samples:
+            indexes = []
+            for key in sample.stack:
+                if key not in frame_index:
+                    frame_index[key] = len(frames)
+                    frames.append({"name": key[0], "file": key[1], "line": key[2]})
+                indexes.append(frame_index[key])
+            threads.setdefault(sample.thread, []).append(indexes)
+        duration = self.ended - self.started
+        # A sampler competing for the GIL ticks slower than asked; weigh by the measured tick
+        ticks = len({sample.timestamp for sample in self.samples})
+        weight = duration / ticks if ticks else self.interval
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": self.info.get("name", "profile"),
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": thread,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": duration,
+                    "samples": stacks,
+                    "weights": [weight] * len(stacks),
+                }
+                for thread, stacks in threads.items()
+            ],
+        }
+
+# ==================== SAMPLER ====================
+class StackSampler:
+    """Background thread that records the Python stacks of other threads every interval.
+
+    Sampling only reads sys._current_frames(), so the profiled threads are
+    never interrupted; the cost is one stack walk per thread and sample.
+    thread_filter picks the threads by name (all of them by default).
+    """
+
+    def __init__(self, interval: float = 0.005, max_samples: int = 100000,
+                 thread_filter: Optional[Callable[[str], bool]] = None):
+        self.interval = interval
+        self.thread_filter = thread_filter
+        self.samples = deque(maxlen=max_samples)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.started = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self, wait: bool = True):
+        """Stop sampling; without wait the thread exits on its own within one interval.
+
+        profile() filters samples by time, so a sample taken after the stop
+        signal never makes it into a profile that ended before.
+        """
+        self._stop_event.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            now = time.monotonic()
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, str(ident))
+                if ident == own or (self.thread_filter and not self.thread_filter(name)):
+                    continue
+                self.samples.append(Sample(now, name, frame_stack(frame)))
+
+    def profile(self, started: Optional[float] = None, ended: Optional[float] = None, **info) -> Profile:
+        """Samples taken between started and ended (the whole session by default)"""
+        started = self.started if started is None else started
+        ended = time.monotonic() if ended is None else ended
+        # Copied first: the sampler thread keeps appending
+        samples = [sample for sample in list(self.samples) if started <= sample.timestamp <= ended]
+        return Profile(samples, self.interval, started, ended, **info)
+
+def request_threads(name: str) -> bool:
+    """Threads that run request code: the event loop and the threadpool"""
+    return name == "MainThread" or name.startswith("AnyIO worker")
+
+# ==================== PROFILE STORE ====================
+# Shared by every store, so ids stay unique across them
+_profile_ids = itertools.count(1)
+
+class ProfileStore:
+    """Ring buffer of the most recent profiles, by id"""
+
+    def __init__(self, max_profiles: int = 20):
+        self.max_profiles = max_profiles
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def new_id(self) -> str:
+        return f"{os.getpid()}-{next(_profile_ids)}"
+
+    def add(self, profile_id: str, profile: Profile):
+        with self._lock:
+            self._profiles[profile_id] = profile
+            while len(self._profiles) > self.max_profiles:
+                self._profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[Profile]:
+        return self._profiles.get(profile_id)
+
+    def summaries(self) -> List[dict]:
+        with self._lock:
+            return [dict(profile.summary(), id=profile_id) for profile_id, profile in reversed(self._profiles.items())]
+
+class SlowProfileStore(ProfileStore):
+    """The max_profiles slowest captures, kept in a min-heap on their duration.
+
+    Separate from the requested profiles, so a burst of slow requests never
+    evicts a profile an operator asked for.
+    """
+
+    def __init__(self, max_profiles: int = 20):
+        super().__init__(max_profiles)
+        self._heap = []  # (duration_ms, profile id), fastest first
+
+    def keeps(self, duration_ms: float) -> bool:
+        """Whether a capture this slow would be stored (checked before building it)"""
+        return len(self._heap) < self.max_profiles or duration_ms > self._heap[0][0]
+
+    def add(self, profile_id: str, profile: Profile):
+        entry = (profile.info.get("duration_ms", 0.0), profile_id)
+        with self._lock:
+            if len(self._heap) < self.max_profiles:
+                heapq.heappush(self._heap, entry)
+            elif entry > self._heap[0]:
+                _, evicted = heapq.heapreplace(self._heap, entry)
+                del self._profiles[evicted]
+            else:
+                return
+            self._profiles[profile_id] = profile
+
+    def summaries(self) -> List[dict]:
+        """Slowest first"""
+        with self._lock:
+            return [dict(self._profiles[profile_id].summary(), id=profile_id)
+                    for _, profile_id in sorted(self._heap, reverse=True)]
+
+# ==================== MIDDLEWARE ====================
+PROFILE_HEADER = b"x-profile"
+TOKEN_HEADER = b"x-admin-token"
+
+def token_matches(given, token: str) -> bool:
+    """Constant-time comparison of a header (str or raw bytes) with the admin token"""
+    if isinstance(given, str):
+        given = given.encode("latin-1", "replace")
+    return hmac.compare_digest(given, token.encode("latin-1", "replace"))
+
+class ProfilerMiddleware:
+    """ASGI middleware for per-request profiles and slow-request capture.
+
+    A request sent with `X-Profile: 1` and the admin token is sampled while it
+    runs; the profile id comes back in the X-Profile-Id header. With a
+    slow_seconds threshold, the continuously running slow_sampler provides
+    the stacks of every request that takes longer; those go to slow_store,
+    which keeps the slowest ones. The worker's threads are shared, so a
+    profile also shows whatever ran concurrently with the request.
+    """
+
+    def __init__(self, app, store: ProfileStore, admin_token: Callable[[], str], interval: float = 0.005,
+                 slow_sampler: Optional[StackSampler] = None, slow_seconds: float = 0.0,
+                 slow_store: Optional[SlowProfileStore] = None):
+        self.app = app
+        self.store = store
+        self.admin_token = admin_token
+        self.interval = interval
+        self.slow_sampler = slow_sampler
+        self.slow_seconds = slow_seconds
+        self.slow_store = slow_store if slow_store is not None else SlowProfileStore(store.max_profiles)
+
+    def requested(self, scope) -> bool:
+        headers = dict(scope.get("headers") or [])
+        token = self.admin_token()
+        return bool(
+            token and headers.get(PROFILE_HEADER, b"") not in (b"", b"0")
+            and token_matches(headers.get(TOKEN_HEADER, b""), token)
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        sampler = None
+        profile_id = None
+        if self.requested(scope):
+            sampler = StackSampler(self.interval, thread_filter=request_threads)
+            profile_id = self.store.new_id()
+        slow = self.slow_seconds > 0 and self.slow_sampler is not None and self.slow_sampler.running
+        status = []
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+                if profile_id:
+                    message = dict(message, headers=list(message.get("headers", [])) + [
+                        (b"x-profile-id", profile_id.encode()),
+                    ])
+            await send(message)
+
+        started = time.monotonic()
+        if sampler:
+            sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            ended = time.monotonic()
+            info = dict(method=scope["method"], path=scope["path"], status=status[0] if status else None,
+                        duration_ms=round((ended - started) * 1000, 3))
+            if sampler:
+                # Not joined: this runs on the event loop
+                sampler.stop(wait=False)
+                self.store.add(profile_id, sampler.profile(started, ended, kind="request", name=scope["path"], **info))
+            elif slow and ended - started >= self.slow_seconds and self.slow_store.keeps(info["duration_ms"]):
+                self.slow_store.add(self.slow_store.new_id(),
+                                    self.slow_sampler.profile(started, ended, kind="slow", name=scope["path"], **info))
@@ -0,0 +1,66 @@
+# ==================== IMPORTS ====================
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+from metrics import (
+    RESULT_CACHE_ENTRIES,
+    RESULT_CACHE_EVICTIONS,
+    RESULT_CACHE_HITS,
+    RESULT_CACHE_MISSES,
+)
+
+# ==================== RESULT CACHE ====================
+class ResultCache:
+    """Thread-safe LRU cache with an optional TTL for calculator outcomes"""
+
+    def __init__(self, max_entries: int = 10000, ttl: Optional[float] = None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: Hashable, label: str = "other") -> Tuple[bool, Any]:
+        """Return (hit, value); the label is only used for metrics"""
+        if not self.enabled:
+            return False, None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > self.clock():
+                    self._entries.move_to_end(key)
+                    RESULT_CACHE_HITS.labels(label).inc()
+                    return True, value
+                del self._entries[key]
+                RESULT_CACHE_EVICTIONS.labels("ttl").inc()
+                RESULT_CACHE_ENTRIES.set(len(self._entries))
+        RESULT_CACHE_MISSES.labels(label).inc()
+        return False, None
+
+    def put(self, key: Hashable, value: Any):
+        """Store a value, evicting the least recently used entries when full"""
+        if not self.enabled:
+            return
+        expires_at = self.clock() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                RESULT_CACHE_EVICTIONS.labels("size").inc()
+            RESULT_CACHE_ENTRIES.set(len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            RESULT_CACHE_ENTRIES.set(0)
+
+    def __len__(self):
+        return len(self._entries)
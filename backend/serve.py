@@ -0,0 +1,56 @@
+"""Serve the API with uvicorn, with one or more worker processes.
+
+Each worker is a separate process that imports main and opens its own Mongo
+clients in the lifespan. With more than one worker, Prometheus metrics are
+collected in multiprocess mode and /metrics on any worker reports the sum.
+
+Usage (from backend/):
+    WEB_CONCURRENCY=4 python serve.py
+"""
+# ==================== IMPORTS ====================
+import os
+import shutil
+from typing import Optional
+
+import uvicorn
+
+# ==================== CONFIGURATION ====================
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Recycle a worker after this many requests (0 = never); the jitter spreads the restarts
+WORKER_MAX_REQUESTS = int(os.getenv("WORKER_MAX_REQUESTS", "0"))
+WORKER_MAX_REQUESTS_JITTER = int(os.getenv("WORKER_MAX_REQUESTS_JITTER", "0"))
+# Seconds in-flight requests get to finish when a worker stops; queued history is drained afterwards
+WORKER_GRACEFUL_TIMEOUT = int(os.getenv("WORKER_GRACEFUL_TIMEOUT", "30"))
+DEFAULT_MULTIPROC_DIR = "/tmp/prometheus-multiproc"
+
+# ==================== PROMETHEUS MULTIPROCESS ====================
+def prepare_multiprocess_dir(workers: int) -> Optional[str]:
+    """Create an empty directory for per-worker metric files and export it to the workers"""
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if workers <= 1 and path is None:
+        return None
+    path = path or DEFAULT_MULTIPROC_DIR
+    # Files left by a previous run would be added to the new counters
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    # Must be set before the workers import prometheus_client
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    return path
+
+# ==================== MAIN ====================
+def main_cli():
+    prepare_multiprocess_dir(WEB_CONCURRENCY)
+    uvicorn.run(
+        "main:app",
+        host=HOST,
+        port=PORT,
+        workers=WEB_CONCURRENCY,
+        limit_max_requests=WORKER_MAX_REQUESTS or None,
+        limit_max_requests_jitter=WORKER_MAX_REQUESTS_JITTER,
+        timeout_graceful_shutdown=WORKER_GRACEFUL_TIMEOUT,
+    )
+
+if __name__ == "__main__":
+    main_cli()
@@ -3,9 +3,43 @@ from fastapi import FastAPI
 from fastapi.testclient import TestClient
 import pytest
 import mongomock
+from pymongo import ReplaceOne, UpdateOne
+from bson import ObjectId
+import io
+import os
+import time
 import json
+import gzip
+import queue
+import asyncio
+import threading
+import logging
+import datetime
+import numpy as np
 
 import main
+import serve
+import fast_response
+from history_writer import HistoryWriter, DURABILITY_ACKNOWLEDGED
+from batch_engine import evaluate_batch
+from result_cache import ResultCache
+from logger_config import BackgroundConsole, DroppingQueueHandler, EventLogger, LokiShipper, logger as app_logger
+from history_schema import build_history_document, build_history_error_document, object_ids
+from history_stats import history_stats
+import history_archive
+from history_archive import HistoryArchiver, append_day, archive_days, find_archived_documents
+from history_query import encode_cursor
+from history_spool import HistorySpool, read_documents
+from history_compaction import CompactingCollection, compaction_summary
+from history_events import RecentIds
+from history_repository import HistoryRepository, MemoryHistoryRepository, MongoHistoryRepository, SQLiteHistoryRepository
+from circuit_breaker import CircuitBreaker
+from admission import AdmissionLimiter, RequestShed
+import profiler
+from profiler import ProfilerMiddleware, ProfileStore, SlowProfileStore, StackSampler
+from pymongo.errors import AutoReconnect, OperationFailure
+from pymongo.results import BulkWriteResult
+from migrate_history import migrate_history
 
 # ==================== TEST SETUP ====================
 client = TestClient(main.app)
@@ -229,4 +263,1654 @@ def test_history(monkeypatch):
     monkeypatch.setattr(main, "collection_historial", collection_historial)
 
     response = client.get("/calculator/history")
-    assert response.status_code == 200
\ No newline at end of file
+    assert response.status_code == 200
+
+
+# ==================== HISTORY WRITER TESTS ====================
+
+def test_history_writer_batches_documents():
+    """Test that queued history documents are written with insert_many"""
+    writer_collection = mongomock.MongoClient().practica1.historial
+    writer = HistoryWriter(lambda: writer_collection, batch_size=10, flush_interval=0.01)
+
+    for i in range(25):
+        writer.submit({"numbers": [i, i], "result": i * 2, "operation": "sum"})
+    writer.flush()
+    writer.stop()
+
+    assert writer_collection.count_documents({}) == 25
+
+def test_history_writer_acknowledged_mode():
+    """Test that acknowledged durability resolves after the write"""
+    writer_collection = mongomock.MongoClient().practica1.historial
+    writer = HistoryWriter(
+        lambda: writer_collection,
+        flush_interval=0.01,
+        durability=DURABILITY_ACKNOWLEDGED,
+    )
+
+    pending = writer.submit_many([{"operation": "sum"}, {"operation": "division"}])
+
+    assert pending.result(timeout=5) == 2
+    assert writer_collection.count_documents({}) == 2
+    writer.stop()
+
+def test_history_writer_backpressure_writes_inline():
+    """Test that a full queue falls back to writing on the caller thread"""
+    writer_collection = mongomock.MongoClient().practica1.historial
+    writer = HistoryWriter(lambda: writer_collection, max_queue_size=1, put_timeout=0)
+    # Fill the queue without a running flusher
+    writer._queue.put((writer_collection, [{"operation": "sum"}], None))
+    writer.start = lambda: None
+
+    writer.submit({"operation": "division"})
+
+    assert writer_collection.count_documents({"operation": "division"}) == 1
+
+def test_batch_history_single_write(monkeypatch):
+    """Test that a batch request is saved to history in one write"""
+    batch_collection = mongomock.MongoClient().practica1.historial
+    monkeypatch.setattr(main, "collection_historial", batch_collection)
+
+    payload = [
+        {"operation": "sum", "numbers": [1, 2]},
+        {"operation": "div", "numbers": [1, 0]},
+        {"operation": "mul", "numbers": [3, 4]},
+    ]
+    response = client.post("/calculator/batch", json=payload)
+    main.history_writer.flush()
+
+    assert response.status_code == 200
+    assert batch_collection.count_documents({"status": "ok"}) == 2
+    assert batch_collection.count_documents({"status": "error"}) == 1
+
+# ==================== HISTORY PAGINATION TESTS ====================
+
+def seed_history(collection, count):
+    """Insert count sum documents with increasing results"""
+    collection.insert_many([
+        {"numbers": [i, 1], "result": i + 1, "operation": "sum", "date": "22/09/2025 10:00"}
+        for i in range(count)
+    ])
+
+def test_history_cursor_pagination(monkeypatch):
+    """Test that cursor pages cover the history once, newest first"""
+    page_collection = mongomock.MongoClient().practica1.historial
+    seed_history(page_collection, 7)
+    monkeypatch.setattr(main, "collection_historial", page_collection)
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 3}
+        if cursor:
+            params["cursor"] = cursor
+        data = client.get("/calculator/history", params=params).json()
+        seen.extend(item["result"] for item in data["history"])
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+
+    assert seen == [7, 6, 5, 4, 3, 2, 1]
+
+def test_history_filter_and_sort_by_result(monkeypatch):
+    """Test server-side operation filter and result ordering"""
+    page_collection = mongomock.MongoClient().practica1.historial
+    seed_history(page_collection, 3)
+    page_collection.insert_many([
+        {"numbers": [4, 2], "result": 2.0, "operation": "division", "date": "22/09/2025 10:00"},
+        {"a": 9, "b": 3, "result": 3.0, "operation": "div", "date": "22/09/2025 10:00"},
+    ])
+    monkeypatch.setattr(main, "collection_historial", page_collection)
+
+    response = client.get(
+        "/calculator/history",
+        params={"operation": "divide", "sort_by": "result", "order": "asc", "limit": 1},
+    )
+    data = response.json()
+    assert response.status_code == 200
+    assert [item["result"] for item in data["history"]] == [2.0]
+
+    response = client.get(
+        "/calculator/history",
+        params={"operation": "divide", "sort_by": "result", "order": "asc", "cursor": data["next_cursor"]},
+    )
+    assert [item["result"] for item in response.json()["history"]] == [3.0]
+
+def test_history_invalid_cursor(monkeypatch):
+    """Test that a malformed cursor is rejected"""
+    monkeypatch.setattr(main, "collection_historial", collection_historial)
+
+    response = client.get("/calculator/history?cursor=not-a-cursor")
+
+    assert response.status_code == 400
+    assert response.json()["error"] == "Invalid cursor"
+
+# ==================== VECTORIZED BATCH TESTS ====================
+
+MIXED_BATCH = [
+    {"operation": "sum", "numbers": [1, 2]},
+    {"operation": "sub", "numbers": [1, 5]},
+    {"operation": "mul", "numbers": [2.5, 4]},
+    {"operation": "div", "numbers": [10, 4]},
+    {"operation": "div", "numbers": [10, 0]},
+    {"operation": "sum", "numbers": [-1, 2]},
+    {"operation": "sum", "numbers": [1, 2, 3]},
+    {"operation": "pow", "numbers": [2, 3]},
+    {"operation": "pow", "numbers": [-2, 3]},
+]
+
+def test_vectorized_batch_matches_loop():
+    """Test that the columnar engine returns the same items as the per-item loop"""
+    operations = [main.BatchOperation(**item) for item in MIXED_BATCH * 3]
+
+    loop_results, loop_documents = main.batch_operations_loop(operations)
+    vector_results, vector_documents = evaluate_batch(operations, loop_documents[0]["created_at"])
+
+    # _id values are unique per document; everything else must match
+    strip_ids = lambda documents: [{k: v for k, v in d.items() if k != "_id"} for d in documents]
+    assert vector_results == loop_results
+    assert strip_ids(vector_documents) == strip_ids(loop_documents)
+
+def test_bulk_object_ids_are_distinct_and_stamped():
+    """Batch ObjectIds carry created_at's second and increase within the call"""
+    created_at = datetime.datetime(2025, 9, 21, 10, 0, 5, 123000, tzinfo=datetime.timezone.utc)
+
+    ids = object_ids(created_at, 1000)
+
+    assert len(set(ids)) == 1000 and ids == sorted(ids)
+    assert {object_id.generation_time for object_id in ids} == {created_at.replace(microsecond=0)}
+    assert set(ids).isdisjoint(object_ids(created_at, 1000))
+
+def test_vectorized_batch_endpoint(monkeypatch):
+    """Test a batch large enough to use the columnar engine"""
+    monkeypatch.setattr(main, "collection_historial", collection_historial)
+    monkeypatch.setattr(main, "BATCH_VECTORIZE_MIN_SIZE", 2)
+
+    response = client.post("/calculator/batch", json=MIXED_BATCH)
+
+    assert response.status_code == 200
+    data = response.json()
+    assert [item.get("result") for item in data[:4]] == [3.0, -4.0, 10.0, 2.5]
+    assert data[4]["error"] == "Division by zero"
+    assert data[5]["error"] == "Negative numbers are not allowed"
+    assert data[6] == {"operation": "sum", "error": "Exactly 2 numbers are required", "operands": [1.0, 2.0, 3.0]}
+    assert data[7]["error"] == "Unsupported operation"
+    assert data[8]["error"] == "Negative numbers are not allowed"
+
+# ==================== ASYNC DRIVER TESTS ====================
+
+class AsyncCursorStub:
+    """Minimal async cursor over a mongomock cursor"""
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self.cursor = self.cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, *args):
+        self.cursor = self.cursor.limit(*args)
+        return self
+
+    async def to_list(self, length=None):
+        return list(self.cursor)[:length]
+
+class AsyncCollectionStub:
+    """Minimal async collection over a mongomock collection"""
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        return AsyncCursorStub(self.collection.find(*args, **kwargs))
+
+    async def find_one(self, *args, **kwargs):
+        return self.collection.find_one(*args, **kwargs)
+
+def test_history_uses_async_collection(monkeypatch):
+    """Test that the history endpoint reads through the async driver when opened"""
+    async_collection = mongomock.MongoClient().practica1.historial
+    seed_history(async_collection, 4)
+    monkeypatch.setattr(main, "async_collection_historial", AsyncCollectionStub(async_collection))
+
+    response = client.get("/calculator/history?limit=2")
+
+    assert response.status_code == 200
+    assert [item["result"] for item in response.json()["history"]] == [4, 3]
+
+def test_mongo_client_options_from_env(monkeypatch):
+    """Test that pool and timeout settings are passed to the clients"""
+    monkeypatch.setattr(main, "MONGO_MAX_POOL_SIZE", 7)
+    monkeypatch.setattr(main, "MONGO_WAIT_QUEUE_TIMEOUT_MS", 150)
+
+    options = main.mongo_client_options()
+
+    assert options["maxPoolSize"] == 7
+    assert options["waitQueueTimeoutMS"] == 150
+
+# ==================== RESULT CACHE TESTS ====================
+
+def test_result_cache_lru_eviction():
+    """Test that the least recently used entry is evicted first"""
+    cache = ResultCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("a") == (True, 1)
+    assert cache.get("b") == (False, None)
+    assert cache.get("c") == (True, 3)
+
+def test_result_cache_ttl_expiry():
+    """Test that entries expire after the configured TTL"""
+    now = [100.0]
+    cache = ResultCache(max_entries=10, ttl=5, clock=lambda: now[0])
+    cache.put("a", 1)
+
+    assert cache.get("a") == (True, 1)
+    now[0] += 6
+    assert cache.get("a") == (False, None)
+    assert len(cache) == 0
+
+def test_cached_hit_skips_history_when_disabled(monkeypatch):
+    """Test that cache hits can skip the history write"""
+    cache_collection = mongomock.MongoClient().practica1.historial
+    monkeypatch.setattr(main, "collection_historial", cache_collection)
+    monkeypatch.setattr(main, "result_cache", ResultCache(max_entries=10))
+    monkeypatch.setattr(main, "RESULT_CACHE_WRITE_HISTORY_ON_HIT", False)
+
+    first = client.get("/calculator/multiply?numbers=6&numbers=7")
+    second = client.get("/calculator/multiply?numbers=6&numbers=7")
+    main.history_writer.flush()
+
+    assert first.json() == second.json() == {"numbers": [6.0, 7.0], "result": 42.0}
+    assert cache_collection.count_documents({}) == 1
+
+def test_cached_validation_error(monkeypatch):
+    """Test that cached validation errors keep their status code"""
+    monkeypatch.setattr(main, "collection_historial", collection_historial)
+    monkeypatch.setattr(main, "result_cache", ResultCache(max_entries=10))
+
+    for _ in range(2):
+        response = client.get("/calculator/divide?numbers=10&numbers=0")
+        assert response.status_code == 403
+        assert response.json()["error"] == "Division by zero"
+
+# ==================== LOG SHIPPING TESTS ====================
+
+def make_record(message):
+    """Build a log record for the logging pipeline tests"""
+    return logging.LogRecord("custom_logger", logging.INFO, __file__, 1, message, None, None)
+
+@pytest.mark.parametrize(
+    "policy, expected",
+    [
+        ("drop_newest", ["first", "second"]),
+        ("drop_oldest", ["second", "third"]),
+    ]
+)
+def test_queue_handler_drop_policy(policy, expected):
+    """Test that a full log queue drops records without blocking"""
+    log_queue = queue.Queue(maxsize=2)
+    handler = DroppingQueueHandler(log_queue, policy)
+
+    for message in ["first", "second", "third"]:
+        handler.handle(make_record(message))
+
+    assert [log_queue.get_nowait().getMessage() for _ in range(2)] == expected
+
+def test_loki_shipper_sends_gzip_batch():
+    """Test that queued records are pushed to Loki as one compressed batch"""
+    sent = []
+
+    class FakeResponse:
+        def raise_for_status(self):
+            pass
+
+    class FakeSession:
+        def post(self, url, data, headers, timeout):
+            sent.append((headers, json.loads(gzip.decompress(data))))
+            return FakeResponse()
+
+    log_queue = queue.Queue()
+    shipper = LokiShipper(log_queue, "http://loki", {"application": "test"}, batch_size=10, flush_interval=0.01)
+    shipper.session = FakeSession()
+    for i in range(3):
+        log_queue.put(make_record(f"message {i}"))
+
+    shipper._push(shipper._collect_batch())
+
+    headers, payload = sent[0]
+    assert headers["Content-Encoding"] == "gzip"
+    values = payload["streams"][0]["values"]
+    assert [json.loads(line)["message"] for _, line in values] == ["message 0", "message 1", "message 2"]
+
+class ListHandler(logging.Handler):
+    """Collects the formatted messages of the records it handles"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+def test_event_logger_samples_successes_and_bounds_fields():
+    """Test that successes are sampled per event, errors always log and operands are truncated"""
+    event_logger = logging.getLogger("test_events")
+    event_logger.setLevel(logging.INFO)
+    handler = ListHandler()
+    event_logger.addHandler(handler)
+    events = EventLogger(event_logger, sample_rate=10, max_operands=3, max_chars=20)
+
+    for i in range(25):
+        events.info("sum completed", numbers=[1.0, 2.0], result=3.0)
+        events.info("multiplication completed", numbers=[2.0, 2.0], result=4.0)
+    events.error("sum validation error", numbers=[float(i) for i in range(100000)], error="x" * 1000)
+
+    messages = [record.getMessage() for record in handler.records]
+    assert messages.count("sum completed: numbers=[1.0, 2.0], result=3.0") == 3
+    assert messages.count("multiplication completed: numbers=[2.0, 2.0], result=4.0") == 3
+    error = messages[-1]
+    assert error.startswith("sum validation error: numbers=[0.0, 1.0, 2.0, ...] (count=100000, hash=")
+    assert error.endswith(f"error={'x' * 20}... (1000 chars)")
+    assert len(error) < 200
+    assert handler.records[-1].event == "sum validation error"
+    assert handler.records[-1].funcName == "test_event_logger_samples_successes_and_bounds_fields"
+
+def test_event_logger_formats_lazily():
+    """Test that events below the logger level are never formatted"""
+    event_logger = logging.getLogger("test_events_lazy")
+    event_logger.setLevel(logging.WARNING)
+
+    class Unformattable:
+        def __str__(self):
+            raise AssertionError("formatted")
+
+    EventLogger(event_logger).info("sum completed", result=Unformattable())
+
+def test_dropped_log_records_are_never_formatted():
+    """Records dropped by sampling or by a full queue are not formatted; queued ones only by the listener"""
+    formatted = []
+
+    class Counted:
+        def __init__(self, name):
+            self.name = name
+
+        def __str__(self):
+            formatted.append(self.name)
+            return self.name
+
+    event_logger = logging.getLogger("test_events_queue")
+    event_logger.setLevel(logging.INFO)
+    event_logger.propagate = False
+    log_queue = queue.Queue(maxsize=1)
+    handler = DroppingQueueHandler(log_queue, "drop_newest")
+    event_logger.addHandler(handler)
+    events = EventLogger(event_logger, sample_rate=2)
+    try:
+        for name in ("first", "sampled out", "full queue"):
+            events.info("sum completed", result=Counted(name))
+    finally:
+        event_logger.removeHandler(handler)
+
+    assert formatted == []
+    assert log_queue.get_nowait().getMessage() == "sum completed: result=first"
+    assert formatted == ["first"]
+
+def test_background_console_formats_off_the_calling_thread():
+    """While started, console records are formatted and written by the listener thread"""
+    threads = []
+
+    class ThreadRecordingHandler(logging.Handler):
+        def emit(self, record):
+            threads.append((self.format(record), threading.current_thread()))
+
+    console_logger = logging.getLogger("test_background_console")
+    console_logger.setLevel(logging.INFO)
+    console_logger.propagate = False
+    handler = ThreadRecordingHandler(logging.INFO)
+    console_logger.addHandler(handler)
+    console = BackgroundConsole(console_logger, handler, 10)
+
+    console.start()
+    assert handler not in console_logger.handlers
+    EventLogger(console_logger).info("sum completed", result=3)
+    console.stop()
+    EventLogger(console_logger).info("sum completed", result=4)
+    console_logger.removeHandler(handler)
+
+    assert [message for message, _ in threads] == ["sum completed: result=3", "sum completed: result=4"]
+    assert threads[0][1] is not threading.current_thread() and threads[1][1] is threading.current_thread()
+
+def test_batch_logs_one_summary_line():
+    """Test that a batch logs one aggregated line however many operations it has"""
+    handler = ListHandler()
+    app_logger.addHandler(handler)
+    try:
+        for size in (10, 1000):
+            operations = [{"operation": "sum", "numbers": [float(i), 1.0]} for i in range(size)]
+            operations[3] = {"operation": "div", "numbers": [1.0, 0.0]}
+            response = client.post("/calculator/batch", json=operations)
+            assert response.status_code == 200
+    finally:
+        app_logger.removeHandler(handler)
+
+    messages = [record.getMessage() for record in handler.records if getattr(record, "event", "").startswith("batch")]
+    assert len(messages) == 2
+    for message in messages:
+        assert message.startswith("batch completed with errors: ")
+        assert "failed=1, errors={'Division by zero': 1}, first_error=Division by zero, first_operation=div" in message
+
+# ==================== HISTORY SCHEMA TESTS ====================
+
+class BulkWriteShim:
+    """mongomock collection whose bulk_write replays requests one by one.
+
+    mongomock's bulk_write does not accept the arguments recent pymongo passes.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def bulk_write(self, requests, ordered=True):
+        upserted = 0
+        for request in requests:
+            if isinstance(request, ReplaceOne):
+                result = self.collection.replace_one(request._filter, request._doc, upsert=request._upsert)
+            elif isinstance(request, UpdateOne):
+                result = self.collection.update_one(request._filter, request._doc, upsert=request._upsert)
+            else:
+                self.collection.insert_one(request._doc)
+                continue
+            upserted += result.upserted_id is not None
+        return BulkWriteResult({"nUpserted": upserted}, True)
+
+def test_history_migration_is_resumable():
+    """Test that legacy documents are rewritten in batches and the run resumes"""
+    database = mongomock.MongoClient().practica1
+    historial = BulkWriteShim(database.historial)
+    historial.insert_many([
+        {"numeros": [1, 2], "resultado": 3, "operacion": "suma", "date": "22/09/2025 10:30"},
+        {"a": 4, "b": 2, "result": {"operation": "div", "result": 2.0}, "operation": "div", "date": "22/09/2025 11:00"},
+        {"numbers": [5, 5], "result": 25, "operation": "multiplication", "date": "bad date"},
+    ])
+
+    batches = []
+    progress = lambda batch, documents, last_id: batches.append((batch, documents))
+    assert migrate_history(historial, database.migrations, batch_size=2, max_batches=1, progress=progress) == 2
+    assert migrate_history(historial, database.migrations, batch_size=2, progress=progress) == 1
+    assert batches == [(1, 2), (1, 1)]
+
+    documents = list(historial.find().sort("_id", 1))
+    assert all(d["schema_version"] == 2 for d in documents)
+    assert [d["operation"] for d in documents] == ["sum", "division", "multiplication"]
+    assert documents[1]["numbers"] == [4, 2] and documents[1]["result"] == 2.0
+    # 10:30 in Mexico City (UTC-6) is 16:30 UTC
+    assert documents[0]["created_at"] == datetime.datetime(2025, 9, 22, 16, 30)
+
+def test_history_reads_canonical_documents(monkeypatch):
+    """Test that schema version 2 documents are formatted in Mexico City time"""
+    schema_collection = mongomock.MongoClient().practica1.historial
+    created_at = datetime.datetime(2025, 9, 22, 16, 30, tzinfo=datetime.timezone.utc)
+    document = build_history_document("div", [9, 3], 3.0, created_at)
+    schema_collection.insert_one(document)
+    monkeypatch.setattr(main, "collection_historial", schema_collection)
+
+    history = client.get("/calculator/history").json()["history"]
+
+    assert history == [{"numbers": [9, 3], "result": 3.0, "operation": "division", "date": "22/09/2025 10:30", "id": str(document["_id"])}]
+
+# ==================== HISTORY STATS TESTS ====================
+
+def seed_stats(collection):
+    """Two days of sums and divisions, including one failed division"""
+    utc = datetime.timezone.utc
+    collection.insert_many([
+        build_history_document("sum", [1, 2], 3.0, datetime.datetime(2025, 9, 21, 10, tzinfo=utc)),
+        build_history_document("sum", [4, 5], 9.0, datetime.datetime(2025, 9, 21, 11, tzinfo=utc)),
+        build_history_document("div", [8, 2], 4.0, datetime.datetime(2025, 9, 22, 9, tzinfo=utc)),
+        build_history_error_document("division", [8, 0], "Division by zero", datetime.datetime(2025, 9, 22, 9, tzinfo=utc)),
+    ])
+
+def test_history_stats_uses_rollups_for_closed_buckets():
+    """Test stats aggregation and that closed buckets are served from rollups"""
+    database = mongomock.MongoClient().practica1
+    seed_stats(database.historial)
+    rollups = BulkWriteShim(database.historial_rollups)
+    now = datetime.datetime(2025, 9, 22, 12, tzinfo=datetime.timezone.utc)
+
+    stats = history_stats(database.historial, rollups, date_from=datetime.datetime(2025, 9, 21, tzinfo=datetime.timezone.utc), now=now)
+
+    assert stats["count"] == 4 and stats["errors"] == 1
+    assert stats["error_rate"] == 0.25
+    by_operation = {entry["operation"]: entry for entry in stats["by_operation"]}
+    assert by_operation["sum"]["avg_result"] == 6.0
+    assert by_operation["division"]["errors"] == 1
+    assert [bucket["count"] for bucket in stats["buckets"]] == [2, 2]
+    # 21/09 is closed and was rolled up; 22/09 is still open
+    assert [r["_id"] for r in database.historial_rollups.find()] == ["day:2025-09-21T00"]
+
+    # A rollup is reused even if raw documents change afterwards
+    database.historial.delete_many({"operation": "sum"})
+    stats = history_stats(database.historial, rollups, date_from=datetime.datetime(2025, 9, 21, tzinfo=datetime.timezone.utc), now=now, operation="sum")
+    assert stats["count"] == 2
+
+def test_history_stats_endpoint(monkeypatch):
+    """Test the stats endpoint and that failed operations stay out of history"""
+    database = mongomock.MongoClient().practica1
+    seed_stats(database.historial)
+    monkeypatch.setattr(main, "collection_historial", database.historial)
+    monkeypatch.setattr(main, "collection_rollups", BulkWriteShim(database.historial_rollups))
+
+    response = client.get("/calculator/history/stats?bucket=hour&date_from=2025-09-21T00:00:00Z&date_to=2025-09-23T00:00:00Z")
+    assert response.status_code == 200
+    assert response.json()["count"] == 4
+
+    history = client.get("/calculator/history").json()["history"]
+    assert len(history) == 3
+
+    response = client.get("/calculator/history/stats?bucket=week")
+    assert response.status_code == 400
+
+# ==================== STAGE METRICS TESTS ====================
+
+def test_metrics_endpoint_registered_once():
+    """The instrumentator exposes /metrics exactly once"""
+    assert [route.path for route in main.app.routes].count("/metrics") == 1
+
+def test_stage_metrics_recorded(monkeypatch):
+    """Calculator and batch requests record per-stage and size histograms"""
+    monkeypatch.setattr(main, "collection_historial", mongomock.MongoClient().practica1.historial)
+    main.result_cache.clear()
+
+    assert client.get("/calculator/divide?numbers=9&numbers=3").status_code == 200
+    assert client.post("/calculator/batch", json=[{"operation": "sum", "numbers": [1, 2]}]).status_code == 200
+    main.history_writer.flush()
+
+    body = client.get("/metrics").text
+    assert 'calculator_stage_seconds_count{operation="division",stage="validate"}' in body
+    assert 'calculator_stage_seconds_count{operation="division",stage="compute"}' in body
+    assert 'calculator_stage_seconds_count{operation="division",stage="encode"}' in body
+    assert 'calculator_stage_seconds_count{operation="batch",stage="history_save"}' in body
+    assert 'calculator_batch_size_count{engine="loop"}' in body
+    assert 'calculator_operand_count_bucket{le="2.0",operation="division"}' in body
+
+# ==================== STREAMING BATCH TESTS ====================
+
+def test_batch_stream_ndjson(monkeypatch):
+    """Streamed batches answer line by line, in order, and write history per chunk"""
+    collection = mongomock.MongoClient().practica1.historial
+    monkeypatch.setattr(main, "collection_historial", collection)
+    monkeypatch.setattr(main, "BATCH_STREAM_CHUNK_SIZE", 2)
+    body = "\n".join([
+        json.dumps({"operation": "sum", "numbers": [1, 2]}),
+        json.dumps({"operation": "div", "numbers": [1, 0]}),
+        "not json",
+        "",
+        json.dumps({"operation": "mul", "numbers": [3, 4]}),
+    ])
+
+    response = client.post("/calculator/batch/stream", content=body, headers={"Content-Type": "application/x-ndjson"})
+    main.history_writer.flush()
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[0] == {"operation": "sum", "result": 3.0}
+    assert lines[1]["error"] == "Division by zero"
+    assert lines[2]["line"] == 3 and lines[2]["error"].startswith("Invalid operation")
+    assert lines[3] == {"operation": "mul", "result": 12.0}
+    assert collection.count_documents({}) == 3
+
+def test_batch_stream_rejects_other_content_types():
+    response = client.post("/calculator/batch/stream", json=[{"operation": "sum", "numbers": [1, 2]}])
+    assert response.status_code == 415
+
+def test_batch_stream_writes_overflow_as_null(monkeypatch):
+    """Infinite results are written as null, as in the other JSON responses, not as bare Infinity"""
+    monkeypatch.setattr(main, "collection_historial", mongomock.MongoClient().practica1.historial)
+    body = json.dumps({"operation": "mul", "numbers": [1e308, 10]}) + "\n"
+
+    response = client.post("/calculator/batch/stream", content=body, headers={"Content-Type": "application/x-ndjson"})
+
+    assert b"Infinity" not in response.content
+    assert json.loads(response.content.splitlines()[0])["result"] is None
+
+def test_batch_stream_line_too_long(monkeypatch):
+    monkeypatch.setattr(main, "collection_historial", mongomock.MongoClient().practica1.historial)
+    monkeypatch.setattr(main, "BATCH_STREAM_MAX_LINE_BYTES", 16)
+    body = json.dumps({"operation": "sum", "numbers": [1, 2]})
+
+    response = client.post("/calculator/batch/stream", content=body, headers={"Content-Type": "application/x-ndjson"})
+
+    assert "longer than 16 bytes" in response.json()["error"]
+
+# ==================== VECTOR INPUT TESTS ====================
+
+def post_vector(path, values):
+    body = np.asarray(values, dtype="<f8").tobytes()
+    return client.post(path, content=body, headers={"Content-Type": "application/octet-stream"})
+
+@pytest.mark.parametrize(
+    "path, values, expected_result",
+    [
+        ("/calculator/sum", [1.5, 2.5, 3.0], 7.0),
+        ("/calculator/substract", [20, 5, 3], 12.0),
+        ("/calculator/multiply", [2, 3, 4], 24.0),
+        ("/calculator/divide", [100, 2, 5], 10.0),
+    ]
+)
+def test_vector_operations(path, values, expected_result, monkeypatch):
+    """float64 bodies give the same results as the query-string endpoints"""
+    monkeypatch.setattr(main, "collection_historial", mongomock.MongoClient().practica1.historial)
+
+    response = post_vector(path, values)
+
+    assert response.status_code == 200
+    assert response.json() == {"count": len(values), "result": pytest.approx(expected_result)}
+
+@pytest.mark.parametrize(
+    "path, values",
+    [
+        ("/calculator/divide", [1e-300, 1e-200, 1e-200]),
+        ("/calculator/divide", [1e300, 1e200, 1e200, 1e-300]),
+        ("/calculator/multiply", [1e-200, 1e200, 1e100]),
+    ]
+)
+def test_vector_extreme_operands_match_list_path(path, values, monkeypatch):
+    """Regression: a / (b * c) underflowed to inf where the sequential division is finite"""
+    monkeypatch.setattr(main, "collection_historial", mongomock.MongoClient().practica1.historial)
+    main.result_cache.clear()
+
+    expected = client.get(path, params={"numbers": values}).json()["result"]
+    response = post_vector(path, values)
+
+    assert response.status_code == 200
+    assert response.json()["result"] == pytest.approx(expected)
+    assert expected is not None
+
+def test_vector_history_stores_summary(monkeypatch):
+    """Long vectors are saved with a digest instead of every operand"""
+    collection = mongomock.MongoClient().practica1.historial
+    monkeypatch.setattr(main, "collection_historial", collection)
+    values = np.arange(1, 1001, dtype=np.float64)
+
+    response = post_vector("/calculator/sum", values)
+    main.history_writer.flush()
+
+    assert response.json()["result"] == 500500.0
+    document = collection.find_one()
+    assert document["numbers"] == values[:main.VECTOR_HISTORY_PREVIEW].tolist()
+    assert document["operands"]["count"] == 1000
+    assert document["operands"]["max"] == 1000.0
+    assert len(document["operands"]["sha256"]) == 64
+
+@pytest.mark.parametrize(
+    "values, status_code, error",
+    [
+        ([5], 400, "At least 2 numbers are required"),
+        ([5, -1], 400, "Negative numbers are not allowed"),
+        ([float("nan"), -1], 400, "Negative numbers are not allowed"),
+        ([5, float("-inf")], 400, "Negative numbers are not allowed"),
+        ([10, 2, 0], 403, "Division by zero"),
+    ]
+)
+def test_vector_validation(values, status_code, error, monkeypatch):
+    monkeypatch.setattr(main, "collection_historial", mongomock.MongoClient().practica1.historial)
+
+    response = post_vector("/calculator/divide", values)
+
+    assert response.status_code == status_code
+    assert response.json()["error"] == error
+
+@pytest.mark.parametrize("values", [[5, float("nan")], [5, float("inf")], [float("inf"), 2]])
+def test_vector_accepts_what_the_list_path_accepts(values, monkeypatch):
+    """Non-finite operands are validated like the list endpoints: accepted, with a null or finite result"""
+    monkeypatch.setattr(main, "collection_historial", mongomock.MongoClient().practica1.historial)
+    main.result_cache.clear()
+
+    listed = client.get("/calculator/divide", params={"numbers": [str(value) for value in values]})
+    vector = post_vector("/calculator/divide", values)
+
+    assert vector.status_code == listed.status_code == 200
+    assert vector.json()["result"] == listed.json()["result"]
+
+def test_vector_rejects_bad_bodies(monkeypatch):
+    monkeypatch.setattr(main, "VECTOR_MAX_BYTES", 64)
+    headers = {"Content-Type": "application/octet-stream"}
+
+    assert client.post("/calculator/sum", content=b"\x00" * 12, headers=headers).status_code == 400
+    assert client.post("/calculator/sum", content=b"\x00" * 72, headers=headers).status_code == 413
+    assert client.post("/calculator/sum", content=b"\x00" * 16).status_code == 415
+
+# ==================== MULTI-WORKER SERVING TESTS ====================
+
+def test_prepare_multiprocess_dir(tmp_path, monkeypatch):
+    """Metric files from a previous run are removed before workers start"""
+    path = tmp_path / "metrics"
+    path.mkdir()
+    (path / "counter_1.db").write_bytes(b"stale")
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(path))
+
+    assert serve.prepare_multiprocess_dir(4) == str(path)
+    assert list(path.iterdir()) == []
+
+def test_single_worker_skips_multiprocess_dir(monkeypatch):
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+    assert serve.prepare_multiprocess_dir(1) is None
+
+# ==================== FAST JSON RESPONSE TESTS ====================
+
+def test_history_response_gzip(monkeypatch):
+    """Large history pages are gzip-compressed when the client accepts it"""
+    collection = mongomock.MongoClient().practica1.historial
+    created_at = datetime.datetime(2025, 9, 22, 18, 30, tzinfo=datetime.timezone.utc)
+    documents = [build_history_document("sum", [i, 1], i + 1, created_at) for i in range(100)]
+    collection.insert_many(documents)
+    monkeypatch.setattr(main, "collection_historial", collection)
+
+    response = client.get("/calculator/history?limit=100", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["content-encoding"] == "gzip"
+    rows = response.json()["history"]
+    assert len(rows) == 100
+    assert rows[0] == {"operation": "sum", "numbers": [99, 1], "result": 100, "date": "22/09/2025 12:30", "id": str(documents[-1]["_id"])}
+
+def test_small_responses_are_not_compressed(monkeypatch):
+    monkeypatch.setattr(main, "collection_historial", collection_historial)
+
+    response = client.get("/calculator/sum?numbers=1&numbers=2", headers={"Accept-Encoding": "gzip"})
+
+    assert "content-encoding" not in response.headers
+    assert response.json() == {"numbers": [1.0, 2.0], "result": 3.0}
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        (None, None),
+        ("gzip, deflate", "gzip"),
+        ("gzip;q=0, identity", None),
+        ("*", "br" if fast_response.brotli else "gzip"),
+    ]
+)
+def test_choose_encoding(header, expected):
+    assert fast_response.choose_encoding(header) == expected
+
+# ==================== HISTORY RETENTION TESTS ====================
+
+def archived_history(tmp_path):
+    """Ten sums, one per hour on 20/09/2025, with the six oldest moved to the archive"""
+    database = mongomock.MongoClient().practica1
+    utc = datetime.timezone.utc
+    for i in range(10):
+        created_at = datetime.datetime(2025, 9, 20, i, tzinfo=utc)
+        # Written at the time of the operation, as the writer does
+        database.historial.insert_one(dict(build_history_document("sum", [i, 1], i + 1, created_at), _id=ObjectId.from_datetime(created_at)))
+    rollups = BulkWriteShim(database.historial_rollups)
+    archiver = HistoryArchiver(lambda: database.historial, lambda: rollups, str(tmp_path), max_documents=4, batch_size=4)
+    moved = archiver.archive_once(now=datetime.datetime(2025, 9, 22, tzinfo=utc))
+    return database, rollups, archiver, moved
+
+def test_history_archiver_keeps_hot_window(tmp_path):
+    """Documents beyond the hot window move to a day file and closed buckets are rolled up first"""
+    database, rollups, archiver, moved = archived_history(tmp_path)
+
+    assert moved == 6
+    assert sorted(document["result"] for document in database.historial.find()) == [7, 8, 9, 10]
+    assert archive_days(str(tmp_path)) == [datetime.date(2025, 9, 20)]
+    assert archiver.archive_once(now=datetime.datetime(2025, 9, 22, tzinfo=datetime.timezone.utc)) == 0
+
+    stats = history_stats(database.historial, rollups, now=datetime.datetime(2025, 9, 22, tzinfo=datetime.timezone.utc))
+    assert stats["count"] == 10
+
+def test_history_reads_span_archive(tmp_path, monkeypatch):
+    """Cursor pages continue from the hot window into the archive in both orders"""
+    database, _, archiver, _ = archived_history(tmp_path)
+    monkeypatch.setattr(main, "collection_historial", database.historial)
+    monkeypatch.setattr(main, "history_archiver", archiver)
+    monkeypatch.setattr(main, "HISTORY_ARCHIVE_DIR", str(tmp_path))
+
+    for order, expected in (("desc", list(range(10, 0, -1))), ("asc", list(range(1, 11)))):
+        seen = []
+        cursor = None
+        while True:
+            params = {"limit": 3, "order": order}
+            if cursor:
+                params["cursor"] = cursor
+            data = client.get("/calculator/history", params=params).json()
+            seen.extend(item["result"] for item in data["history"])
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        assert seen == expected
+
+    response = client.get("/calculator/history", params={"sort_by": "result", "order": "desc", "limit": 5})
+    assert [item["result"] for item in response.json()["history"]] == [10, 9, 8, 7, 6]
+
+def test_archive_reads_are_bounded(tmp_path, monkeypatch):
+    """Date pages skip the days past the cursor; result sorts read only the newest days"""
+    utc = datetime.timezone.utc
+    for day in range(15, 20):
+        created_at = datetime.datetime(2025, 9, day, 12, tzinfo=utc)
+        document = dict(build_history_document("sum", [day, 0], float(day), created_at), _id=ObjectId.from_datetime(created_at))
+        append_day(str(tmp_path), created_at.date(), [document])
+    read = []
+    read_day = history_archive.read_day
+    monkeypatch.setattr(history_archive, "read_day", lambda directory, day: read.append(day.day) or read_day(directory, day))
+
+    second = find_archived_documents(str(tmp_path), 1, cursor=encode_cursor(find_archived_documents(str(tmp_path), 1)[0], "date"))
+    read.clear()
+    page = find_archived_documents(str(tmp_path), 1, cursor=encode_cursor(second[0], "date"))
+    assert [document["result"] for document in page] == [17.0, 16.0]
+    assert read == [18, 17, 16]
+
+    read.clear()
+    by_result = find_archived_documents(str(tmp_path), 10, sort_by="result", max_result_days=2)
+    assert [document["result"] for document in by_result] == [19.0, 18.0]
+    assert sorted(read) == [18, 19]
+    with pytest.raises(main.InvalidHistoryQuery):
+        find_archived_documents(str(tmp_path), 10, sort_by="result", max_result_days=2,
+                                date_from=datetime.datetime(2025, 9, 15, tzinfo=utc))
+
+def test_archived_day_is_streamed_in_id_order(tmp_path):
+    """A batch archived again after a crash and a late spool replay come out once each, in _id order"""
+    utc = datetime.timezone.utc
+    documents = [
+        dict(build_history_document("sum", [minute, 0], float(minute), datetime.datetime(2025, 9, 21, 10, minute, tzinfo=utc)),
+             _id=ObjectId.from_datetime(datetime.datetime(2025, 9, 21, 10, minute, tzinfo=utc)))
+        for minute in range(5)
+    ]
+    day = datetime.date(2025, 9, 21)
+    append_day(str(tmp_path), day, documents[1:4])
+    append_day(str(tmp_path), day, documents[2:4])
+    append_day(str(tmp_path), day, [documents[0]])
+    append_day(str(tmp_path), day, [documents[4]])
+
+    assert len(list(history_archive.read_day(str(tmp_path), day))) == 7
+    ordered = history_archive.read_day_ordered(str(tmp_path), day)
+    assert [document["result"] for document in ordered] == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+# ==================== HISTORY EXPORT TESTS ====================
+
+def test_history_export_csv(monkeypatch):
+    """CSV export streams every matching document oldest first"""
+    collection = mongomock.MongoClient().practica1.historial
+    seed_stats(collection)
+    monkeypatch.setattr(main, "collection_historial", collection)
+
+    response = client.get("/calculator/history/export", params={"format": "csv", "operation": "sum"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.splitlines()
+    assert lines[0] == "id,created_at,operation,numbers,result,expression"
+    assert [line.split(",", 2)[2] for line in lines[1:]] == ['sum,"[1,2]",3.0,', 'sum,"[4,5]",9.0,']
+
+def test_history_export_jsonl_gzip_includes_archive(tmp_path, monkeypatch):
+    """Gzip JSONL export covers the archive and the hot window once each"""
+    database, _, archiver, _ = archived_history(tmp_path)
+    monkeypatch.setattr(main, "collection_historial", database.historial)
+    monkeypatch.setattr(main, "history_archiver", archiver)
+    monkeypatch.setattr(main, "HISTORY_ARCHIVE_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "HISTORY_EXPORT_BATCH_SIZE", 3)
+
+    response = client.get("/calculator/history/export", params={"format": "jsonl", "compression": "gzip"})
+
+    assert response.headers["content-type"] == "application/gzip"
+    rows = [json.loads(line) for line in gzip.decompress(response.content).splitlines()]
+    assert [row["result"] for row in rows] == list(range(1, 11))
+    assert rows[0]["created_at"] == "2025-09-20T00:00:00+00:00"
+
+def test_history_export_parquet(monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    collection = mongomock.MongoClient().practica1.historial
+    seed_stats(collection)
+    monkeypatch.setattr(main, "collection_historial", collection)
+    monkeypatch.setattr(main, "HISTORY_EXPORT_BATCH_SIZE", 2)
+
+    response = client.get("/calculator/history/export", params={"format": "parquet"})
+
+    table = pq.read_table(io.BytesIO(response.content))
+    assert table.column("result").to_pylist() == [3.0, 9.0, 4.0]
+    assert table.column("numbers").to_pylist()[0] == [1.0, 2.0]
+
+@pytest.mark.parametrize("params", [{"format": "xml"}, {"compression": "zip"}, {"operation": "pow"}])
+def test_history_export_invalid(params, monkeypatch):
+    monkeypatch.setattr(main, "collection_historial", collection_historial)
+    assert client.get("/calculator/history/export", params=params).status_code == 400
+
+# ==================== HISTORY SYNC TESTS ====================
+
+def timed_document(result, hour):
+    """Sum document whose _id time matches created_at, as written by the history writer"""
+    created_at = datetime.datetime(2025, 9, 22, hour, tzinfo=datetime.timezone.utc)
+    return dict(build_history_document("sum", [result, 0], result, created_at), _id=ObjectId.from_datetime(created_at))
+
+def test_history_since_and_etag(monkeypatch):
+    """Unchanged history answers 304 and a sync token returns only newer entries"""
+    collection = mongomock.MongoClient().practica1.historial
+    collection.insert_many([timed_document(1, 10), timed_document(2, 11)])
+    monkeypatch.setattr(main, "collection_historial", collection)
+    monkeypatch.setattr(main, "HISTORY_SYNC_LAG_SECONDS", 0)
+
+    first = client.get("/calculator/history")
+    token = first.json()["sync_token"]
+    assert token == first.json()["history"][0]["id"]
+    cached = client.get("/calculator/history", headers={"If-None-Match": first.headers["etag"]})
+    assert cached.status_code == 304 and cached.content == b""
+
+    collection.insert_one(timed_document(3, 12))
+    delta = client.get("/calculator/history", params={"since": token}).json()
+    # The entry at the token itself is repeated; clients drop it by id
+    assert [item["result"] for item in delta["history"]] == [3, 2]
+    assert delta["sync_token"] == delta["history"][0]["id"]
+
+    assert client.get("/calculator/history", params={"since": "nope"}).status_code == 400
+
+def test_history_event_stream(monkeypatch):
+    """Entries saved on this worker are pushed at once; others are found by polling"""
+    collection = mongomock.MongoClient().practica1.historial
+    monkeypatch.setattr(main, "collection_historial", collection)
+    monkeypatch.setattr(main, "HISTORY_EVENTS_POLL_SECONDS", 0.05)
+    monkeypatch.setattr(main, "HISTORY_SYNC_LAG_SECONDS", 0)
+
+    async def scenario():
+        stream = main.history_event_stream(None)
+        pending = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0.01)
+        await main.save_history([build_history_document("sum", [1, 2], 3.0, main.utc_now())], "sum")
+        local = await pending
+        main.history_writer.flush()
+        # Written by another worker: only visible through Mongo
+        collection.insert_one(build_history_document("division", [8, 2], 4.0, main.utc_now()))
+        polled = await stream.__anext__()
+        while polled == b": keep-alive\n\n":
+            polled = await stream.__anext__()
+        await stream.aclose()
+        return local, polled
+
+    local, polled = asyncio.run(scenario())
+
+    assert local.startswith(b"event: history\n")
+    assert json.loads(local.split(b"data: ")[1])["history"][0]["result"] == 3.0
+    data = json.loads(polled.split(b"data: ")[1])
+    assert [row["result"] for row in data["history"]] == [4.0]
+    assert data["sync_token"] == data["history"][0]["id"]
+    assert main.history_events.subscriber_count == 0
+
+# ==================== HEALTH TESTS ====================
+
+class PingClientStub:
+    """Async client whose admin database answers ping"""
+    def __init__(self, fail=False):
+        self.admin = self
+        self.fail = fail
+        self.pings = 0
+
+    async def command(self, name):
+        self.pings += 1
+        if self.fail:
+            raise ConnectionError("connection refused")
+        return {"ok": 1.0}
+
+def test_liveness():
+    assert client.get("/health/live").json() == {"status": "ok"}
+
+def test_readiness_waits_for_warmup(monkeypatch):
+    """Readiness is 503 until warm-up has filled the pool and created the indexes"""
+    stub = PingClientStub()
+    collection = mongomock.MongoClient().practica1.historial
+    monkeypatch.setattr(main, "async_mongo_client", stub)
+    monkeypatch.setattr(main, "collection_historial", collection)
+    monkeypatch.setattr(main, "warmup_complete", False)
+
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["checks"]["warmup"] == "pending"
+
+    pings = stub.pings
+    asyncio.run(main.warm_up())
+    assert stub.pings - pings == main.MONGO_WARMUP_CONNECTIONS
+    assert len(collection.index_information()) > 1
+
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json()["checks"]["mongo"]["status"] == "ok"
+
+    monkeypatch.setattr(main, "async_mongo_client", PingClientStub(fail=True))
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["checks"]["mongo"] == {"status": "down", "error": "connection refused"}
+
+def test_warmup_retries_only_transient_errors(monkeypatch):
+    """Connection errors are retried; an index error stops warm-up and shows in readiness"""
+    failures = [AutoReconnect("connection refused"), OperationFailure("Index already exists with different options", 85)]
+    calls = []
+
+    def prepare_collections():
+        calls.append(1)
+        if failures:
+            raise failures.pop(0)
+
+    monkeypatch.setattr(main, "async_mongo_client", PingClientStub())
+    monkeypatch.setattr(main, "prepare_collections", prepare_collections)
+    monkeypatch.setattr(main, "MONGO_WARMUP_RETRY_SECONDS", 0)
+    monkeypatch.setattr(main, "warmup_complete", False)
+    monkeypatch.setattr(main, "warmup_error", None)
+
+    asyncio.run(main.warm_up())
+
+    assert len(calls) == 2 and not main.warmup_complete
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["checks"]["warmup"] == "failed"
+    assert "different options" in response.json()["checks"]["warmup_error"]
+
+class CollModShim:
+    """mongomock collection whose database accepts the collMod of a TTL index (mongomock has no collMod)"""
+    def __init__(self, collection):
+        self.collection = collection
+        self.database = self
+        self.commands = []
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def command(self, spec):
+        self.commands.append(spec)
+        index = spec["index"]
+        key = list(index["keyPattern"].items())
+        self.collection.drop_index(key)
+        self.collection.create_index(key, expireAfterSeconds=index["expireAfterSeconds"])
+        return {"ok": 1}
+
+def test_restart_with_changed_retention_updates_ttl_index(monkeypatch):
+    """A new HISTORY_RETENTION_DAYS changes the TTL index in place instead of failing warm-up"""
+    collection = CollModShim(mongomock.MongoClient().practica1.historial)
+    monkeypatch.setattr(main, "async_mongo_client", PingClientStub())
+    monkeypatch.setattr(main, "collection_historial", collection)
+    monkeypatch.setattr(main.history_archiver, "directory", None)
+
+    def ttl():
+        return [index["expireAfterSeconds"] for index in collection.index_information().values()
+                if "expireAfterSeconds" in index]
+
+    for days in (30, 30, 7):
+        monkeypatch.setattr(main, "HISTORY_RETENTION_DAYS", days)
+        monkeypatch.setattr(main, "warmup_complete", False)
+        monkeypatch.setattr(main, "warmup_error", None)
+        asyncio.run(main.warm_up())
+        assert main.warmup_complete and main.warmup_error is None
+        assert ttl() == [days * 86400]
+    assert len(collection.commands) == 1
+
+# ==================== DEGRADED MODE TESTS ====================
+
+def test_circuit_breaker_opens_and_recovers():
+    """Failures open the breaker; after open_seconds one probe decides whether it closes"""
+    now = [0.0]
+    states = []
+    breaker = CircuitBreaker(failure_rate=0.5, window=4, min_calls=4, slow_seconds=1.0,
+                             open_seconds=10, on_state_change=states.append, clock=lambda: now[0])
+    for ok, elapsed in [(True, 0.1), (False, 0), (True, 2.0), (True, 0.1)]:
+        assert breaker.allow()
+        breaker.record(ok, elapsed)
+    assert breaker.state == "open" and not breaker.allow()
+
+    now[0] = 10
+    assert breaker.allow() and not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+
+    now[0] = 20
+    assert breaker.allow()
+    breaker.record(True, 0.1)
+    assert states == ["open", "half_open", "open", "half_open", "closed"]
+
+class FlakyCollection:
+    """mongomock collection whose inserts fail while down is set"""
+    def __init__(self, collection):
+        self.collection = collection
+        self.down = True
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def insert_many(self, documents, ordered=True):
+        if self.down:
+            raise AutoReconnect("connection refused")
+        return self.collection.insert_many(documents, ordered=ordered)
+
+def test_history_writer_spools_and_replays(tmp_path):
+    """While Mongo is down batches are spooled and acknowledged; they are replayed once, without duplicates"""
+    collection = FlakyCollection(mongomock.MongoClient().practica1.historial)
+    now = [0.0]
+    breaker = CircuitBreaker(min_calls=1, open_seconds=5, clock=lambda: now[0])
+    spool = HistorySpool(str(tmp_path), segment_bytes=256)
+    writer = HistoryWriter(lambda: collection, batch_size=2, flush_interval=0.01,
+                           durability=DURABILITY_ACKNOWLEDGED, spool=spool, breaker=breaker)
+    documents = [build_history_document("suma", [i, 1], i + 1, main.utc_now()) for i in range(6)]
+    try:
+        for document in documents:
+            assert writer.submit(document).result(timeout=5) == 1
+        assert breaker.state == "open"
+        assert spool.pending() and collection.count_documents({}) == 0
+
+        # One document made it before the outage; the replay must not duplicate it
+        collection.collection.insert_one(documents[0])
+        collection.down = False
+        now[0] = 5
+        writer.submit(build_history_document("suma", [9, 1], 10, main.utc_now())).result(timeout=5)
+        for _ in range(100):
+            if not spool.pending():
+                break
+            time.sleep(0.01)
+    finally:
+        writer.stop()
+
+    assert breaker.state == "closed"
+    assert not spool.pending()
+    assert collection.count_documents({}) == 7
+
+def test_spool_replay_updates_closed_rollups(tmp_path):
+    """Documents replayed after their bucket was rolled up are added to the rollup, once"""
+    database = mongomock.MongoClient().practica1
+    seed_stats(database.historial)
+    rollups = BulkWriteShim(database.historial_rollups)
+    repository = MongoHistoryRepository(lambda: database.historial, lambda: None, lambda: rollups)
+    now = datetime.datetime(2025, 9, 22, 12, tzinfo=datetime.timezone.utc)
+    date_from = datetime.datetime(2025, 9, 21, tzinfo=datetime.timezone.utc)
+    assert repository.stats(bucket="day", date_from=date_from, now=now)["count"] == 4
+
+    late = build_history_document("sum", [10, 20], 30.0, datetime.datetime(2025, 9, 21, 23, tzinfo=datetime.timezone.utc))
+    stored = database.historial.find_one({"operation": "sum"})
+    spool = HistorySpool(str(tmp_path))
+    spool.append([late, stored])
+    spool.replay(database.historial, on_stored=repository.replayed)
+
+    stats = repository.stats(bucket="day", date_from=date_from, now=now, operation="sum")
+    assert stats["count"] == 3 and stats["max_result"] == 30.0
+    assert [bucket["count"] for bucket in stats["buckets"]] == [3]
+    # The hour buckets had no rollup yet: they are aggregated from the collection
+    assert database.historial_rollups.count_documents({}) == 1
+    assert repository.stats(bucket="hour", date_from=date_from, now=now)["count"] == 5
+
+def test_spool_ignores_torn_tail(tmp_path):
+    """A record cut short by a crash mid-append ends the segment"""
+    spool = HistorySpool(str(tmp_path))
+    spool.append([{"_id": 1}, {"_id": 2}])
+    spool.seal()
+    path = spool.segments()[0]
+    with open(path, "ab") as spool_file:
+        spool_file.write(b"\x40\x00\x00\x00\x10_id")
+
+    with open(path, "rb") as spool_file:
+        documents, offset, exhausted = read_documents(spool_file, 10)
+
+    assert [document["_id"] for document in documents] == [1, 2]
+    assert exhausted and offset < os.path.getsize(path)
+
+# ==================== ADMISSION CONTROL TESTS ====================
+
+def test_admission_limiter_weighted_fifo_and_shedding():
+    """Costs are admitted in arrival order; a full queue or a missed deadline sheds"""
+    async def scenario():
+        limiter = AdmissionLimiter("test", capacity=10, max_queue=2, queue_timeout=0.05)
+        first = await limiter.acquire(8)
+        large = asyncio.ensure_future(limiter.acquire(5))
+        small = asyncio.ensure_future(limiter.acquire(1))
+        await asyncio.sleep(0)
+        with pytest.raises(RequestShed) as full:
+            await limiter.acquire(1)
+        # The small request fits, but waits behind the large one
+        assert not small.done()
+        limiter.release(first)
+        assert await large == 5 and await small == 1
+        with pytest.raises(RequestShed) as late:
+            await limiter.acquire(10)
+        return full.value.reason, late.value.reason, limiter.in_use, limiter.queued
+
+    assert asyncio.run(scenario()) == ("queue_full", "deadline", 6, 0)
+
+def test_saturated_batches_shed_without_blocking_cheap_routes(monkeypatch):
+    """A batch that cannot get its operation budget in time gets 503 while sums still answer"""
+    monkeypatch.setattr(main, "collection_historial", mongomock.MongoClient().practica1.historial)
+    limiter = main.batch_operations_limiter
+    monkeypatch.setattr(limiter, "in_use", limiter.capacity)
+    monkeypatch.setattr(limiter, "queue_timeout", 0.01)
+
+    response = client.post("/calculator/batch", json=[{"operation": "sum", "numbers": [1, 2]}])
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert response.json()["reason"] == "deadline"
+    assert client.get("/calculator/sum", params={"numbers": [1, 2]}).json()["result"] == 3
+
+def test_batch_is_charged_its_parsed_operations(monkeypatch):
+    """The admission cost is the parsed operation count, however the keys are spelled"""
+    monkeypatch.setattr(main, "collection_historial", mongomock.MongoClient().practica1.historial)
+    limiter = main.batch_operations_limiter
+    costs = []
+    slot = limiter.slot
+    monkeypatch.setattr(limiter, "slot", lambda cost: costs.append(cost) or slot(cost))
+    body = b'[{"\\u006fperation": "sum", "numbers": [1, 2]}, {"operation": "mul", "numbers": [2, 3]}]'
+
+    response = client.post("/calculator/batch", content=body, headers={"Content-Type": "application/json"})
+
+    assert response.status_code == 200
+    assert costs == [2]
+
+def test_batch_body_validation_errors():
+    """The batch body is parsed by the endpoint, with FastAPI's 422 format"""
+    response = client.post("/calculator/batch", json=[{"operation": "sum"}])
+
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", 0, "numbers"]
+
+def test_route_limit_sheds_when_queue_is_full(monkeypatch):
+    monkeypatch.setattr(main.export_limiter, "in_use", main.export_limiter.capacity)
+    monkeypatch.setattr(main.export_limiter, "max_queue", 0)
+
+    response = client.get("/calculator/history/export")
+
+    assert response.status_code == 503
+    assert response.json()["route"] == "export"
+    assert client.get("/health/live").status_code == 200
+
+# ==================== EXPRESSION TESTS ====================
+
+def test_evaluate_expression(monkeypatch):
+    """An expression is evaluated with the calculator semantics and stored as one history document"""
+    collection = mongomock.MongoClient().practica1.historial
+    monkeypatch.setattr(main, "collection_historial", collection)
+
+    response = client.post("/calculator/evaluate", json={"expression": "(a * b) + c", "variables": {"a": 2, "b": 3, "c": 4}})
+    main.history_writer.flush()
+
+    assert response.status_code == 200
+    assert response.json() == {"expression": "(a * b) + c", "variables": {"a": 2, "b": 3, "c": 4}, "result": 10.0}
+    document = collection.find_one()
+    assert (document["operation"], document["numbers"], document["expression"]) == ("evaluate", [2, 3, 4], "(a * b) + c")
+    # Listed and exported with the expression, so the row says what was computed
+    assert client.get("/calculator/history").json()["history"][0]["expression"] == "(a * b) + c"
+    export = client.get("/calculator/history/export", params={"format": "jsonl"})
+    assert json.loads(export.text.splitlines()[0])["expression"] == "(a * b) + c"
+
+@pytest.mark.parametrize("expression, status_code, error", [
+    ("10 / (a - 2)", 403, "Division by zero"),
+    ("a - 5 + 1", 400, "Negative numbers are not allowed"),
+    ("__import__('os')", 400, "Unknown function: __import__"),
+    ("open('x').read()", 400, "Unsupported syntax: Call"),
+    ("a ** 2", 400, "Unsupported syntax: BinOp"),
+    ("sum(a)", 400, "At least 2 numbers are required: sum()"),
+])
+def test_evaluate_expression_errors(expression, status_code, error, monkeypatch):
+    monkeypatch.setattr(main, "collection_historial", mongomock.MongoClient().practica1.historial)
+
+    response = client.post("/calculator/evaluate", json={"expression": expression, "variables": {"a": 2}})
+
+    assert response.status_code == status_code
+    assert response.json()["error"] == error
+
+def test_evaluate_rows_reuse_cached_plan(monkeypatch):
+    """Rows share one compiled plan and one history write; each row fails on its own"""
+    collection = mongomock.MongoClient().practica1.historial
+    monkeypatch.setattr(main, "collection_historial", collection)
+    main.compiled_expression.cache_clear()
+    body = {"expression": "divide(x, y) + 1", "rows": [{"x": 6, "y": 3}, {"x": 1, "y": 0}, {"x": 1}]}
+
+    first = client.post("/calculator/evaluate", json=body).json()
+    client.post("/calculator/evaluate", json=body)
+    main.history_writer.flush()
+
+    assert first["results"] == [
+        {"result": 3.0},
+        {"error": "Division by zero", "operands": [1.0, 0.0]},
+        {"error": "Missing variable: y", "operands": []},
+    ]
+    assert main.compiled_expression.cache_info().hits == 1
+    # Rows missing a variable are not evaluated, so they are not recorded
+    assert collection.count_documents({}) == 4
+
+# ==================== PROFILING TESTS ====================
+
+def test_profile_endpoints_require_admin_token(monkeypatch):
+    monkeypatch.setattr(main, "PROFILER_ADMIN_TOKEN", "")
+    assert client.get("/debug/profiles").status_code == 404
+
+    monkeypatch.setattr(main, "PROFILER_ADMIN_TOKEN", "secret")
+    assert client.get("/debug/profiles", headers={"X-Admin-Token": "wrong"}).status_code == 403
+
+def test_profile_worker_formats(monkeypatch):
+    """On-demand profiles come back as collapsed stacks or speedscope JSON"""
+    monkeypatch.setattr(main, "PROFILER_ADMIN_TOKEN", "secret")
+    headers = {"X-Admin-Token": "secret"}
+
+    collapsed = client.get("/debug/profile", params={"seconds": 0.05, "interval_ms": 1}, headers=headers)
+    speedscope = client.get("/debug/profile", params={"seconds": 0.05, "format": "speedscope"}, headers=headers).json()
+
+    assert collapsed.status_code == 200
+    lines = collapsed.text.splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert speedscope["$schema"] == "https://www.speedscope.app/file-format-schema.json"
+    assert speedscope["profiles"][0]["type"] == "sampled"
+    assert client.get("/debug/profile", params={"seconds": 0.01, "format": "svg"}, headers=headers).status_code == 400
+
+def test_profile_single_request(monkeypatch):
+    """X-Profile with the admin token profiles that request and returns the profile id"""
+    monkeypatch.setattr(main, "PROFILER_ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(main, "collection_historial", mongomock.MongoClient().practica1.historial)
+    headers = {"X-Admin-Token": "secret"}
+
+    response = client.get("/calculator/sum", params={"numbers": [1, 2]}, headers=dict(headers, **{"X-Profile": "1"}))
+    plain = client.get("/calculator/sum", params={"numbers": [1, 2]}, headers={"X-Profile": "1"})
+
+    assert response.json()["result"] == 3
+    assert "x-profile-id" not in plain.headers
+    profile_id = response.headers["X-Profile-Id"]
+    listed = client.get("/debug/profiles", headers=headers).json()["profiles"]
+    assert listed[0]["id"] == profile_id and listed[0]["path"] == "/calculator/sum"
+    assert client.get(f"/debug/profiles/{profile_id}", params={"format": "speedscope"}, headers=headers).status_code == 200
+
+def test_slow_request_capture():
+    """Requests over the threshold keep their stacks in their own store, which holds the slowest ones"""
+    delays = iter([0.04, 0.02, 0.08])
+
+    async def slow_app(scope, receive, send):
+        time.sleep(next(delays))
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(message):
+        pass
+
+    store = ProfileStore(max_profiles=2)
+    requested = StackSampler(0.001).profile(kind="worker", name="on demand")
+    store.add(store.new_id(), requested)
+    slow_store = SlowProfileStore(max_profiles=2)
+    sampler = StackSampler(0.001)
+    middleware = ProfilerMiddleware(slow_app, store, lambda: "", slow_sampler=sampler, slow_seconds=0.01,
+                                    slow_store=slow_store)
+    scope = {"type": "http", "method": "GET", "path": "/slow", "headers": []}
+    sampler.start()
+    try:
+        for _ in range(3):
+            asyncio.run(middleware(scope, None, send))
+    finally:
+        sampler.stop()
+
+    summaries = slow_store.summaries()
+    assert [summary["duration_ms"] >= 70 for summary in summaries] == [True, False]
+    assert summaries[1]["duration_ms"] >= 35
+    assert summaries[0]["kind"] == "slow" and summaries[0]["status"] == 200
+    assert "slow_app (test_main.py" in slow_store.get(summaries[0]["id"]).collapsed()
+    # The requested profile was not evicted by the slow ones
+    assert [summary["name"] for summary in store.summaries()] == ["on demand"]
+
+def test_frame_key_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(profiler, "FRAME_KEYS_MAX", 3)
+    monkeypatch.setattr(profiler, "_frame_keys", {})
+    for index in range(10):
+        code = compile(f"x = {index}", f"<generated {index}>", "exec")
+        assert profiler.frame_key(code) == ("<module>", f"<generated {index}>", 1)
+    assert len(profiler._frame_keys) <= 3
+
+# ==================== HISTORY STORAGE BACKEND TESTS ====================
+
+def make_repository(backend, tmp_path):
+    """An empty history repository of the given backend"""
+    if backend == "memory":
+        return MemoryHistoryRepository(100)
+    if backend == "sqlite":
+        return SQLiteHistoryRepository(str(tmp_path / "history.sqlite3"))
+    database = mongomock.MongoClient().practica1
+    rollups = BulkWriteShim(database.historial_rollups)
+    return MongoHistoryRepository(lambda: database.historial, lambda: None, lambda: rollups)
+
+@pytest.mark.parametrize("backend", ["mongo", "memory", "sqlite"])
+def test_history_backends_answer_alike(backend, tmp_path):
+    """Test that pages, sync tokens, stats and exports match on every backend"""
+    repository = make_repository(backend, tmp_path)
+    repository.prepare()
+    utc = datetime.timezone.utc
+    documents = [
+        build_history_document("sum", [i, 1], float(result), datetime.datetime(2025, 9, 21, 10 + i, tzinfo=utc))
+        for i, result in enumerate([5, 3, 9, 1, 7])
+    ]
+    documents.append(build_history_document("div", [8, 2], 4.0, datetime.datetime(2025, 9, 22, 9, tzinfo=utc)))
+    error = build_history_error_document("division", [8, 0], "Division by zero", datetime.datetime(2025, 9, 22, 9, tzinfo=utc))
+    repository.append_many(documents[:3])
+    repository.append_many(documents[3:] + [error])
+    if backend == "sqlite":
+        # A replayed document that is already stored is skipped
+        repository.insert_many([documents[0]])
+
+    def page(**params):
+        found = asyncio.run(repository.find_documents(params.pop("limit", 3), **params))
+        return [document["result"] for document in found], found
+
+    results, found = page()
+    assert results == [4.0, 7.0, 1.0, 9.0]
+    assert set(found[0]) <= {"_id", "numbers", "result", "operation", "created_at", "schema_version"}
+    _, next_cursor = main.split_page(found, 3, "date")
+    assert page(cursor=next_cursor)[0] == [9.0, 3.0, 5.0]
+    assert page(sort_by="result", order="asc", limit=10)[0] == [1.0, 3.0, 4.0, 5.0, 7.0, 9.0]
+    assert page(operation="divide")[0] == [4.0]
+    assert page(since=documents[4]["_id"])[0] == [4.0, 7.0]
+    assert asyncio.run(repository.newest_id()) == documents[-1]["_id"]
+    with pytest.raises(main.InvalidHistoryQuery):
+        page(operation="modulo")
+
+    stats = repository.stats(date_from=datetime.datetime(2025, 9, 21, tzinfo=utc),
+                             now=datetime.datetime(2025, 9, 23, tzinfo=utc))
+    assert (stats["count"], stats["errors"]) == (7, 1)
+    assert [bucket["count"] for bucket in stats["buckets"]] == [5, 2]
+    by_operation = {entry["operation"]: entry for entry in stats["by_operation"]}
+    assert by_operation["sum"]["avg_result"] == 5.0 and by_operation["sum"]["max_result"] == 9.0
+    assert repository.stats(bucket="hour", operation="sum", now=datetime.datetime(2025, 9, 23, tzinfo=utc))["count"] == 5
+
+    exported = list(repository.iter_documents(operation="sum", batch_size=2))
+    assert [document["_id"] for document in exported] == [document["_id"] for document in documents[:5]]
+    repository.close()
+
+def test_incomplete_history_backend_fails_at_construction():
+    class WriteOnlyRepository(HistoryRepository):
+        def append_many(self, documents):
+            pass
+
+    with pytest.raises(TypeError, match="find_documents"):
+        WriteOnlyRepository()
+
+def test_memory_export_reads_one_snapshot():
+    """An export reads the buffer as it was when it started, in _id order"""
+    repository = MemoryHistoryRepository(100)
+    utc = datetime.timezone.utc
+    documents = [build_history_document("sum", [i, 1], float(i), datetime.datetime(2025, 9, 21, 10, i, tzinfo=utc)) for i in range(5)]
+    repository.append_many(documents[:3])
+
+    exported = repository.iter_documents(batch_size=2)
+    first = [next(exported), next(exported)]
+    repository.append_many(documents[3:])
+
+    assert [document["result"] for document in first + list(exported)] == [0.0, 1.0, 2.0]
+
+def test_memory_buffer_stays_ordered_by_id():
+    """Out-of-order batches are merged in, and pages bisect to their cursor in both orders"""
+    repository = MemoryHistoryRepository(4)
+    utc = datetime.timezone.utc
+    documents = [build_history_document("sum", [i, 1], float(i), datetime.datetime(2025, 9, 21, 10, i, tzinfo=utc)) for i in range(6)]
+    repository.append_many([documents[1], documents[3]])
+    repository.append_many([documents[4], documents[0], documents[2]])
+    repository.append_many([documents[5]])
+
+    # The oldest fell out of the full buffer
+    assert [document["result"] for document in repository.iter_documents()] == [2.0, 3.0, 4.0, 5.0]
+    newest = repository.find(2)
+    assert [document["result"] for document in newest] == [5.0, 4.0, 3.0]
+    after = repository.find(2, cursor=encode_cursor(newest[1], "date"))
+    assert [document["result"] for document in after] == [3.0, 2.0]
+    ascending = repository.find(1, cursor=encode_cursor(newest[2], "date"), order="asc")
+    assert [document["result"] for document in ascending] == [4.0, 5.0]
+    assert [document["result"] for document in repository.find(5, since=documents[4]["_id"])] == [5.0, 4.0]
+
+def test_history_endpoints_on_sqlite_backend(tmp_path, monkeypatch):
+    """Test the app writing and reading history through the SQLite backend"""
+    repository = SQLiteHistoryRepository(str(tmp_path / "history.sqlite3"))
+    monkeypatch.setattr(main, "history_repository", repository)
+    monkeypatch.setattr(main, "HISTORY_BACKEND", "sqlite")
+    monkeypatch.setattr(main, "warmup_complete", True)
+    main.result_cache.clear()
+
+    assert client.get("/calculator/sum?numbers=2&numbers=3").status_code == 200
+    assert client.get("/calculator/divide?numbers=1&numbers=0").status_code == 403
+    assert client.post("/calculator/batch", json=[{"operation": "mul", "numbers": [2, 4]}]).status_code == 200
+    main.history_writer.flush()
+
+    data = client.get("/calculator/history").json()
+    assert [row["result"] for row in data["history"]] == [8.0, 5.0]
+    assert data["sync_token"] == data["history"][0]["id"]
+    assert client.get("/calculator/history", params={"since": data["sync_token"]}).json()["history"][0]["result"] == 8.0
+    assert client.get("/calculator/history/stats").json()["errors"] == 1
+    export = client.get("/calculator/history/export", params={"format": "jsonl"})
+    assert [json.loads(line)["result"] for line in export.text.splitlines()] == [5.0, 8.0]
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json()["checks"]["sqlite"] == {"status": "ok"}
+    repository.close()
+
+# ==================== HISTORY COMPACTION TESTS ====================
+
+def test_compaction_merges_identical_operations_per_window():
+    """Identical operations in one window become one counted entry, across batches"""
+    collection = BulkWriteShim(mongomock.MongoClient().practica1.historial)
+    sink = CompactingCollection(collection, window=60)
+    utc = datetime.timezone.utc
+    at = lambda minute, second: datetime.datetime(2025, 9, 21, 10, minute, second, tzinfo=utc)
+
+    sink.insert_many([
+        build_history_document("sum", [1, 2], 3.0, at(0, 1)),
+        build_history_document("sum", [1, 2], 3.0, at(0, 30)),
+        build_history_document("sum", [2, 1], 3.0, at(0, 31)),
+    ])
+    sink.insert_many([
+        build_history_document("sum", [1, 2], 3.0, at(0, 50)),
+        build_history_document("sum", [1, 2], 3.0, at(1, 5)),
+        build_history_error_document("division", [8, 0], "Division by zero", at(0, 40)),
+    ])
+
+    entries = {(tuple(entry["numbers"]), entry["created_at"].minute): entry for entry in collection.find()}
+    merged = entries[((1, 2), 0)]
+    assert merged["count"] == 3
+    assert merged["created_at"].second == 1 and merged["last_seen"].second == 50
+    assert entries[((2, 1), 0)]["count"] == 1
+    assert entries[((1, 2), 1)]["count"] == 1
+    assert compaction_summary(collection) == {"operations": 6, "entries": 4, "ratio": 1.5}
+
+def test_compacted_history_endpoints(monkeypatch):
+    """Compacted entries are listed with their count or expanded, and weigh their count in stats and exports"""
+    database = mongomock.MongoClient().practica1
+    repository = MongoHistoryRepository(
+        lambda: BulkWriteShim(database.historial), lambda: None, lambda: BulkWriteShim(database.historial_rollups),
+        compaction_window=3600,
+    )
+    monkeypatch.setattr(main, "history_repository", repository)
+    main.result_cache.clear()
+
+    for _ in range(3):
+        assert client.get("/calculator/sum?numbers=2&numbers=3").status_code == 200
+    assert client.get("/calculator/multiply?numbers=2&numbers=4").status_code == 200
+    main.history_writer.flush()
+
+    history = client.get("/calculator/history").json()["history"]
+    assert [(row["result"], row["count"]) for row in history] == [(8.0, 1), (5.0, 3)]
+    assert "last_seen" in history[1]
+    expanded = client.get("/calculator/history", params={"expand": "true"}).json()["history"]
+    assert [row["result"] for row in expanded] == [8.0, 5.0, 5.0, 5.0]
+    assert "count" not in expanded[1]
+    assert [row["id"] for row in expanded[1:]] == [f"{history[1]['id']}:{copy}" for copy in range(3)]
+    assert {row["entry_id"] for row in expanded[1:]} == {history[1]["id"]}
+
+    # Pages stay at limit rows, also when they end inside an entry
+    pages = []
+    cursor = None
+    while True:
+        params = {"expand": "true", "limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        data = client.get("/calculator/history", params=params).json()
+        pages.append([row["id"] for row in data["history"]])
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+    assert [len(page) for page in pages] == [2, 2]
+    assert sum(pages, []) == [row["id"] for row in expanded]
+    params = {"expand": "true", "limit": 1}
+    first = client.get("/calculator/history", params=params).json()
+    second = client.get("/calculator/history", params=dict(params, cursor=first["next_cursor"])).json()
+    third = client.get("/calculator/history", params=dict(params, cursor=second["next_cursor"])).json()
+    assert [third["history"][0]["id"]] == [expanded[2]["id"]]
+    assert client.get("/calculator/history", params={"cursor": second["next_cursor"]}).status_code == 400
+
+    stats = client.get("/calculator/history/stats").json()
+    assert stats["count"] == 4
+    assert {entry["operation"]: entry["avg_result"] for entry in stats["by_operation"]} == {"multiplication": 8.0, "sum": 5.0}
+    export = client.get("/calculator/history/export", params={"format": "jsonl"})
+    assert [json.loads(line)["result"] for line in export.text.splitlines()] == [5.0, 5.0, 5.0, 8.0]
+
+def test_compacted_entries_are_published_as_stored(monkeypatch):
+    """Events carry the stored id and count of a compacted entry, and a repeat moves the sync token"""
+    database = mongomock.MongoClient().practica1
+    repository = MongoHistoryRepository(
+        lambda: BulkWriteShim(database.historial), lambda: None, lambda: BulkWriteShim(database.historial_rollups),
+        compaction_window=3600, on_compacted=main.publish_stored,
+    )
+    monkeypatch.setattr(main, "history_repository", repository)
+    utc = datetime.timezone.utc
+    first, repeat = (build_history_document("sum", [2, 3], 5.0, datetime.datetime(2025, 9, 21, 10, minute, tzinfo=utc))
+                     for minute in (0, 5))
+
+    async def scenario():
+        monkeypatch.setattr(main, "event_loop", asyncio.get_running_loop())
+        subscription = main.history_events.subscribe()
+        try:
+            repository.append_many([first])
+            stored = await asyncio.wait_for(subscription.get(), 1)
+            token = await main.fetch_sync_token()
+            repository.append_many([repeat])
+            bumped = await asyncio.wait_for(subscription.get(), 1)
+            return stored, token, bumped, await main.fetch_sync_token()
+        finally:
+            main.history_events.unsubscribe(subscription)
+
+    stored, token, bumped, bumped_token = asyncio.run(scenario())
+    assert [(row["id"], row["count"]) for row in stored] == [(str(first["_id"]), 1)]
+    assert [(row["id"], row["count"]) for row in bumped] == [(str(first["_id"]), 2)]
+    assert token == str(first["_id"]) and bumped_token == str(repeat["_id"])
+    assert main.newest_token(token, bumped) == bumped_token
+
+    # The delta after the first token returns the bumped entry; the stream sends it again with its new count
+    delta = client.get("/calculator/history", params={"since": token}).json()
+    assert [(row["id"], row["count"]) for row in delta["history"]] == [(str(first["_id"]), 2)]
+    assert delta["sync_token"] == bumped_token
+    sent = RecentIds()
+    assert sent.unseen(stored) == stored and sent.unseen(bumped) == bumped and sent.unseen(bumped) == []
+
+def test_compaction_keeps_different_expressions_apart(monkeypatch):
+    """Expressions with the same operands and result are different entries"""
+    database = mongomock.MongoClient().practica1
+    repository = MongoHistoryRepository(
+        lambda: BulkWriteShim(database.historial), lambda: None, lambda: BulkWriteShim(database.historial_rollups),
+        compaction_window=3600,
+    )
+    monkeypatch.setattr(main, "history_repository", repository)
+
+    for expression in ("2+2", "2*2", "2+2"):
+        assert client.post("/calculator/evaluate", json={"expression": expression}).json()["result"] == 4.0
+    main.history_writer.flush()
+
+    counts = {entry["expression"]: entry["count"] for entry in database.historial.find()}
+    assert counts == {"2+2": 2, "2*2": 1}
@@ -0,0 +1,65 @@
+# ==================== IMPORTS ====================
+import hashlib
+from typing import Optional, Tuple
+
+import numpy as np
+
+VECTOR_MEDIA_TYPE = "application/octet-stream"
+# Raw little-endian IEEE 754 doubles, independent of the server's byte order
+VECTOR_DTYPE = np.dtype("<f8")
+
+# Subtraction and division are left folds, like the sequential list operations.
+# Division must not be a / (b * c ...): the product can underflow to 0 (or
+# overflow to inf) where the fold still has a finite result
+VECTOR_REDUCTIONS = {
+    "sum": np.add.reduce,
+    "subtract": np.subtract.reduce,
+    "multiplication": np.multiply.reduce,
+    "division": np.divide.reduce,
+}
+
+class InvalidVector(ValueError):
+    """The request body is not a whole number of float64 values"""
+
+# ==================== PARSING ====================
+def parse_vector(body: bytes) -> np.ndarray:
+    """Wrap a raw float64 body as a read-only array without copying it"""
+    if len(body) % VECTOR_DTYPE.itemsize:
+        raise InvalidVector(f"Body length must be a multiple of {VECTOR_DTYPE.itemsize} bytes")
+    return np.frombuffer(body, dtype=VECTOR_DTYPE)
+
+# ==================== EVALUATION ====================
+def vector_error(operation: str, values: np.ndarray) -> Optional[Tuple[str, int]]:
+    """Same rules as the list endpoints, checked with array operations"""
+    if values.size < 2:
+        return "At least 2 numbers are required", 400
+    # Like `num < 0` in the list path: -inf is negative, NaN is not (and would hide negatives from min())
+    if (values < 0).any():
+        return "Negative numbers are not allowed", 400
+    # NaN is truthy, as it is not == 0 in the list path
+    if operation == "division" and not values[1:].all():
+        return "Division by zero", 403
+    return None
+
+def reduce_vector(operation: str, values: np.ndarray) -> float:
+    # Overflow gives inf, as with Python floats in the list operations
+    with np.errstate(over="ignore", under="ignore"):
+        return float(VECTOR_REDUCTIONS[operation](values))
+
+# ==================== HISTORY SUMMARY ====================
+def vector_preview(values: np.ndarray, count: int) -> list:
+    """First values of a vector for error responses; empty if they are not valid JSON numbers"""
+    head = values[:count]
+    return head.tolist() if np.isfinite(head).all() else []
+
+def summarize_vector(values: np.ndarray, preview: int) -> dict:
+    """Digest stored in history instead of the full operand list"""
+    summary = {
+        "count": int(values.size),
+        "sha256": hashlib.sha256(values.data).hexdigest(),
+        "preview": values[:preview].tolist(),
+    }
+    if values.size:
+        summary["min"] = float(values.min())
+        summary["max"] = float(values.max())
+    return summary
@@ -1,4 +1,4 @@
-import { useState, useEffect, useCallback } from "react";
+import { useState, useEffect, useCallback, useRef } from "react";
 import "./App.css";
 
 export default function App() {
@@ -9,10 +9,15 @@ export default function App() {
   const [isLoading, setIsLoading] = useState(false);
 
   const [history, setHistory] = useState([]);
-  const [completeHistory, setCompleteHistory] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  // Newest history entry this tab has seen; deltas are requested after it
+  const syncToken = useRef(null);
 
   const [operationFilter, setOperationFilter] = useState("all");
   const [dateFilter, setDateFilter] = useState("");
+  // Last complete, valid date typed; partial input keeps the previous filter
+  const [appliedDate, setAppliedDate] = useState("");
+  const [dateError, setDateError] = useState(null);
   const [sortBy, setSortBy] = useState("date");
   const [sortDirection, setSortDirection] = useState("desc");
 
@@ -41,6 +46,7 @@ export default function App() {
       multiplication: "×", // alias
       divide: "÷",
       division: "÷", // alias
+      evaluate: "ƒ", // /calculator/evaluate: the row shows the expression
       // legacy
       suma: "+",
       resta: "-",
@@ -61,62 +67,162 @@ export default function App() {
     return map[op] || op;
   };
 
-  // ==================== FILTERS (DECLARAR ANTES) ====================
-  const applyFilters = useCallback(
-    (data = completeHistory) => {
-      let filtered = [...data];
+  // ==================== HISTORY QUERY ====================
+  // Filters, sorting and pagination run on the server
+  const HISTORY_PAGE_SIZE = 50;
 
+  const toIsoDate = (value) => {
+    const match = /^(\d{2})\/(\d{2})\/(\d{4})$/.exec(value.trim());
+    if (!match) return null;
+    const [, day, month, year] = match;
+    // Rejects dates such as 31/02/2025, which Date would roll over
+    const d = new Date(Date.UTC(Number(year), Number(month) - 1, Number(day)));
+    if (
+      d.getUTCDate() !== Number(day) ||
+      d.getUTCMonth() !== Number(month) - 1
+    ) {
+      return null;
+    }
+    return `${year}-${month}-${day}`;
+  };
+
+  const updateDateFilter = (value) => {
+    setDateFilter(value);
+    const text = value.trim();
+    if (text && !toIsoDate(text)) {
+      // Not sent until complete: the list keeps the last valid filter meanwhile
+      setDateError("Enter a full date as dd/mm/yyyy");
+      return;
+    }
+    setDateError(null);
+    setAppliedDate(text);
+  };
+
+  const nextDay = (isoDate) => {
+    const d = new Date(`${isoDate}T00:00:00Z`);
+    d.setUTCDate(d.getUTCDate() + 1);
+    return d.toISOString().slice(0, 10);
+  };
+
+  const buildHistoryParams = useCallback(
+    (cursor) => {
+      const params = new URLSearchParams({
+        limit: HISTORY_PAGE_SIZE,
+        sort_by: sortBy,
+        order: sortDirection,
+      });
       if (operationFilter !== "all") {
-        filtered = filtered.filter(
-          (op) =>
-            normalizeOperation(op.operation) ===
-            normalizeOperation(operationFilter)
-        );
+        params.set("operation", normalizeOperation(operationFilter));
       }
+      const day = appliedDate && toIsoDate(appliedDate);
+      if (day) {
+        params.set("date_from", `${day}T00:00:00`);
+        params.set("date_to", `${nextDay(day)}T00:00:00`);
+      }
+      if (cursor) params.set("cursor", cursor);
+      return params;
+    },
+    [operationFilter, appliedDate, sortBy, sortDirection]
+  );
 
-      if (dateFilter) {
-        filtered = filtered.filter((op) =>
-          (op.date || "").includes(dateFilter)
+  // ==================== HISTORY ====================
+  const updateSyncToken = (token) => {
+    // Tokens are ObjectId hex strings, so string order is creation order
+    if (token && (!syncToken.current || token > syncToken.current)) {
+      syncToken.current = token;
+    }
+  };
+
+  const getHistory = useCallback(
+    async (cursor = null) => {
+      try {
+        // no-cache: the browser revalidates with If-None-Match and reuses its copy on 304
+        const res = await fetch(
+          `http://localhost:8089/calculator/history?${buildHistoryParams(
+            cursor
+          )}`,
+          { cache: "no-cache" }
         );
+        const data = await res.json();
+        if (res.ok) {
+          const list = data.history || [];
+          setHistory((prev) => (cursor ? [...prev, ...list] : list));
+          setNextCursor(data.next_cursor || null);
+          if (!cursor) {
+            syncToken.current = null;
+            updateSyncToken(data.sync_token);
+          }
+        }
+      } catch (err) {
+        console.error("Error getting history:", err);
       }
+    },
+    [buildHistoryParams]
+  );
 
-      filtered.sort((a, b) => {
-        let A, B;
-        if (sortBy === "date") {
-          const parse = (s = "") => {
-            const [d = "", t = "00:00"] = s.split(" ");
-            const [day = "01", mon = "01", year = "1970"] = d.split("/");
-            const [hh = "00", mm = "00"] = t.split(":");
-            return new Date(year, Number(mon) - 1, day, hh, mm);
-          };
-          A = parse(a.date);
-          B = parse(b.date);
-        } else {
-          A = a.result;
-          B = b.result;
-        }
-        return sortDirection === "asc" ? (A > B ? 1 : -1) : A < B ? 1 : -1;
-      });
+  // ==================== INCREMENTAL SYNC ====================
+  // New entries are prepended when the newest-first view is shown; other views reload
+  const matchesFilters = useCallback(
+    (op) => {
+      if (
+        operationFilter !== "all" &&
+        normalizeOperation(op.operation) !== normalizeOperation(operationFilter)
+      ) {
+        return false;
+      }
+      return !appliedDate || op.date.startsWith(appliedDate);
+    },
+    [operationFilter, appliedDate]
+  );
 
-      setHistory(filtered);
+  const applyNewEntries = useCallback(
+    (entries, token) => {
+      if (sortBy !== "date" || sortDirection !== "desc") {
+        getHistory();
+        return;
+      }
+      updateSyncToken(token);
+      setHistory((prev) => {
+        const incoming = new Map(
+          entries.filter(matchesFilters).map((op) => [op.id, op])
+        );
+        if (!incoming.size) return prev;
+        // Compacted entries come back with a higher count: update them in place
+        const updated = prev.map((op) => {
+          const next = incoming.get(op.id);
+          if (!next) return op;
+          incoming.delete(op.id);
+          return next;
+        });
+        return [...incoming.values(), ...updated];
+      });
     },
-    [operationFilter, dateFilter, sortBy, sortDirection, completeHistory]
+    [sortBy, sortDirection, matchesFilters, getHistory]
   );
 
-  // ==================== HISTORY (DECLARAR DESPUÉS) ====================
-  const getHistory = useCallback(async () => {
+  const syncHistory = useCallback(async () => {
+    if (!syncToken.current) {
+      getHistory();
+      return;
+    }
     try {
-      const res = await fetch("http://localhost:8089/calculator/history");
+      const params = buildHistoryParams(null);
+      params.set("since", syncToken.current);
+      const res = await fetch(
+        `http://localhost:8089/calculator/history?${params}`
+      );
       const data = await res.json();
-      if (res.ok) {
-        const list = data.history || [];
-        setCompleteHistory(list);
-        applyFilters(list);
+      if (!res.ok) return;
+      if (data.next_cursor) {
+        // Too many new entries for one delta
+        getHistory();
+      } else {
+        applyNewEntries(data.history || [], data.sync_token);
       }
     } catch (err) {
-      console.error("Error getting history:", err);
+      console.error("Error syncing history:", err);
     }
-  }, [applyFilters]);
+  }, [buildHistoryParams, applyNewEntries, getHistory]);
 
   // ==================== VALIDATION & OPS ====================
   const validateNumbers = () => {
@@ -149,7 +255,7 @@ export default function App() {
       if (!res.ok)
         throw new Error(data.error || data.detail || "Error in operation");
       setResult(data.result);
-      getHistory();
+      syncHistory();
     } catch (err) {
       setError(err.message);
       setResult(null);
@@ -163,14 +269,26 @@ export default function App() {
     getHistory();
   }, [getHistory]);
 
+  // Entries recorded by other tabs and clients are pushed by the server
   useEffect(() => {
-    applyFilters();
-  }, [applyFilters]);
+    const since = syncToken.current ? `?since=${syncToken.current}` : "";
+    const source = new EventSource(
+      `http://localhost:8089/calculator/history/events${since}`
+    );
+    source.addEventListener("history", (event) => {
+      const data = JSON.parse(event.data);
+      applyNewEntries(data.history || [], data.sync_token);
+    });
+    source.addEventListener("reset", () => getHistory());
+    return () => source.close();
+  }, [applyNewEntries, getHistory]);
 
   // ==================== CLEAR FILTERS ====================
   const clearFilters = () => {
     setOperationFilter("all");
     setDateFilter("");
+    setAppliedDate("");
+    setDateError(null);
     setSortBy("date");
     setSortDirection("desc");
   };
@@ -274,11 +392,15 @@ export default function App() {
               <label className="filter-label">Date (dd/mm/yyyy):</label>
               <input
                 type="text"
-                className="filter-input"
+                className={`filter-input${
+                  dateError ? " filter-input-invalid" : ""
+                }`}
                 value={dateFilter}
-                onChange={(e) => setDateFilter(e.target.value)}
+                onChange={(e) => updateDateFilter(e.target.value)}
                 placeholder="Ex: 22/09/2025"
+                aria-invalid={dateError ? "true" : "false"}
               />
+              {dateError && <div className="filter-error">{dateError}</div>}
             </div>
           </div>
 
@@ -314,10 +436,12 @@ export default function App() {
         <ul className="history-list">
           {history.length > 0 ? (
             history.map((op, i) => (
-              <li key={i} className="history-item">
+              <li key={op.id || i} className="history-item">
                 <div className="operation-info">
                   <div className="operation-text">
-                    {op.numbers
+                    {op.expression
+                      ? `${op.expression} = ${op.result}`
+                      : op.numbers
                       ? op.numbers.join(
                           ` ${getOperationSymbol(op.operation)} `
                         ) + ` = ${op.result}`
@@ -331,6 +455,7 @@ export default function App() {
                   </div>
                   <div className="operation-type">
                     {normalizeOperation(op.operation)}
+                    {op.count > 1 && ` ×${op.count}`}
                   </div>
                 </div>
                 <div className="operation-date">{formatDate(op.date)}</div>
@@ -340,6 +465,14 @@ export default function App() {
             <div className="no-history">No operations in history</div>
           )}
         </ul>
+
+        {nextCursor && (
+          <button
+            className="clear-filters-btn"
+            onClick={() => getHistory(nextCursor)}>
+            Load more
+          </button>
+        )}
       </div>
     </div>
   );